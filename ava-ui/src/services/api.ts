@@ -59,7 +59,7 @@ export class APIService {
 		}
 	}
 
-	async submitKnowledgeBase(payload: SubmitPayloadType): Promise<{ chatbot_request_id: string }> {
+	async submitKnowledgeBase(payload: SubmitPayloadType): Promise<{ chatbot_request_id: string; status?: string; result?: BedrockKnowledgeBaseResponseType }> {
 		try {
 			const session = await fetchAuthSession();
 			const idToken = session.tokens?.idToken?.toString();
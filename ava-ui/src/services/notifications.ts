@@ -0,0 +1,111 @@
+import { fetchAuthSession } from '@aws-amplify/auth';
+import type { BedrockKnowledgeBaseResponseType } from '@/types/bedrockKnowledgeBaseResponseType';
+
+export interface StatusNotification {
+	chatbot_request_id: string;
+	status: string;
+	result?: BedrockKnowledgeBaseResponseType | string;
+	// The answer was too big to push; fetch it with GET /chatbot
+	fetch?: boolean;
+}
+
+type StatusListener = (notification: StatusNotification) => void;
+
+const RECONNECT_DELAY_MS = 2000;
+
+// Receives finished answers over the WebSocket API so the chat only polls as a fallback
+export class NotificationService {
+	private socket: WebSocket | null = null;
+	private listeners = new Map<string, StatusListener>();
+	private reconnectTimer: ReturnType<typeof setTimeout> | null = null;
+	private connecting = false;
+
+	constructor(private url: string | undefined = import.meta.env.VITE_APP_WEBSOCKET_URL) {}
+
+	get available(): boolean {
+		return !!this.url && typeof WebSocket !== 'undefined';
+	}
+
+	get connected(): boolean {
+		return this.socket?.readyState === WebSocket.OPEN;
+	}
+
+	async connect(): Promise<void> {
+		if (!this.available || this.socket || this.connecting) {
+			return;
+		}
+		this.connecting = true;
+		let accessToken: string | undefined;
+		try {
+			// Browsers cannot set headers on a WebSocket, so the $connect authorizer reads the token from the URL
+			accessToken = (await fetchAuthSession()).tokens?.accessToken?.toString();
+		} catch (error) {
+			console.error('No session for notifications:', error);
+		} finally {
+			this.connecting = false;
+		}
+		if (!accessToken || this.socket) {
+			// Polling still delivers the answer
+			return;
+		}
+		const url = new URL(this.url!);
+		url.searchParams.set('token', accessToken);
+		const socket = new WebSocket(url.toString());
+		this.socket = socket;
+
+		socket.onopen = () => {
+			// Requests still waiting after a reconnect subscribe again
+			this.listeners.forEach((_, requestId) => this.sendSubscribe(requestId));
+		};
+		socket.onmessage = (event: MessageEvent) => {
+			try {
+				const notification: StatusNotification = JSON.parse(event.data);
+				this.listeners.get(notification.chatbot_request_id)?.(notification);
+			} catch (error) {
+				console.error('Invalid notification:', error);
+			}
+		};
+		socket.onclose = () => {
+			this.socket = null;
+			// Only worth reconnecting while someone is waiting for an answer
+			if (this.listeners.size > 0 && !this.reconnectTimer) {
+				this.reconnectTimer = setTimeout(() => {
+					this.reconnectTimer = null;
+					this.connect();
+				}, RECONNECT_DELAY_MS);
+			}
+		};
+		socket.onerror = (event: Event) => {
+			console.error('WebSocket error:', event);
+		};
+	}
+
+	subscribe(requestId: string, listener: StatusListener): () => void {
+		this.listeners.set(requestId, listener);
+		if (this.connected) {
+			this.sendSubscribe(requestId);
+		} else {
+			// onopen subscribes everything that is registered
+			this.connect();
+		}
+		return () => {
+			this.listeners.delete(requestId);
+		};
+	}
+
+	disconnect(): void {
+		this.listeners.clear();
+		if (this.reconnectTimer) {
+			clearTimeout(this.reconnectTimer);
+			this.reconnectTimer = null;
+		}
+		this.socket?.close();
+		this.socket = null;
+	}
+
+	private sendSubscribe(requestId: string): void {
+		this.socket?.send(JSON.stringify({ action: 'subscribe', chatbot_request_id: requestId }));
+	}
+}
+
+export default NotificationService;
@@ -11,4 +11,7 @@ export interface SubmitPayloadType {
     textPromptTemplate?: string | null;
     textInferenceConfig: TextInferenceConfigType;
     modelArn: string;
+    conversationId?: string;
+    // Ask for an inline answer; the API queues the request when it cannot give one
+    sync?: boolean;
 }
\ No newline at end of file
@@ -0,0 +1,570 @@
+"""End-to-end load benchmark for the submit -> queue -> worker -> poll pipeline.
+
+Drives index.handler and queue_handler.handler in-process against moto's
+DynamoDB and SQS and a fake Bedrock runtime, replaying traffic shaped like
+lambda/payload.json. Writes a JSON report and, given a baseline, exits non-zero
+when a route got slower, lost throughput or started making more AWS calls.
+
+    python benchmarks/pipeline.py --requests 200 --output benchmark-results.json \\
+        --baseline benchmarks/baseline.json
+"""
+import argparse
+import ast
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+CDK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(CDK_DIR, 'lambda')
+PAYLOAD_PATH = os.path.join(LAMBDA_DIR, 'payload.json')
+
+TRACKING_TABLE = 'ava-chatbot-tracking-table'
+STATE_TABLE = 'ava-chatbot-state-table'
+QUEUE_NAME = 'ava-chatbot-queue'
+
+SUBMIT_ROUTE = 'POST /chatbot'
+POLL_ROUTE = 'GET /chatbot'
+WORKER_ROUTE = 'worker'
+FINISHED_STATUSES = ('success', 'error')
+
+# Questions are drawn from a small pool so the answer cache and in-flight
+# coalescing see the kind of repetition real traffic has
+QUESTIONS = [
+    'what is the tone of the meeting?',
+    'summarize the action items',
+    'who attended the meeting?',
+    'what decisions were made?',
+    'what are the open risks?',
+    'list the deadlines that were mentioned',
+    'what did the team agree to follow up on?',
+    'which topics took the most time?'
+]
+
+
+def load_payload_template(path: str = PAYLOAD_PATH) -> Dict[str, Any]:
+    # payload.json is a Python repr of a tracking record, not strict JSON
+    with open(path, 'r') as payload_file:
+        record = ast.literal_eval(payload_file.read())
+    return record['payload']
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies_ms: List[float], calls: int, elapsed_seconds: float) -> Dict[str, Any]:
+    count = len(latencies_ms)
+    return {
+        'count': count,
+        'p50_ms': round(percentile(latencies_ms, 50), 2),
+        'p95_ms': round(percentile(latencies_ms, 95), 2),
+        'p99_ms': round(percentile(latencies_ms, 99), 2),
+        'throughput_per_second': round(count / elapsed_seconds, 2) if elapsed_seconds else 0.0,
+        'aws_calls': calls,
+        'aws_calls_per_request': round(calls / count, 3) if count else 0.0
+    }
+
+
+class CallCounter:
+    """Counts AWS calls per route, attributed through a thread-local tag."""
+
+    def __init__(self, default_route: str = WORKER_ROUTE):
+        self.default_route = default_route
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.calls: Dict[str, Dict[str, int]] = {}
+
+    @contextlib.contextmanager
+    def route(self, name: str):
+        previous = getattr(self._local, 'route', None)
+        self._local.route = name
+        try:
+            yield
+        finally:
+            self._local.route = previous
+
+    def record(self, operation: str) -> None:
+        route = getattr(self._local, 'route', None) or self.default_route
+        with self._lock:
+            operations = self.calls.setdefault(route, {})
+            operations[operation] = operations.get(operation, 0) + 1
+
+    def total(self, route: str) -> int:
+        return sum(self.calls.get(route, {}).values())
+
+    def on_before_call(self, service_name: str):
+        def handler(model, **kwargs):
+            self.record(f"{service_name}.{model.name}")
+        return handler
+
+
+class FakeBedrockAgentRuntime:
+    """Stand-in for bedrock-agent-runtime with configurable latency and throttling."""
+
+    def __init__(self, counter: CallCounter, latency_ms: float, jitter_ms: float,
+                 throttle_rate: float, seed: int, stream_chunks: int = 8):
+        self.counter = counter
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.stream_chunks = stream_chunks
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _roll(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'latency': max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)),
+                'throttle': self._random.random()
+            }
+
+    def _start(self, operation: str) -> float:
+        self.counter.record(f"bedrock-agent-runtime.{operation}")
+        roll = self._roll()
+        if roll['throttle'] < self.throttle_rate:
+            sleep(roll['latency'] / 10000.0)
+            raise ClientError(
+                {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                operation
+            )
+        return roll['latency']
+
+    @staticmethod
+    def _answer(input_text: str) -> str:
+        return f"Answer to: {input_text}. " + 'The meeting covered several topics in detail. ' * 6
+
+    @staticmethod
+    def _citation(text: str) -> Dict[str, Any]:
+        return {
+            'generatedResponsePart': {'textResponsePart': {'text': text, 'span': {'start': 0, 'end': len(text)}}},
+            'retrievedReferences': [{
+                'content': {'text': 'Transcript excerpt used to answer the question.'},
+                'location': {'type': 'S3', 's3Location': {'uri': 's3://ava-kb/meeting.txt'}}
+            }]
+        }
+
+    def retrieve_and_generate(self, **request):
+        latency_ms = self._start('RetrieveAndGenerate')
+        sleep(latency_ms / 1000.0)
+        text = self._answer(request['input']['text'])
+        return {
+            'output': {'text': text},
+            'citations': [self._citation(text)],
+            'sessionId': 'benchmark-session',
+            'ResponseMetadata': {'HTTPStatusCode': 200}
+        }
+
+    def retrieve_and_generate_stream(self, **request):
+        latency_ms = self._start('RetrieveAndGenerateStream')
+        text = self._answer(request['input']['text'])
+        size = max(1, len(text) // self.stream_chunks)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+
+        def events():
+            for chunk in chunks:
+                sleep(latency_ms / 1000.0 / len(chunks))
+                yield {'output': {'text': chunk}}
+            yield {'citation': {'citation': self._citation(text)}}
+
+        return {'stream': events(), 'sessionId': 'benchmark-session'}
+
+
+class PipelineBenchmark:
+    def __init__(self, requests: int = 100, concurrency: int = 10, bedrock_latency_ms: float = 200.0,
+                 bedrock_jitter_ms: float = 50.0, throttle_rate: float = 0.0, poll_interval_ms: float = 50.0,
+                 worker_batch_size: int = 10, worker_concurrency: int = 10, poll_timeout_seconds: float = 60.0,
+                 streaming: bool = False, seed: int = 7):
+        self.requests = requests
+        self.concurrency = concurrency
+        self.bedrock_latency_ms = bedrock_latency_ms
+        self.bedrock_jitter_ms = bedrock_jitter_ms
+        self.throttle_rate = throttle_rate
+        self.poll_interval_ms = poll_interval_ms
+        self.worker_batch_size = worker_batch_size
+        self.worker_concurrency = worker_concurrency
+        self.poll_timeout_seconds = poll_timeout_seconds
+        self.streaming = streaming
+        self.seed = seed
+        self.counter = CallCounter()
+        self.latencies: Dict[str, List[float]] = {SUBMIT_ROUTE: [], POLL_ROUTE: [], WORKER_ROUTE: []}
+        self.end_to_end: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.errors: List[Any] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    # --- environment -----------------------------------------------------------
+
+    def _setup(self):
+        import boto3
+
+        for name, value in {
+            'AWS_DEFAULT_REGION': 'us-east-1',
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'DYNAMODB_TABLE': TRACKING_TABLE,
+            'STATE_TABLE': STATE_TABLE,
+            'METRICS_ENABLED': 'false',
+            'DEBUG_LOG_SAMPLE_RATE': '0'
+        }.items():
+            os.environ[name] = value
+
+        dynamodb = boto3.client('dynamodb')
+        for table_name, key in ((TRACKING_TABLE, 'chatbot_request_id'), (STATE_TABLE, 'pk')):
+            dynamodb.create_table(
+                TableName=table_name,
+                KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+        # The driver plays the SQS event source; its own calls are not counted
+        self.sqs = boto3.client('sqs')
+        self.queue_url = self.sqs.create_queue(
+            QueueName=QUEUE_NAME,
+            Attributes={'VisibilityTimeout': '1'}
+        )['QueueUrl']
+        os.environ['SQS_QUEUE_URL'] = self.queue_url
+
+        if LAMBDA_DIR not in sys.path:
+            sys.path.insert(0, LAMBDA_DIR)
+        import aws_clients
+        import answer_cache
+        import index
+        import metrics
+        import queue_handler
+
+        aws_clients.reset()
+        # Module settings are read at import, which may have happened earlier
+        answer_cache.STATE_TABLE = STATE_TABLE
+        answer_cache.ENABLED = True
+        answer_cache._local.clear()
+        index.QUEUE_URL = queue_handler.QUEUE_URL = self.queue_url
+        queue_handler.WORKER_STREAMING = self.streaming
+        queue_handler.WORKER_CONCURRENCY = self.worker_concurrency
+        metrics.METRICS_ENABLED = False
+        metrics.DEBUG_LOG_SAMPLE_RATE = 0
+
+        original_instrument = metrics.instrument_client
+
+        def instrument_client(service_client):
+            original_instrument(service_client)
+            service_name = service_client.meta.service_model.service_id.hyphenize()
+            service_client.meta.events.register('before-call', self.counter.on_before_call(service_name))
+
+        metrics.instrument_client = instrument_client
+
+        # moto applies DynamoDB writes without locking, while the real service
+        # serializes them per item; the answer cache's conditional claims and
+        # list_append waiters depend on that, so calls are serialized here
+        from moto.dynamodb.responses import DynamoHandler
+        original_call_action = DynamoHandler.call_action
+        dynamodb_lock = threading.Lock()
+
+        def call_action(handler):
+            with dynamodb_lock:
+                return original_call_action(handler)
+
+        DynamoHandler.call_action = call_action
+
+        def restore():
+            metrics.instrument_client = original_instrument
+            DynamoHandler.call_action = original_call_action
+
+        self._restore = restore
+        aws_clients._clients['bedrock-agent-runtime'] = FakeBedrockAgentRuntime(
+            self.counter, self.bedrock_latency_ms, self.bedrock_jitter_ms, self.throttle_rate, self.seed
+        )
+        self.aws_clients = aws_clients
+        self.index = index
+        self.queue_handler = queue_handler
+
+    # --- traffic ---------------------------------------------------------------
+
+    def _events(self) -> List[Dict[str, Any]]:
+        template = load_payload_template()
+        rng = random.Random(self.seed)
+        events = []
+        for number in range(self.requests):
+            body = {
+                **template,
+                'message': rng.choice(QUESTIONS)
+            }
+            events.append({
+                'httpMethod': 'POST',
+                'path': '/chatbot',
+                'body': json.dumps(body),
+                'requestContext': {'authorizer': {'claims': {'sub': f"benchmark-user-{number}"}}}
+            })
+        return events
+
+    def _warm_thread(self) -> None:
+        # A Lambda container builds its DynamoDB resource once; keep that
+        # one-off cost out of the per-request figures
+        self.aws_clients.tracking_table()
+        self.aws_clients.state_table()
+
+    def _warm_worker(self) -> None:
+        if self.worker_concurrency <= 1:
+            self._warm_thread()
+            return
+        # The barrier makes every pool thread take exactly one warm-up task
+        barrier = threading.Barrier(self.worker_concurrency)
+
+        def warm():
+            barrier.wait(timeout=10)
+            self._warm_thread()
+
+        executor = self.queue_handler.get_executor()
+        for future in [executor.submit(warm) for _ in range(self.worker_concurrency)]:
+            future.result()
+
+    def _timed(self, route: str, event: Dict[str, Any]) -> Dict[str, Any]:
+        started = perf_counter()
+        with self.counter.route(route):
+            response = self.index.handler(event, None)
+        with self._lock:
+            self.latencies[route].append((perf_counter() - started) * 1000)
+        return response
+
+    def _conversation(self, event: Dict[str, Any]) -> None:
+        started = perf_counter()
+        response = self._timed(SUBMIT_ROUTE, event)
+        body = json.loads(response['body'])
+        status = body.get('status')
+        if response['statusCode'] != 200 or body.get('success') is False:
+            status = 'submit_error'
+            with self._lock:
+                self.errors.append(body.get('error'))
+        if status not in FINISHED_STATUSES and 'chatbot_request_id' in body:
+            deadline = started + self.poll_timeout_seconds
+            poll_event = {
+                'httpMethod': 'GET',
+                'path': '/chatbot',
+                'queryStringParameters': {'url': body['chatbot_request_id']},
+                # Records are only returned to the user who submitted them
+                'requestContext': event['requestContext']
+            }
+            status = 'timeout'
+            while perf_counter() < deadline:
+                sleep(self.poll_interval_ms / 1000.0)
+                poll = self._timed(POLL_ROUTE, poll_event)
+                if poll['statusCode'] != 200:
+                    continue
+                record_status = json.loads(poll['body']).get('status')
+                if record_status in FINISHED_STATUSES:
+                    status = record_status
+                    break
+        with self._lock:
+            self.end_to_end.append((perf_counter() - started) * 1000)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def _worker_loop(self) -> None:
+        # Plays the Lambda SQS event source: receive a batch, invoke, delete
+        # what succeeded and leave failures to reappear after the visibility timeout
+        while not self._stop.is_set():
+            messages = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=self.worker_batch_size,
+                WaitTimeSeconds=0
+            ).get('Messages', [])
+            if not messages:
+                sleep(0.01)
+                continue
+            event = {'Records': [
+                {'messageId': message['MessageId'], 'body': message['Body'],
+                 'receiptHandle': message['ReceiptHandle']}
+                for message in messages
+            ]}
+            started = perf_counter()
+            with self.counter.route(WORKER_ROUTE):
+                result = self.queue_handler.handler(event, None)
+            elapsed_ms = (perf_counter() - started) * 1000
+            failed = {failure['itemIdentifier'] for failure in result.get('batchItemFailures', [])}
+            with self._lock:
+                self.latencies[WORKER_ROUTE].extend([elapsed_ms] * len(messages))
+            done = [message for message in messages if message['MessageId'] not in failed]
+            if done:
+                self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                             for i, message in enumerate(done)]
+                )
+
+    # --- run -------------------------------------------------------------------
+
+    def run(self) -> Dict[str, Any]:
+        from moto import mock_aws
+
+        with mock_aws(), contextlib.redirect_stdout(io.StringIO()):
+            self._setup()
+            try:
+                events = self._events()
+                self._warm_worker()
+                worker = threading.Thread(target=self._worker_loop, daemon=True)
+                worker.start()
+                started = perf_counter()
+                with ThreadPoolExecutor(max_workers=self.concurrency, initializer=self._warm_thread) as pool:
+                    list(pool.map(self._conversation, events))
+                elapsed = perf_counter() - started
+                self._stop.set()
+                worker.join(timeout=10)
+            finally:
+                self._restore()
+        return self._report(elapsed)
+
+    def _report(self, elapsed: float) -> Dict[str, Any]:
+        routes = {
+            route: summarize(latencies, self.counter.total(route), elapsed)
+            for route, latencies in self.latencies.items()
+        }
+        total_calls = sum(self.counter.total(route) for route in self.counter.calls)
+        end_to_end = summarize(self.end_to_end, total_calls, elapsed)
+        return {
+            'config': {
+                'requests': self.requests,
+                'concurrency': self.concurrency,
+                'bedrock_latency_ms': self.bedrock_latency_ms,
+                'bedrock_jitter_ms': self.bedrock_jitter_ms,
+                'throttle_rate': self.throttle_rate,
+                'poll_interval_ms': self.poll_interval_ms,
+                'worker_batch_size': self.worker_batch_size,
+                'worker_concurrency': self.worker_concurrency,
+                'streaming': self.streaming,
+                'seed': self.seed
+            },
+            'elapsed_seconds': round(elapsed, 3),
+            'statuses': dict(sorted(self.statuses.items())),
+            'sample_errors': self.errors[:5],
+            'end_to_end': end_to_end,
+            'routes': routes,
+            'aws_calls': {route: dict(sorted(ops.items())) for route, ops in sorted(self.counter.calls.items())}
+        }
+
+
+def combine_runs(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge repeated runs, taking the median of every per-route figure."""
+    if len(reports) == 1:
+        return reports[0]
+
+    def median_section(sections: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {key: percentile([section[key] for section in sections], 50) for key in sections[0]}
+
+    combined = dict(reports[-1])
+    combined['runs'] = len(reports)
+    combined['elapsed_seconds'] = percentile([report['elapsed_seconds'] for report in reports], 50)
+    combined['end_to_end'] = median_section([report['end_to_end'] for report in reports])
+    combined['routes'] = {
+        route: median_section([report['routes'][route] for report in reports])
+        for route in reports[0]['routes']
+    }
+    statuses: Dict[str, int] = {}
+    for report in reports:
+        for status, count in report['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + count
+    combined['statuses'] = statuses
+    combined['sample_errors'] = [error for report in reports for error in report['sample_errors']][:5]
+    return combined
+
+
+def find_regressions(results: Dict[str, Any], baseline: Dict[str, Any], latency_tolerance: float = 1.0,
+                     calls_tolerance: float = 0.25, latency_floor_ms: float = 25.0) -> List[str]:
+    """Compare a run against a baseline report and describe every regression.
+
+    Latency only counts as regressed when it is both relatively and absolutely
+    worse, so millisecond-level noise on fast routes does not fail the run;
+    p99 is reported but too noisy in-process to gate on.
+    """
+    regressions = []
+    sections = {'end_to_end': results['end_to_end'], **results['routes']}
+    baseline_sections = {'end_to_end': baseline.get('end_to_end', {}), **baseline.get('routes', {})}
+    for name, expected in baseline_sections.items():
+        actual = sections.get(name)
+        if not actual or not expected:
+            continue
+        for metric in ('p50_ms', 'p95_ms'):
+            limit = max(expected.get(metric, 0) * (1 + latency_tolerance), expected.get(metric, 0) + latency_floor_ms)
+            if actual[metric] > limit:
+                regressions.append(f"{name} {metric} {actual[metric]} > {round(limit, 2)}")
+        floor = expected.get('throughput_per_second', 0) * (1 - latency_tolerance)
+        if actual['throughput_per_second'] < floor:
+            regressions.append(f"{name} throughput_per_second {actual['throughput_per_second']} < {round(floor, 2)}")
+        # End-to-end calls include polling, which grows with latency already checked above
+        if name == 'end_to_end' or 'aws_calls_per_request' not in expected:
+            continue
+        ceiling = expected['aws_calls_per_request'] * (1 + calls_tolerance)
+        if actual['aws_calls_per_request'] > ceiling:
+            regressions.append(f"{name} aws_calls_per_request {actual['aws_calls_per_request']} > {round(ceiling, 3)}")
+    failed = sum(count for status, count in results['statuses'].items() if status != 'success')
+    if failed:
+        regressions.append(f"{failed} requests did not succeed: {results['statuses']}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--bedrock-latency-ms', type=float, default=200.0)
+    parser.add_argument('--bedrock-jitter-ms', type=float, default=50.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--poll-interval-ms', type=float, default=50.0)
+    parser.add_argument('--worker-batch-size', type=int, default=10)
+    parser.add_argument('--worker-concurrency', type=int, default=10)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--runs', type=int, default=3, help='repeat the run and report medians')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--baseline', help='report to compare against; regressions exit with status 1')
+    parser.add_argument('--latency-tolerance', type=float, default=1.0)
+    parser.add_argument('--calls-tolerance', type=float, default=0.25)
+    parser.add_argument('--latency-floor-ms', type=float, default=25.0)
+    args = parser.parse_args(argv)
+
+    results = combine_runs([
+        PipelineBenchmark(
+            requests=args.requests,
+            concurrency=args.concurrency,
+            bedrock_latency_ms=args.bedrock_latency_ms,
+            bedrock_jitter_ms=args.bedrock_jitter_ms,
+            throttle_rate=args.throttle_rate,
+            poll_interval_ms=args.poll_interval_ms,
+            worker_batch_size=args.worker_batch_size,
+            worker_concurrency=args.worker_concurrency,
+            streaming=args.streaming,
+            seed=args.seed
+        ).run()
+        for _ in range(max(1, args.runs))
+    ])
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline, args.latency_tolerance,
+                                       args.calls_tolerance, args.latency_floor_ms)
+    results['regressions'] = regressions
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(json.dumps({'end_to_end': results['end_to_end'], 'routes': results['routes'],
+                      'statuses': results['statuses']}, indent=2))
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+from time import time
+from typing import Dict, Any, List, Optional, Tuple
+
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+import aws_clients
+import result_store
+from local_cache import LocalTTLCache
+
+STATE_TABLE = os.environ.get('STATE_TABLE')
+ENABLED = bool(STATE_TABLE) and os.environ.get('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+
+# How long a generated answer is served from the DynamoDB tier
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '3600'))
+# The in-process tier is short lived so invalidations from other containers
+# are picked up quickly
+ANSWER_CACHE_LOCAL_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_LOCAL_TTL_SECONDS', '60'))
+ANSWER_CACHE_LOCAL_SIZE = int(os.environ.get('ANSWER_CACHE_LOCAL_SIZE', '128'))
+# An in-flight entry older than this is treated as abandoned and can be reclaimed
+ANSWER_CACHE_PENDING_SECONDS = int(os.environ.get('ANSWER_CACHE_PENDING_SECONDS', '300'))
+
+STATE_PENDING = 'pending'
+STATE_READY = 'ready'
+
+OWNER = 'owner'
+WAITER = 'waiter'
+HIT = 'hit'
+
+# Every form an entry's answer may be stored in, removed when it changes hands
+_STORED_RESULT = ', '.join(['#result', *result_store.STORED_ATTRIBUTES])
+
+_local = LocalTTLCache(ANSWER_CACHE_LOCAL_SIZE, ANSWER_CACHE_LOCAL_TTL_SECONDS)
+_deserializer = TypeDeserializer()
+
+
+def _now_ms() -> int:
+    return int(time() * 1000)
+
+
+def _entry_key(cache_key: str) -> Dict[str, str]:
+    return {'pk': f"answer#{cache_key}"}
+
+
+def invalidation_key(knowledge_base_id: str) -> Dict[str, str]:
+    return {'pk': f"answer-kb#{knowledge_base_id}"}
+
+
+def _error_item(e: ClientError) -> Optional[Dict[str, Any]]:
+    raw_item = e.response.get('Item')
+    if not raw_item:
+        return None
+    return {key: _deserializer.deserialize(value) for key, value in raw_item.items()}
+
+
+def normalize_message(message: str) -> str:
+    return ' '.join(message.split()).lower()
+
+
+def cache_key(payload: Dict[str, Any]) -> str:
+    material = {
+        'knowledgeBaseId': payload.get('knowledgeBaseId'),
+        'modelArn': payload.get('modelArn'),
+        'message': normalize_message(payload.get('message') or ''),
+        'templateId': payload.get('templateId'),
+        'textPromptTemplate': payload.get('textPromptTemplate'),
+        'textInferenceConfig': payload.get('textInferenceConfig')
+    }
+    encoded = json.dumps(material, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _is_fresh(entry: Dict[str, Any], invalidated_at: int) -> bool:
+    return (
+        entry.get('state') == STATE_READY
+        and int(entry.get('expires_at', 0)) > time()
+        and int(entry.get('created_at', 0)) > invalidated_at
+    )
+
+
+def lookup(cache_key: str, knowledge_base_id: str) -> Tuple[Optional[Dict[str, Any]], int]:
+    """Return the cached answer (or None) and the KB's last invalidation time."""
+    local_entry = _local.get(cache_key)
+    if local_entry is not None:
+        return local_entry['result'], 0
+
+    # The entry and the KB invalidation marker come back in one round trip
+    response = aws_clients.state_table().meta.client.batch_get_item(
+        RequestItems={
+            STATE_TABLE: {
+                'Keys': [
+                    _entry_key(cache_key),
+                    invalidation_key(knowledge_base_id)
+                ],
+                'ConsistentRead': True
+            }
+        }
+    )
+    items = {
+        item['pk']: item
+        for item in response.get('Responses', {}).get(STATE_TABLE, [])
+    }
+
+    marker = items.get(invalidation_key(knowledge_base_id)['pk'], {})
+    invalidated_at = int(marker.get('invalidated_at', 0))
+    entry = items.get(_entry_key(cache_key)['pk'])
+    if entry and _is_fresh(entry, invalidated_at):
+        result = result_store.decode(entry)
+        _local.put(cache_key, {'result': result, 'knowledgeBaseId': knowledge_base_id})
+        return result, invalidated_at
+    return None, invalidated_at
+
+
+def claim(cache_key: str, knowledge_base_id: str, chatbot_request_id: str,
+          invalidated_at: int = 0) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Register a request for an answer that was not in the cache.
+
+    Returns (OWNER, None) when this request must generate the answer,
+    (WAITER, None) when an identical request is already generating it and
+    will publish to this request too, or (HIT, result) when the answer landed
+    in the meantime.
+    """
+    now = _now_ms()
+    try:
+        aws_clients.state_table().update_item(
+            Key=_entry_key(cache_key),
+            UpdateExpression=(
+                'SET #state = :pending, #owner = :owner, knowledgeBaseId = :kb, '
+                'created_at = :now, expires_at = :expires_at, '
+                # Requests waiting on an expired claim wait on this one instead
+                'waiters = list_append(if_not_exists(waiters, :empty), :empty) '
+                f"REMOVE {_STORED_RESULT}"
+            ),
+            ConditionExpression=(
+                'attribute_not_exists(pk) OR expires_at < :now_seconds '
+                'OR (#state = :ready AND created_at <= :invalidated_at)'
+            ),
+            ExpressionAttributeNames={
+                '#state': 'state',
+                '#owner': 'owner',
+                '#result': 'result'
+            },
+            ExpressionAttributeValues={
+                ':pending': STATE_PENDING,
+                ':ready': STATE_READY,
+                ':owner': chatbot_request_id,
+                ':kb': knowledge_base_id,
+                ':now': now,
+                ':now_seconds': now // 1000,
+                ':expires_at': now // 1000 + ANSWER_CACHE_PENDING_SECONDS,
+                ':invalidated_at': invalidated_at,
+                ':empty': []
+            },
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return OWNER, None
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        existing = _error_item(e)
+
+    if existing and existing.get('state') == STATE_READY:
+        return HIT, result_store.decode(existing)
+
+    # Someone else is generating this answer: ask to be told when it is ready
+    try:
+        aws_clients.state_table().update_item(
+            Key=_entry_key(cache_key),
+            UpdateExpression='SET waiters = list_append(waiters, :waiter)',
+            ConditionExpression='#state = :pending',
+            ExpressionAttributeNames={
+                '#state': 'state'
+            },
+            ExpressionAttributeValues={
+                ':pending': STATE_PENDING,
+                ':waiter': [chatbot_request_id]
+            },
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return WAITER, None
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        existing = _error_item(e)
+
+    if existing and existing.get('state') == STATE_READY:
+        return HIT, result_store.decode(existing)
+    # The entry vanished between the two calls; generate it ourselves
+    return OWNER, None
+
+
+def _release(cache_key: str, chatbot_request_id: str, update_expression: str,
+             values: Dict[str, Any]) -> List[str]:
+    try:
+        response = aws_clients.state_table().update_item(
+            Key=_entry_key(cache_key),
+            UpdateExpression=update_expression,
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={
+                '#state': 'state',
+                '#owner': 'owner',
+                '#result': 'result'
+            },
+            ExpressionAttributeValues={
+                ':owner': chatbot_request_id,
+                **values
+            },
+            ReturnValues='ALL_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            # The claim expired and was taken over by another request
+            return []
+        raise
+    return list(response.get('Attributes', {}).get('waiters', []))
+
+
+def complete(cache_key: str, chatbot_request_id: str, result: Dict[str, Any],
+             stored_result: Optional[Dict[str, Any]] = None) -> List[str]:
+    """Publish a generated answer and return the requests that were waiting for it.
+
+    The answer is kept the way tracking records keep it, compressed or in S3,
+    so a large one fits; stored_result reuses what the owner's record holds.
+    """
+    stored_result = stored_result or result_store.encode(chatbot_request_id, result)
+    now = _now_ms()
+    assignments = ', '.join(f"{attribute} = :{attribute}" for attribute in stored_result)
+    removals = ', '.join(
+        ['waiters', '#owner', '#result']
+        + [attribute for attribute in result_store.STORED_ATTRIBUTES if attribute not in stored_result]
+    )
+    return _release(
+        cache_key,
+        chatbot_request_id,
+        f"SET #state = :ready, {assignments}, created_at = :now, expires_at = :expires_at REMOVE {removals}",
+        {
+            ':ready': STATE_READY,
+            **{f":{attribute}": value for attribute, value in stored_result.items()},
+            ':now': now,
+            ':expires_at': now // 1000 + ANSWER_CACHE_TTL_SECONDS
+        }
+    )
+
+
+def abandon(cache_key: str, chatbot_request_id: str) -> List[str]:
+    """Drop an in-flight entry whose generation failed and return its waiters."""
+    return _release(
+        cache_key,
+        chatbot_request_id,
+        f"SET expires_at = :expired REMOVE waiters, #state, {_STORED_RESULT}",
+        {
+            ':expired': 0
+        }
+    )
+
+
+def invalidate_knowledge_base(knowledge_base_id: str) -> None:
+    """Treat every answer cached so far for a knowledge base as stale."""
+    now = _now_ms()
+    aws_clients.state_table().put_item(
+        Item={
+            **invalidation_key(knowledge_base_id),
+            'invalidated_at': now,
+            # Answers never outlive their TTL, so neither does the marker
+            'expires_at': now // 1000 + ANSWER_CACHE_TTL_SECONDS + 60
+        }
+    )
+    _local.discard_where(lambda key, value: value.get('knowledgeBaseId') == knowledge_base_id)
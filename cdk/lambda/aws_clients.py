@@ -0,0 +1,147 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+import metrics
+
+# Shared by every client; sized for the worker and catalog thread pools
+CLIENT_CONFIG = Config(
+    connect_timeout=float(os.environ.get('AWS_CONNECT_TIMEOUT_SECONDS', '2')),
+    read_timeout=float(os.environ.get('AWS_READ_TIMEOUT_SECONDS', '10')),
+    max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '20')),
+    retries={
+        'max_attempts': 3,
+        'mode': 'standard'
+    },
+    tcp_keepalive=True
+)
+
+# Generation calls stay open for as long as the model is writing
+_GENERATION_CONFIG = CLIENT_CONFIG.merge(Config(
+    read_timeout=float(os.environ.get('BEDROCK_READ_TIMEOUT_SECONDS', '120'))
+))
+_SERVICE_CONFIG = {
+    'bedrock-agent-runtime': _GENERATION_CONFIG,
+    'bedrock-runtime': _GENERATION_CONFIG
+}
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_generation = 0
+_thread_state = threading.local()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def _cached_client(key: str, build):
+    service_client = _clients.get(key)
+    if service_client is None:
+        with _lock:
+            service_client = _clients.get(key)
+            if service_client is None:
+                service_client = build()
+                metrics.instrument_client(service_client)
+                _clients[key] = service_client
+    return service_client
+
+
+def client(service_name: str):
+    """Return the client for a service, building it on first use.
+
+    Clients are thread safe and live for the whole Lambda container, so warm
+    invocations reuse their connections.
+    """
+    return _cached_client(service_name, lambda: _get_session().client(
+        service_name,
+        config=_SERVICE_CONFIG.get(service_name, CLIENT_CONFIG)
+    ))
+
+
+def table(table_name: str):
+    # boto3 resources are not thread safe, so every thread gets its own
+    if getattr(_thread_state, 'generation', None) != _generation:
+        _thread_state.__dict__.clear()
+        _thread_state.generation = _generation
+        _thread_state.tables = {}
+    tables = _thread_state.tables
+    dynamodb_table = tables.get(table_name)
+    if dynamodb_table is None:
+        resource = getattr(_thread_state, 'dynamodb', None)
+        if resource is None:
+            resource = boto3.session.Session().resource('dynamodb', config=CLIENT_CONFIG)
+            metrics.instrument_client(resource.meta.client)
+            _thread_state.dynamodb = resource
+        dynamodb_table = tables[table_name] = resource.Table(table_name)
+    return dynamodb_table
+
+
+def sqs():
+    return client('sqs')
+
+
+def s3():
+    return client('s3')
+
+
+def bedrock():
+    return client('bedrock')
+
+
+def bedrock_agent():
+    return client('bedrock-agent')
+
+
+def bedrock_agent_runtime():
+    return client('bedrock-agent-runtime')
+
+
+def bedrock_runtime():
+    return client('bedrock-runtime')
+
+
+def bedrock_agent_runtime_with_deadline(deadline_seconds: float):
+    """A client whose calls give up after deadline_seconds, without retrying."""
+    return _cached_client(f"bedrock-agent-runtime@{deadline_seconds:g}", lambda: _get_session().client(
+        'bedrock-agent-runtime',
+        config=CLIENT_CONFIG.merge(Config(
+            read_timeout=deadline_seconds,
+            retries={
+                'max_attempts': 1,
+                'mode': 'standard'
+            }
+        ))
+    ))
+
+
+def websocket_management():
+    # Posts to the WebSocket API's connections; the endpoint is the stage's callback URL
+    return _cached_client('apigatewaymanagementapi', lambda: _get_session().client(
+        'apigatewaymanagementapi',
+        endpoint_url=os.environ['WEBSOCKET_ENDPOINT'],
+        config=CLIENT_CONFIG
+    ))
+
+
+def tracking_table():
+    return table(os.environ['DYNAMODB_TABLE'])
+
+
+def state_table():
+    return table(os.environ['STATE_TABLE'])
+
+
+def reset() -> None:
+    """Forget every client and table, e.g. between benchmark runs."""
+    global _session, _generation
+    with _lock:
+        _clients.clear()
+        _session = None
+        _generation += 1
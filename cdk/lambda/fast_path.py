@@ -0,0 +1,91 @@
+import os
+import traceback
+from time import perf_counter
+from typing import Dict, Any, Optional, Tuple
+
+import aws_clients
+import job_retry
+import kb_request
+import metrics
+import rate_limiter
+import result_store
+import sessions
+import template_registry
+import usage
+
+ENABLED = os.environ.get('SYNC_ENABLED', 'true').lower() == 'true'
+
+# The whole answer has to arrive inside the API Gateway integration timeout
+# (29 seconds); anything slower is handed to the queue instead
+SYNC_DEADLINE_SECONDS = float(os.environ.get('SYNC_DEADLINE_SECONDS', '8'))
+
+# Comma separated substrings of the model ARNs fast enough to answer inline
+SYNC_MODEL_ALLOWLIST = [
+    pattern.strip()
+    for pattern in os.environ.get('SYNC_MODEL_ALLOWLIST', 'claude-3-5-haiku,claude-3-haiku').split(',')
+    if pattern.strip()
+]
+SYNC_MAX_MESSAGE_CHARS = int(os.environ.get('SYNC_MAX_MESSAGE_CHARS', '1000'))
+
+
+def ineligible_reason(payload: Dict[str, Any]) -> Optional[str]:
+    """Why a request has to go through the queue, or None if it may be answered inline."""
+    if not ENABLED:
+        return 'disabled'
+    if not any(pattern in (payload.get('modelArn') or '') for pattern in SYNC_MODEL_ALLOWLIST):
+        return 'model'
+    if len(payload.get('message') or '') > SYNC_MAX_MESSAGE_CHARS:
+        return 'message_length'
+    if job_retry.breaker_for(payload['modelArn']).wait_seconds() > 0:
+        return 'circuit_open'
+    return None
+
+
+def _call(payload: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    reason = ineligible_reason(payload)
+    if reason:
+        return None, reason
+
+    template = template_registry.template_for(payload)
+    request = kb_request.build_request(payload, template)
+    tokens = rate_limiter.estimate_tokens(template + payload['message'], kb_request.inference_config(request)['maxTokens'])
+    if rate_limiter.acquire(payload['modelArn'], tokens) > 0:
+        return None, 'rate_limited'
+
+    breaker = job_retry.breaker_for(payload['modelArn'])
+    started = perf_counter()
+    try:
+        response = aws_clients.bedrock_agent_runtime_with_deadline(SYNC_DEADLINE_SECONDS).retrieve_and_generate(**request)
+    except Exception as e:
+        if job_retry.is_throttling(e):
+            breaker.record_failure()
+        # Timeouts, throttles, rejected sessions: the worker knows how to deal with them
+        print(f"Sync answer failed, queueing instead: {job_retry.error_code(e)}: {str(e)}")
+        return None, 'error'
+    breaker.record_success()
+    usage.record(
+        payload.get('userSub'),
+        payload['modelArn'],
+        usage.measure(response, template + payload['message'], (perf_counter() - started) * 1000)
+    )
+
+    if payload.get('conversationKey') and response.get('sessionId') and sessions.ENABLED:
+        try:
+            sessions.save(payload['conversationKey'], response['sessionId'])
+        except Exception:
+            print(traceback.format_exc())
+    return result_store.expand(result_store.compact(response)), None
+
+
+def answer(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Answer a request inline within SYNC_DEADLINE_SECONDS, or return None to queue it."""
+    result, reason = _call(payload)
+    metrics.emit(
+        {
+            'SyncAnswered': (1 if result is not None else 0, 'Count'),
+            'SyncFallbacks': (0 if result is not None else 1, 'Count')
+        },
+        {'Function': 'Api'},
+        properties={'FallbackReason': reason}
+    )
+    return result
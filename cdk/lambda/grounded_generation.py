@@ -0,0 +1,94 @@
+import re
+from typing import Dict, Any, List
+
+import aws_clients
+import retrieval_cache
+import template_registry
+
+OUTPUT_FORMAT_INSTRUCTIONS = (
+    'Cite the search results that support each paragraph by their number in square '
+    'brackets, for example [1] or [2][3], at the end of the paragraph.'
+)
+
+_CITATION_MARKER = re.compile(r'\s*\[(\d+)\]')
+
+def format_search_results(results: List[Dict[str, Any]]) -> str:
+    return '\n'.join(
+        f"<search_result>\n<index>{number}</index>\n"
+        f"<content>{result.get('content', {}).get('text', '')}</content>\n</search_result>"
+        for number, result in enumerate(results, start=1)
+    )
+
+
+def build_prompt(template: str, query: str, results: List[Dict[str, Any]]) -> str:
+    """Fill a knowledge base prompt template the way retrieve_and_generate does."""
+    search_results = format_search_results(results)
+    prompt = (template or template_registry.default_template()).replace('$search_results$', search_results)
+    prompt = prompt.replace('$output_format_instructions$', OUTPUT_FORMAT_INSTRUCTIONS)
+    if '$query$' in prompt:
+        return prompt.replace('$query$', query)
+    # Templates without a query placeholder get the question appended
+    return f"{prompt}\n\n{query}"
+
+
+def build_citations(text: str, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Split an answer into paragraphs shaped like retrieve_and_generate citations.
+
+    The client renders an answer from its citations, so every paragraph gets
+    one, carrying the search results its [n] markers point at.
+    """
+    citations = []
+    position = 0
+    for paragraph in re.split(r'\n\s*\n', text):
+        start = text.find(paragraph, position)
+        position = start + len(paragraph)
+        numbers = [int(number) for number in _CITATION_MARKER.findall(paragraph)]
+        clean = _CITATION_MARKER.sub('', paragraph).strip()
+        if not clean:
+            continue
+        references = []
+        for number in dict.fromkeys(numbers):
+            if 1 <= number <= len(results):
+                references.append(results[number - 1])
+        citations.append({
+            'generatedResponsePart': {
+                'textResponsePart': {
+                    'text': clean,
+                    'span': {'start': start, 'end': position - 1}
+                }
+            },
+            'retrievedReferences': references
+        })
+    return citations
+
+
+def generate(model_arn: str, prompt: str, inference_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Answer a filled prompt with the Converse API and return a retrieve_and_generate shaped result."""
+    response = aws_clients.bedrock_runtime().converse(
+        modelId=model_arn,
+        messages=[{
+            'role': 'user',
+            'content': [{'text': prompt}]
+        }],
+        inferenceConfig=inference_config
+    )
+    text = ''.join(
+        block.get('text', '')
+        for block in response['output']['message']['content']
+    )
+    return {
+        'output': {
+            'text': text
+        },
+        'usage': response.get('usage', {}),
+        'stopReason': response.get('stopReason')
+    }
+
+
+def retrieve_then_generate(knowledge_base_id: str, query: str, model_arn: str, template: str,
+                           retrieval_config: Dict[str, Any], inference_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Run retrieval (cached) and generation as separate calls."""
+    results = retrieval_cache.retrieve(knowledge_base_id, query, retrieval_config)
+    generated = generate(model_arn, build_prompt(template, query, results), inference_config)
+    generated['citations'] = build_citations(generated['output']['text'], results)
+    return generated
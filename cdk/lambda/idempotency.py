@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import uuid
+from time import time
+from typing import Dict, Any, Optional
+
+# Repeats of a submission inside this window resolve to the same request
+IDEMPOTENCY_WINDOW_SECONDS = int(os.environ.get('IDEMPOTENCY_WINDOW_SECONDS', '300'))
+IDEMPOTENCY_HEADER = 'idempotency-key'
+MAX_KEY_LENGTH = 255
+
+_NAMESPACE = uuid.UUID('6f1b7c2e-4d0a-5b8e-9c3f-2a7d1e5b9f40')
+
+
+def caller_id(event: Dict[str, Any]) -> Optional[str]:
+    """Return the Cognito subject of the caller, if the request was authorized."""
+    authorizer = (event.get('requestContext') or {}).get('authorizer') or {}
+    claims = authorizer.get('claims') or {}
+    return claims.get('sub')
+
+
+def client_key(event: Dict[str, Any], body: Dict[str, Any]) -> Optional[str]:
+    """Return the key sent in the Idempotency-Key header or the idempotencyKey field."""
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == IDEMPOTENCY_HEADER and value:
+            return str(value)[:MAX_KEY_LENGTH]
+    key = body.get('idempotencyKey')
+    return str(key)[:MAX_KEY_LENGTH] if key else None
+
+
+def payload_key(payload: Dict[str, Any]) -> str:
+    # Whitespace-only differences in the message count as the same submission
+    material = {**payload, 'message': ' '.join((payload.get('message') or '').split())}
+    encoded = json.dumps(material, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def request_id(event: Dict[str, Any], body: Dict[str, Any], payload: Dict[str, Any]) -> str:
+    """Derive a deterministic chatbot_request_id for a submission.
+
+    An explicit client key wins; otherwise the caller and payload identify the
+    submission, so a retried or double-clicked POST maps to the same id.
+    Conversation turns only dedupe on a client key: every turn carries the same
+    session, so a repeated follow-up such as "tell me more" is a new question.
+    """
+    key = client_key(event, body)
+    if not key and payload.get('conversationKey'):
+        return str(uuid.uuid4())
+    source = f"key:{key}" if key else f"payload:{payload_key(payload)}"
+    # Each window gets its own ids, so a later resubmission never lands on an
+    # earlier record; a repeat that straddles two windows runs twice
+    window = int(time()) // IDEMPOTENCY_WINDOW_SECONDS
+    return str(uuid.uuid5(_NAMESPACE, f"{caller_id(event) or 'anonymous'}|{window}|{source}"))
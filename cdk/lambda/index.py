@@ -1,53 +1,207 @@
+import base64
 import decimal
 import json
 from datetime import datetime, date
-from time import time, struct_time, mktime
+from time import time, struct_time, mktime, sleep
 import decimal 
 import os
-import boto3
 import logging
 import uuid
 from typing import Dict, Any
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 import traceback
+import answer_cache
+import aws_clients
+import fast_path
+import idempotency
+import job_envelope
+import kb_catalog
+import metrics
+import model_catalog
+import queue_handler
+import result_store
+import sessions
+import template_registry
+import usage
+from router import Router, json_response, error_response, cacheable_json_response
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
-sqs = boto3.client('sqs')
-dynamodb = boto3.resource('dynamodb')
-bedrock = boto3.client('bedrock-agent')
-bedrock_runtime = boto3.client('bedrock-agent-runtime')
-bedrock_client = boto3.client('bedrock')
-
+# AWS clients are built on first use by aws_clients, so routes that do not
+# need one pay nothing for them on a cold start
 QUEUE_URL = os.environ.get('SQS_QUEUE_URL')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
 
-  
+# Records expire through the tracking table's TTL instead of being deleted
+# once polled, so they stay available for the caller's history
+RECORD_TTL_SECONDS = int(os.environ.get('RECORD_TTL_SECONDS', str(30 * 24 * 60 * 60)))
+HISTORY_INDEX = os.environ.get('HISTORY_INDEX', 'user-history')
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+# Enough of the question to recognise it in a history list
+HISTORY_MESSAGE_MAX_CHARS = 500
+
+def new_record(chatbot_request_id: str, payload: Dict[str, Any], now: int,
+               user_sub: Optional[str] = None) -> Dict[str, Any]:
+    item = {
+        'chatbot_request_id': chatbot_request_id,
+        'status': 'processing',
+        'result': "",
+        'created_at': now,
+        'expires_at': now // 1000 + RECORD_TTL_SECONDS,
+        'message': (payload.get('message') or '')[:HISTORY_MESSAGE_MAX_CHARS],
+        'knowledge_base_id': payload.get('knowledgeBaseId')
+    }
+    if user_sub:
+        item['user_sub'] = user_sub
+    return item
+
+def record_answer(item: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+    # Answers that never went through the worker (cache hits, sync answers)
+    # are kept in the caller's history like any other
+    result = json.loads(json.dumps(result, cls=CustomJSONEncoder))
+    stored_result = result_store.encode(item['chatbot_request_id'], result)
+    aws_clients.tracking_table().put_item(Item={
+        **item,
+        'status': 'success',
+        **stored_result
+    })
+    return stored_result
+
+def release_record(chatbot_request_id: str, created_at: int) -> None:
+    # Only the record this submission wrote; a newer one belongs to someone else
+    try:
+        aws_clients.tracking_table().delete_item(
+            Key={
+                'chatbot_request_id': chatbot_request_id
+            },
+            ConditionExpression='created_at = :created_at',
+            ExpressionAttributeValues={
+                ':created_at': created_at
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f"Error releasing record {chatbot_request_id}: {e.response['Error']['Message']}")
+
+def fail_record(chatbot_request_id: str, message: str) -> None:
+    try:
+        aws_clients.tracking_table().update_item(
+            Key={
+                'chatbot_request_id': chatbot_request_id
+            },
+            UpdateExpression='SET #status = :status, #result = :result',
+            ExpressionAttributeNames={
+                '#status': 'status',
+                '#result': 'result'
+            },
+            ExpressionAttributeValues={
+                ':status': 'error',
+                ':result': message
+            }
+        )
+    except ClientError as e:
+        print(f"Error failing record {chatbot_request_id}: {e.response['Error']['Message']}")
+
+def create_record(item: Dict[str, Any]) -> bool:
+    """Write a submission's record; False when the same submission already has one."""
+    try:
+        # Only the first submission inside the window creates the job; ids
+        # change with the window, so an existing record is never replaced
+        aws_clients.tracking_table().put_item(
+            Item=item,
+            ConditionExpression='attribute_not_exists(chatbot_request_id)'
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print("Duplicate submission: " + item['chatbot_request_id'])
+        return False
 
-prompt_template = open('prompt_template.txt', 'r').read()
+def submit_to_queue(payload: Dict[str, Any], cache_key: Optional[str] = None,
+                    invalidated_at: int = 0, chatbot_request_id: Optional[str] = None,
+                    user_sub: Optional[str] = None, record: Optional[Dict[str, Any]] = None,
+                    claimed: bool = False) -> Dict[str, Any]:
+    """Queue a job for the worker.
 
-def submit_to_queue(payload: Dict[str, Any]) -> Dict[str, str]:
+    record is the submission's record when create_record already wrote it;
+    claimed says the request already owns its answer-cache entry.
+    """
     try:
-        chatbot_request_id = str(uuid.uuid4())
-        status = "processing"
+        idempotent = chatbot_request_id is not None
+        chatbot_request_id = chatbot_request_id or str(uuid.uuid4())
+        now = record['created_at'] if record else int(time() * 1000)
+
+        if cache_key:
+            # Lets the worker publish the answer to the cache and to any waiters
+            payload = {**payload, 'cacheKey': cache_key}
         
-        item = {
-            'chatbot_request_id': chatbot_request_id,
-            'status': status,
-            'payload': payload,
-            'result': ""
-        }
-        table.put_item(Item=item)
-        message = {
-            'chatbot_request_id': chatbot_request_id,
-        }
+        message_body, payload_inline = job_envelope.build_message(chatbot_request_id, payload)
+
+        # The worker reads the payload from the message, so the record only
+        # tracks status and result unless the payload was too big to send
+        if record:
+            item = record
+            if not payload_inline:
+                aws_clients.tracking_table().update_item(
+                    Key={
+                        'chatbot_request_id': chatbot_request_id
+                    },
+                    UpdateExpression='SET payload = :payload',
+                    ExpressionAttributeValues={
+                        ':payload': payload
+                    }
+                )
+        else:
+            item = new_record(chatbot_request_id, payload, now, user_sub)
+            if not payload_inline:
+                item['payload'] = payload
+            if idempotent:
+                if not create_record(item):
+                    return {
+                        'chatbot_request_id': chatbot_request_id,
+                        'duplicate': True
+                    }
+            else:
+                aws_clients.tracking_table().put_item(Item=item)
+
+        if cache_key and not claimed:
+            outcome, cached_result = answer_cache.claim(
+                cache_key, payload['knowledgeBaseId'], chatbot_request_id, invalidated_at
+            )
+            if outcome == answer_cache.HIT:
+                record_answer(item, cached_result)
+                return {
+                    'chatbot_request_id': chatbot_request_id,
+                    'status': 'success',
+                    'result': cached_result,
+                    'cached': True
+                }
+            if outcome == answer_cache.WAITER:
+                # An identical question is already being answered; the worker
+                # fills in this record when that job finishes
+                print("Joined in-flight request: " + chatbot_request_id)
+                return {
+                    'chatbot_request_id': chatbot_request_id
+                }
         
-        response = sqs.send_message(
-            QueueUrl=QUEUE_URL,
-            MessageBody=json.dumps(message)
-        )
+        try:
+            response = aws_clients.sqs().send_message(
+                QueueUrl=QUEUE_URL,
+                MessageBody=message_body
+            )
+        except ClientError as e:
+            if cache_key:
+                # Let the next identical question claim the answer instead;
+                # requests that joined this one in the meantime fail with it
+                for waiter_id in answer_cache.abandon(cache_key, chatbot_request_id):
+                    fail_record(waiter_id, str(e))
+            # The job was never queued: free the idempotency slot so a retry queues it
+            release_record(chatbot_request_id, now)
+            raise
         print("Message created: "+ response["MessageId"])
         
         return {
@@ -63,288 +217,474 @@ def submit_to_queue(payload: Dict[str, Any]) -> Dict[str, str]:
             'error': str(e)
         }    
         
-def print_table_info():
-    response = table.meta.client.describe_table(TableName=os.environ['DYNAMODB_TABLE'])
-    print("Table Key Schema:")
-    for key in response['Table']['KeySchema']:
-        print(f"- {key['AttributeName']} ({key['KeyType']})")
-    
-def get_record(chatbot_request_id: str) -> Optional[Dict[str, any]]:
-    try:
-        print_table_info()
-        response = table.get_item(
-            Key={
-                'chatbot_request_id': str(chatbot_request_id)
-            },
-            ConsistentRead=True  # Optional: ensures you get the latest version
-        )    
-        
-        if 'Item' in response:
-            # Use get() method to safely access dictionary keys
-            item = response['Item']
-            record = {
-                'chatbot_request_id': item.get('chatbot_request_id'),
-                'status': item.get('status'),
-                'payload': item.get('payload'),
-                'result': item.get('result')
-            }
-            
-            # If status is success, delete the record after retrieving it
-            if record['status'] != 'processing':
-                try:
-                    delete_record(chatbot_request_id)
-                except Exception as e:
-                    logger.warning(f"Failed to delete completed record {chatbot_request_id}: {str(e)}")
-            
-            return record
-        else:
-            return None
-            
-    except ClientError as e:
-        traceback_str = traceback.format_exc()
-        print(traceback_str)
-        error_code = e.response['Error']['Code']
-        error_message = e.response['Error']['Message']
-        print(f"Error getting record: {error_code}: {error_message}")
-        raise
-    except Exception as e:
-        print(f"Unexpected error: {str(e)}")
-        raise
-    
-def delete_record(chatbot_request_id: str) -> Dict[str, any]:
-    try:
-        # Delete the item and get the old values
-        response = table.delete_item(
-            Key={
-                'chatbot_request_id': chatbot_request_id
+def to_client_record(item: Dict[str, Any]) -> Dict[str, Any]:
+    # Only the fields the chat client renders go back over the wire
+    record = {
+        'chatbot_request_id': item.get('chatbot_request_id'),
+        'status': item.get('status'),
+        'result': result_store.decode(item)
+    }
+
+    # While the worker is streaming, hand back what has been generated so far
+    if record['status'] == 'streaming':
+        record['result'] = {
+            'output': {
+                'text': ''.join(item.get('stream_text', []))
             },
-            ReturnValues='ALL_OLD'  # This will return the item that was deleted
+            'citations': item.get('stream_citations', [])
+        }
+
+    # Which equivalent model or inference profile the worker routed the job to
+    if item.get('served_model_arn'):
+        record['served_model_arn'] = item['served_model_arn']
+    return record
+
+def get_record(chatbot_request_id: str, user_sub: Optional[str]) -> Optional[Dict[str, any]]:
+    # Polling reads only what the client renders; the record stays for the
+    # caller's history until the table's TTL removes it
+    response = aws_clients.tracking_table().get_item(
+        Key={
+            'chatbot_request_id': str(chatbot_request_id)
+        },
+        ProjectionExpression=', '.join(RECORD_PROJECTION),
+        ExpressionAttributeNames=RECORD_PROJECTION,
+        ConsistentRead=True
+    )
+    item = response.get('Item')
+    # Someone else's request looks the same as one that does not exist
+    if not item or item.get('user_sub') != user_sub:
+        return None
+    return to_client_record(item)
+
+# Request limits of the batched DynamoDB and SQS APIs
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '100'))
+SQS_BATCH_MAX_ENTRIES = 10
+DYNAMODB_BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_ATTEMPTS = 5
+
+RECORD_PROJECTION = {
+    '#id': 'chatbot_request_id',
+    '#status': 'status',
+    '#result': 'result',
+    '#result_z': result_store.INLINE_ATTRIBUTE,
+    '#result_ref': result_store.REFERENCE_ATTRIBUTE,
+    '#stream_text': 'stream_text',
+    '#stream_citations': 'stream_citations',
+    '#served_model_arn': 'served_model_arn',
+    '#user_sub': 'user_sub'
+}
+
+def _message_batches(messages: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    # send_message_batch takes at most 10 entries and 256 KiB in total
+    batches = []
+    current = []
+    current_bytes = 0
+    for message in messages:
+        size = len(message['MessageBody'].encode('utf-8'))
+        if current and (len(current) == SQS_BATCH_MAX_ENTRIES or current_bytes + size > job_envelope.MAX_MESSAGE_BYTES):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(message)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+def submit_batch_to_queue(payloads: List[Dict[str, Any]], user_sub: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Create and enqueue many jobs with batched writes and sends.
+
+    Bulk jobs skip the answer cache and idempotency checks, both of which need
+    a conditional write per request.
+    """
+    now = int(time() * 1000)
+    messages = []
+    with aws_clients.tracking_table().batch_writer() as batch:
+        for position, payload in enumerate(payloads):
+            chatbot_request_id = str(uuid.uuid4())
+            message_body, payload_inline = job_envelope.build_message(chatbot_request_id, payload)
+            item = new_record(chatbot_request_id, payload, now, user_sub)
+            if not payload_inline:
+                item['payload'] = payload
+            batch.put_item(Item=item)
+            messages.append({'Id': str(position), 'MessageBody': message_body, 'chatbot_request_id': chatbot_request_id})
+
+    results = [{'chatbot_request_id': message['chatbot_request_id']} for message in messages]
+    failed_ids = []
+    for entries in _message_batches(messages):
+        response = aws_clients.sqs().send_message_batch(
+            QueueUrl=QUEUE_URL,
+            Entries=[{'Id': entry['Id'], 'MessageBody': entry['MessageBody']} for entry in entries]
         )
-        
-        # Check if an item was actually deleted
-        if 'Attributes' in response:
-            deleted_item = {
-                'chatbot_request_id': response['Attributes']['chatbot_request_id'],
-                'status': response['Attributes']['status'],
-                'payload': response['Attributes']['payload'],
-                'result': response['Attributes']['result']
-            }
-            
-            return {
-                'success': True,
-                'message': 'Record deleted successfully',
-                'deleted_item': deleted_item
-            }
-        else:
-            return {
-                'success': False,
-                'message': 'Record not found',
-                'deleted_item': None
+        for failure in response.get('Failed', []):
+            position = int(failure['Id'])
+            chatbot_request_id = messages[position]['chatbot_request_id']
+            error = failure.get('Message', failure.get('Code'))
+            failed_ids.append((chatbot_request_id, error))
+            results[position] = {'chatbot_request_id': chatbot_request_id, 'error': error}
+
+    if failed_ids:
+        # Nothing will ever work on these, so do not leave them processing
+        print(f"Failed to queue {len(failed_ids)} of {len(messages)} requests")
+        for chatbot_request_id, error in failed_ids:
+            fail_record(chatbot_request_id, f"Could not be queued: {error}")
+    return results
+
+def get_records(chatbot_request_ids: List[str], user_sub: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetch many of a caller's records in batch_get_item round trips."""
+    table = aws_clients.tracking_table()
+    items = {}
+    for start in range(0, len(chatbot_request_ids), DYNAMODB_BATCH_GET_MAX_KEYS):
+        request_items = {
+            table.name: {
+                'Keys': [{'chatbot_request_id': chatbot_request_id}
+                         for chatbot_request_id in chatbot_request_ids[start:start + DYNAMODB_BATCH_GET_MAX_KEYS]],
+                'ProjectionExpression': ', '.join(RECORD_PROJECTION),
+                'ExpressionAttributeNames': RECORD_PROJECTION
             }
-            
-    except ClientError as e:
-        traceback_str = traceback.format_exc()
-        print(traceback_str)
-        error_code = e.response['Error']['Code']
-        error_message = e.response['Error']['Message']
-        print(f"Error deleting record: {error_code}: {error_message}")
-        return {
-            'success': False,
-            'message': f"Failed to delete record: {error_message}",
-            'error': error_code
-        }
-    except Exception as e:
-        traceback_str = traceback.format_exc()
-        print(traceback_str)
-        print(f"Unexpected error: {str(e)}")
-        return {
-            'success': False,
-            'message': f"Unexpected error: {str(e)}",
-            'error': 'UnexpectedError'
         }
-    
-def extract_guid(url):
-    try:
-        if '?' not in url:
-            return None
-        
-        # Remove any trailing slashes or whitespace
-        guid = url.split('?')[1].strip('/')
-        
-        # Optional: Validate the GUID format if needed
-        if not guid:
-            return None
-            
-        return guid
-    except Exception as e:
-        traceback_str = traceback.format_exc()
-        print(traceback_str)
-        print(f"Error extracting GUID: {str(e)}")
-        return None
+        for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+            response = table.meta.client.batch_get_item(RequestItems=request_items)
+            for item in response.get('Responses', {}).get(table.name, []):
+                items[item['chatbot_request_id']] = item
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+            # Throttled keys come back unprocessed; back off before retrying them
+            sleep(0.05 * (2 ** attempt))
+    return {chatbot_request_id: to_client_record(item) for chatbot_request_id, item in items.items()
+            if item.get('user_sub') == user_sub}
 
-def handler(event, context):
-    # Get the HTTP method from the event
-    http_method = event['httpMethod']
-    path = event.get('path')
-    
-    # Set CORS headers
-    headers = {
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Headers': '*',
-        'Access-Control-Allow-Methods': 'GET,PUT'
+# Browsers and the UI may reuse catalog responses this long before revalidating
+CATALOG_MAX_AGE_SECONDS = int(os.environ.get('CATALOG_MAX_AGE_SECONDS', '300'))
+
+router = Router()
+
+@router.route('GET', '/knowledge-bases')
+def list_knowledge_bases(event, context):
+    query_params = event.get('queryStringParameters') or {}
+    if query_params.get('refresh') == 'true':
+        kb_catalog.invalidate('refresh requested')
+    filtered_knowledge_bases = kb_catalog.get_visible_knowledge_bases(
+        aws_clients.bedrock_agent(),
+        aws_clients.bedrock()
+    )
+
+    return cacheable_json_response(event, {
+        'knowledgeBases': filtered_knowledge_bases
+    }, CATALOG_MAX_AGE_SECONDS)
+
+@router.route('GET', '/models')
+def list_models(event, context):
+    query_params = event.get('queryStringParameters') or {}
+    if query_params.get('refresh') == 'true':
+        model_catalog.invalidate('refresh requested')
+    models = model_catalog.get_models(aws_clients.bedrock())
+    return cacheable_json_response(event, models, CATALOG_MAX_AGE_SECONDS)
+
+@router.route('GET', '/chatbot')
+def get_chatbot_request(event, context):
+    query_params = event.get('queryStringParameters') or {}
+    print("getting information for request: " + str(query_params))
+
+    chatbot_request_id = query_params.get('url')
+    if not chatbot_request_id:
+        return error_response(400, 'url query parameter with the chatbot_request_id is required')
+
+    print("Found chatbot_request_id in request: " + chatbot_request_id)
+    record = get_record(chatbot_request_id, idempotency.caller_id(event))
+    if not record:
+        print("No record found DynamoDB record: " + chatbot_request_id)
+        return error_response(404, f"No request found for {chatbot_request_id}")
+
+    return json_response(200, record, CustomJSONEncoder)
+
+def build_payload(body: Dict[str, Any]) -> Dict[str, Any]:
+    # Jobs name their template instead of carrying it; no template means the default
+    return {
+        'message': body.get('message', ''),
+        'knowledgeBaseId': body.get('knowledgeBaseId'),
+        **template_registry.template_reference(body.get('textPromptTemplate')),
+        'textInferenceConfig': body.get('textInferenceConfig'),
+        'modelArn': body.get('modelArn')
     }
+
+def lookup_answer(payload: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, Any]], int]:
+    cache_key = answer_cache.cache_key(payload)
+    cached_result, invalidated_at = answer_cache.lookup(cache_key, payload['knowledgeBaseId'])
+    return cache_key, cached_result, invalidated_at
+
+def cached_answer_response(chatbot_request_id: str, payload: Dict[str, Any], user_sub: Optional[str],
+                           cache_key: str, cached_result: Dict[str, Any],
+                           notice: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # Answered before: hand back the finished result, no queue round trip
+    print("Answer cache hit: " + cache_key)
+    if user_sub:
+        record = new_record(chatbot_request_id, payload, int(time() * 1000), user_sub)
+        record_answer(record, cached_result)
+    return json_response(200, {
+        'chatbot_request_id': chatbot_request_id,
+        'status': 'success',
+        'result': cached_result,
+        'cached': True,
+        **(notice or {})
+    }, CustomJSONEncoder)
+
+def quota_exceeded_response(error: Exception) -> Dict[str, Any]:
+    metrics.emit({'QuotaRejections': (1, 'Count')}, {'Function': 'Api'})
+    return error_response(429, str(error), {'Retry-After': str(usage.seconds_until_reset())})
+
+@router.route('POST', '/chatbot')
+def submit_chatbot_request(event, context):
+    body = json.loads(event['body'])
+    knowledgeBaseId = body.get('knowledgeBaseId')
+    conversationId = body.get('conversationId')
     
+    metrics.sampled_debug('POST /chatbot body', body)
+
+    # Validate knowledge base ID is provided
+    if not knowledgeBaseId:
+        return error_response(400, 'knowledgeBaseId is required in the request body')
+
     try:
-        if http_method == 'GET' and path == '/knowledge-bases':
-            filtered_knowledge_bases = []
-            knowledge_bases = bedrock.list_knowledge_bases()
-            logger.info(knowledge_bases)
-            for kb in knowledge_bases.get('knowledgeBaseSummaries', []):
-                get_knowledge_base_response = bedrock.get_knowledge_base(
-                    knowledgeBaseId=kb['knowledgeBaseId']
-                )
-                tags_response = bedrock_client.list_tags_for_resource(
-                    resourceArn=get_knowledge_base_response['knowledgeBase']['knowledgeBaseArn']
-                )
-                tags = tags_response.get('tags', {})
-                if tags.get('public') == 'visible':
-                    filtered_knowledge_bases.append({
-                        'id': kb['knowledgeBaseId'],
-                        'name': kb['name']
-                    })
-
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps({
-                    'knowledgeBases': filtered_knowledge_bases
-                })
-            }
-        if http_method == 'GET' and path == '/models':
-            available_models = [
-                {
-                    'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-opus-20240229-v1:0',
-                    'modelName': 'Claude 3 Opus'
-                }
-                ,
-                {
-                    'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-5-haiku-20241022-v1:0',
-                    'modelName': 'Claude 3.5 Haiku'
-                },
-                {
-                    'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-5-sonnet-20241022-v2:0',
-                    'modelName': 'Claude 3.5 Sonnet v2'
-                },
-                {
-                    'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-7-sonnet-20250219-v1:0',
-                    'modelName': 'Claude 3.7 Sonnet v1'
-                }
+        payload = build_payload(body)
+    except template_registry.InvalidTemplate as e:
+        return error_response(400, str(e))
 
+    user_sub = idempotency.caller_id(event)
+    session_id = None
+    if conversationId and sessions.ENABLED:
+        conversation_key = sessions.conversation_key(user_sub, conversationId)
+        session_id = sessions.get(conversation_key)
+        # The worker continues the Bedrock session and records the one it ends up using
+        payload['conversationKey'] = conversation_key
+        if session_id:
+            payload['sessionId'] = session_id
 
-            ]
-            
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps(available_models)
-            }
-            
-        elif http_method == "GET" and path == "/chatbot":
-            query_params = event.get('queryStringParameters', {})
-            print("getting information for request: " + str(query_params))
-
-            if query_params and 'url' in query_params:
-                print("Found URL in request")
-
-                chatbot_request_id = query_params['url']
-                print("Found chatbot_request_id in request: " + chatbot_request_id)
-                record = get_record(chatbot_request_id)
-                if record:
-                    return {
-                        'statusCode': 200,
-                        'headers': headers,
-                        'body': json.dumps(record, cls=CustomJSONEncoder)
-                    }
-                else:
-                    print("No record found DynamoDB record: " + chatbot_request_id)
-
-                 
-
-            
-        elif http_method == 'POST' and path == "/chatbot":
-            body = json.loads(event['body'])
-            message = body.get('message', '')
-            knowledgeBaseId = body.get('knowledgeBaseId')
-            textPromptTemplate = body.get('textPromptTemplate')
-            textInferenceConfig = body.get('textInferenceConfig')
-            modelArn = body.get('modelArn') 
-            
-            print("Body: "+ json.dumps(body))
-            # model_arn = 'us.anthropic.claude-3-opus-20240229-v1:0'
-            
-            # Add detailed logging for debugging template flow
-            logger.info("=== Template Debug Information ===")
-            logger.info(f"Custom template provided: {textPromptTemplate is not None}")
-            if textPromptTemplate is not None:
-                logger.info(f"Custom template length: {len(textPromptTemplate)}")
-                logger.info(f"Custom template preview (first 100 chars): {textPromptTemplate[:100]}")
-            
-            print("ModelARN: "+ modelArn)
-            print("knowledge_base_id: "+ knowledgeBaseId)
-            print("Message: "+ message)
-
-            # Validate knowledge base ID is provided
-            if not knowledgeBaseId:
-                return {
-                    'statusCode': 400,
-                    'headers': headers,
-                    'body': json.dumps({
-                        'error': 'knowledgeBaseId is required in the request body'
-                    })
-                }
+    chatbot_request_id = idempotency.request_id(event, body, payload)
+    if user_sub:
+        # The worker charges the answer's token usage to the caller
+        payload['userSub'] = user_sub
 
-            # Use custom template if provided, otherwise use default
-            template = textPromptTemplate if textPromptTemplate else open('prompt_template.txt', 'r').read()
-            
-            # Log which template is being used and its content
-            logger.info("=== Final Template Information ===")
-            logger.info(f"Using custom template: {textPromptTemplate is not None}")
-            logger.info(f"Template length: {len(template)}")
-            logger.info(f"Template preview (first 100 chars): {template[:100]}")
-            logger.info("=== End Template Information ===")
-            
-            createdRecord = submit_to_queue({
-                'message': message,
-                'knowledgeBaseId': knowledgeBaseId,
-                'textPromptTemplate': template,
-                'textInferenceConfig': textInferenceConfig,
-                'modelArn': modelArn
-                })
-
-            return {
-                'statusCode': 200,
-                'headers': headers,
-                'body': json.dumps(createdRecord)
-            }
-        else:
-            return {
-                'statusCode': 405,
-                'headers': headers,
-                'body': json.dumps({
-                    'error': 'Method not allowed'
-                })
+    cache_key = None
+    invalidated_at = 0
+    # A follow-up turn depends on the conversation so far, not just its text
+    use_cache = answer_cache.ENABLED and not session_id
+    if use_cache:
+        cache_key, cached_result, invalidated_at = lookup_answer(payload)
+        if cached_result is not None:
+            return cached_answer_response(chatbot_request_id, payload, user_sub, cache_key, cached_result)
+
+    # Cached answers cost nothing, so quotas only stand in the way of new ones
+    try:
+        payload['modelArn'], downgraded = usage.check(user_sub, payload['modelArn'])
+    except usage.QuotaExceeded as e:
+        return quota_exceeded_response(e)
+    # Tells the client its request runs on a cheaper model than it asked for
+    quota_notice = {'downgradedModelArn': payload['modelArn']} if downgraded else {}
+    if downgraded and use_cache:
+        # The cheaper model may have answered the question before
+        cache_key, cached_result, invalidated_at = lookup_answer(payload)
+        if cached_result is not None:
+            return cached_answer_response(chatbot_request_id, payload, user_sub, cache_key, cached_result, quota_notice)
+
+    record = None
+    claimed = False
+    if body.get('sync'):
+        # The record is written first, so a double-click or retry finds it
+        # instead of paying for a second inline answer
+        record = new_record(chatbot_request_id, payload, int(time() * 1000), user_sub)
+        if not create_record(record):
+            return json_response(200, {
+                **(get_record(chatbot_request_id, user_sub) or {'chatbot_request_id': chatbot_request_id}),
+                'duplicate': True
+            }, CustomJSONEncoder)
+        if cache_key:
+            # Identical questions wait on this answer instead of generating their own
+            outcome, cached_result = answer_cache.claim(
+                cache_key, payload['knowledgeBaseId'], chatbot_request_id, invalidated_at
+            )
+            if outcome == answer_cache.HIT:
+                record_answer(record, cached_result)
+                return json_response(200, {
+                    'chatbot_request_id': chatbot_request_id,
+                    'status': 'success',
+                    'result': cached_result,
+                    'cached': True,
+                    **quota_notice
+                }, CustomJSONEncoder)
+            if outcome == answer_cache.WAITER:
+                print("Joined in-flight request: " + chatbot_request_id)
+                return json_response(200, {'chatbot_request_id': chatbot_request_id, **quota_notice}, CustomJSONEncoder)
+            claimed = True
+        # Opted in to an inline answer; falls through to the queue when the
+        # model, the deadline or the rate budget says no
+        try:
+            result = fast_path.answer(payload)
+        except Exception as e:
+            if claimed:
+                for waiter_id in answer_cache.abandon(cache_key, chatbot_request_id):
+                    fail_record(waiter_id, str(e))
+            # Nothing was answered: free the idempotency slot so a retry starts over
+            release_record(chatbot_request_id, record['created_at'])
+            raise
+        if result is not None:
+            stored_result = None
+            try:
+                stored_result = record_answer(record, result)
+            except Exception:
+                # The caller still gets its answer; only the history entry is lost
+                print(traceback.format_exc())
+                release_record(chatbot_request_id, record['created_at'])
+            if claimed:
+                # Answers the waiters and caches the answer, as the worker would
+                queue_handler.publish_to_answer_cache(cache_key, chatbot_request_id, result, 'success', stored_result)
+            return json_response(200, {
+                'chatbot_request_id': chatbot_request_id,
+                'status': 'success',
+                'result': result,
+                'sync': True,
+                **quota_notice
+            }, CustomJSONEncoder)
+
+    createdRecord = submit_to_queue(payload, cache_key, invalidated_at, chatbot_request_id, user_sub, record, claimed)
+
+    return json_response(200, {**createdRecord, **quota_notice}, CustomJSONEncoder)
+
+@router.route('POST', '/chatbot/batch')
+def submit_chatbot_batch(event, context):
+    body = json.loads(event['body'] or '{}')
+    requests = body.get('requests')
+    if not isinstance(requests, list) or not requests:
+        return error_response(400, 'requests must be a non-empty list')
+    if len(requests) > MAX_BATCH_SIZE:
+        return error_response(400, f"At most {MAX_BATCH_SIZE} requests per batch")
+    if not all(isinstance(request, dict) and request.get('knowledgeBaseId') for request in requests):
+        return error_response(400, 'knowledgeBaseId is required in every request')
+
+    try:
+        payloads = [build_payload(request) for request in requests]
+    except template_registry.InvalidTemplate as e:
+        return error_response(400, str(e))
+
+    user_sub = idempotency.caller_id(event)
+    try:
+        for payload in payloads:
+            payload['modelArn'], _ = usage.check(user_sub, payload['modelArn'])
+            if user_sub:
+                payload['userSub'] = user_sub
+    except usage.QuotaExceeded as e:
+        return quota_exceeded_response(e)
+
+    results = submit_batch_to_queue(payloads, user_sub)
+    print(f"Queued batch of {len(results)} requests")
+    return json_response(200, {'requests': results}, CustomJSONEncoder)
+
+@router.route('GET', '/chatbot/batch')
+def get_chatbot_batch(event, context):
+    query_params = event.get('queryStringParameters') or {}
+    chatbot_request_ids = list(dict.fromkeys(
+        chatbot_request_id.strip()
+        for chatbot_request_id in (query_params.get('ids') or '').split(',')
+        if chatbot_request_id.strip()
+    ))
+    if not chatbot_request_ids:
+        return error_response(400, 'ids query parameter with comma separated chatbot_request_ids is required')
+    if len(chatbot_request_ids) > MAX_BATCH_SIZE:
+        return error_response(400, f"At most {MAX_BATCH_SIZE} ids per request")
+
+    records = get_records(chatbot_request_ids, idempotency.caller_id(event))
+    return json_response(200, {
+        'requests': [records[chatbot_request_id] for chatbot_request_id in chatbot_request_ids
+                     if chatbot_request_id in records],
+        'missing': [chatbot_request_id for chatbot_request_id in chatbot_request_ids
+                    if chatbot_request_id not in records]
+    }, CustomJSONEncoder)
+
+@router.route('GET', '/chatbot/history')
+def get_chatbot_history(event, context):
+    user_sub = idempotency.caller_id(event)
+    if not user_sub:
+        return error_response(401, 'History is only kept for signed-in users')
+
+    query_params = event.get('queryStringParameters') or {}
+    try:
+        limit = min(HISTORY_MAX_PAGE_SIZE, max(1, int(query_params.get('limit') or HISTORY_PAGE_SIZE)))
+    except ValueError:
+        return error_response(400, 'limit must be a number')
+
+    query = {
+        'IndexName': HISTORY_INDEX,
+        'KeyConditionExpression': Key('user_sub').eq(user_sub),
+        'ScanIndexForward': False,
+        'Limit': limit
+    }
+    if query_params.get('next'):
+        try:
+            start_key = json.loads(
+                base64.urlsafe_b64decode(query_params['next']),
+                parse_int=decimal.Decimal,
+                parse_float=decimal.Decimal
+            )
+        except ValueError:
+            return error_response(400, 'next is not a valid page token')
+        # A token names a position in the caller's own history only
+        if not isinstance(start_key, dict) or start_key.get('user_sub') != user_sub:
+            return error_response(400, 'next is not a valid page token')
+        query['ExclusiveStartKey'] = start_key
+
+    response = aws_clients.tracking_table().query(**query)
+    last_key = response.get('LastEvaluatedKey')
+    return json_response(200, {
+        'requests': [
+            {
+                'chatbot_request_id': item['chatbot_request_id'],
+                'created_at': item['created_at'],
+                'status': item.get('status'),
+                'message': item.get('message'),
+                'knowledgeBaseId': item.get('knowledge_base_id')
             }
-            
-    except Exception as e:
-        traceback_str = traceback.format_exc()
-        print(traceback_str)
-        return {
-            'statusCode': 500,
-            'headers': headers,
-            'body': json.dumps({
-                'error': str(e)
-            })
-        }
+            for item in response.get('Items', [])
+        ],
+        'next': base64.urlsafe_b64encode(
+            json.dumps(last_key, cls=CustomJSONEncoder).encode('utf-8')
+        ).decode('ascii') if last_key else None
+    }, CustomJSONEncoder)
+
+@router.route('GET', '/usage')
+def get_usage(event, context):
+    user_sub = idempotency.caller_id(event)
+    if not user_sub:
+        return error_response(401, 'Usage is only tracked for signed-in users')
+    if not usage.ENABLED:
+        return error_response(404, 'Usage tracking is not enabled')
+
+    query_params = event.get('queryStringParameters') or {}
+    try:
+        days = min(usage.MAX_USAGE_DAYS, max(1, int(query_params.get('days') or 7)))
+    except ValueError:
+        return error_response(400, 'days must be a number')
+
+    return json_response(200, {
+        'days': usage.daily_usage(user_sub, days),
+        'quotas': usage.USAGE_QUOTAS,
+        'resetsInSeconds': usage.seconds_until_reset()
+    }, CustomJSONEncoder)
+
+@router.route('DELETE', '/answer-cache')
+def invalidate_answer_cache(event, context):
+    query_params = event.get('queryStringParameters') or {}
+    knowledgeBaseId = query_params.get('knowledgeBaseId')
+    if not knowledgeBaseId:
+        return error_response(400, 'knowledgeBaseId is required')
+    if answer_cache.ENABLED:
+        answer_cache.invalidate_knowledge_base(knowledgeBaseId)
+    return json_response(200, {
+        'invalidated': knowledgeBaseId
+    })
+
+def handler(event, context):
+    return router.dispatch(event, context)
         
     
 class CustomJSONEncoder(json.JSONEncoder):
@@ -0,0 +1,38 @@
+import json
+import os
+from typing import Dict, Any, Optional, Tuple
+
+# Bump when the message layout changes; the worker keeps reading older versions.
+ENVELOPE_VERSION = 1
+
+# SQS rejects message bodies above 256 KiB
+MAX_MESSAGE_BYTES = int(os.environ.get('SQS_MAX_MESSAGE_BYTES', str(256 * 1024)))
+
+
+def build_message(chatbot_request_id: str, payload: Dict[str, Any]) -> Tuple[str, bool]:
+    """Return the SQS body for a job and whether the payload fits inline."""
+    envelope = {
+        'version': ENVELOPE_VERSION,
+        'chatbot_request_id': chatbot_request_id,
+        'payload': payload
+    }
+    body = json.dumps(envelope, separators=(',', ':'))
+    if len(body.encode('utf-8')) <= MAX_MESSAGE_BYTES:
+        return body, True
+
+    # Too big for SQS: the payload stays on the DynamoDB record instead
+    reference = {
+        'version': ENVELOPE_VERSION,
+        'chatbot_request_id': chatbot_request_id,
+        'payload_ref': 'dynamodb'
+    }
+    return json.dumps(reference, separators=(',', ':')), False
+
+
+def parse_message(body: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Return the request id and the inline payload, or None when it has to be fetched."""
+    message = json.loads(body)
+    # Messages sent before the envelope existed only carry the request id
+    if 'version' not in message:
+        return message['chatbot_request_id'], None
+    return message['chatbot_request_id'], message.get('payload')
@@ -0,0 +1,160 @@
+import os
+import threading
+from random import uniform
+from time import monotonic
+from typing import Dict
+
+from botocore.exceptions import (
+    ClientError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError
+)
+
+# Attempts a job gets, counting the first one, before it is marked as an error
+MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '5'))
+# Times a job may be put back for a rate budget or an open circuit. A
+# message delivered more often than both together is failed by the worker,
+# before the queue's redrive policy moves it to the dead-letter queue.
+MAX_DEFERRALS = int(os.environ.get('MAX_DEFERRALS', '10'))
+MAX_DELIVERIES = MAX_ATTEMPTS + MAX_DEFERRALS
+RETRY_BASE_SECONDS = float(os.environ.get('RETRY_BASE_SECONDS', '2'))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get('RETRY_MAX_DELAY_SECONDS', '300'))
+
+# Transient failures within the window that open a model's circuit, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_WINDOW_SECONDS = float(os.environ.get('BREAKER_WINDOW_SECONDS', '30'))
+BREAKER_COOLDOWN_SECONDS = float(os.environ.get('BREAKER_COOLDOWN_SECONDS', '30'))
+
+# Error codes are compared case-insensitively: event streams report
+# 'throttlingException' where the plain API says 'ThrottlingException'
+THROTTLING_ERROR_CODES = {
+    'throttlingexception',
+    'toomanyrequestsexception',
+    'servicequotaexceededexception',
+    'provisionedthroughputexceededexception',
+    'requestlimitexceeded'
+}
+TRANSIENT_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'serviceunavailableexception',
+    'internalserverexception',
+    'internalservererror',
+    'modelnotreadyexception',
+    'modeltimeoutexception',
+    'dependencyfailedexception',
+    'badgatewayexception',
+    'requesttimeout',
+    'requesttimeoutexception'
+}
+_TRANSIENT_EXCEPTIONS = (ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)
+
+
+def error_code(error: Exception) -> str:
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code', '')
+    return type(error).__name__
+
+
+def is_throttling(error: Exception) -> bool:
+    return error_code(error).lower() in THROTTLING_ERROR_CODES
+
+
+def is_transient(error: Exception) -> bool:
+    """True for errors that a later attempt can be expected to get past."""
+    if isinstance(error, _TRANSIENT_EXCEPTIONS):
+        return True
+    if isinstance(error, ClientError):
+        if error_code(error).lower() in TRANSIENT_ERROR_CODES:
+            return True
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return status is not None and (status == 429 or status >= 500)
+    return False
+
+
+def backoff_seconds(attempt: int) -> float:
+    """Exponential backoff with full jitter for the given (1-based) attempt."""
+    ceiling = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_SECONDS * (2 ** max(0, attempt - 1)))
+    return max(1.0, uniform(0, ceiling))
+
+
+class CircuitBreaker:
+    """Stops calls to a model that keeps failing, for a cool-down period.
+
+    Closed: calls go through while failures are counted. Open: calls are
+    refused until the cool-down passes. Half open: one trial call is let
+    through, and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 window_seconds: float = BREAKER_WINDOW_SECONDS,
+                 cooldown_seconds: float = BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self._failures = []
+        self._opened_at = None
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+
+    def wait_seconds(self) -> float:
+        """Return 0 if a call may go ahead now, otherwise how long to hold off."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            now = monotonic()
+            remaining = self._opened_at + self.cooldown_seconds - now
+            if remaining > 0:
+                return remaining
+            # A trial that never reported back stops blocking after a cool-down
+            if self._trial_started_at is not None and now - self._trial_started_at < self.cooldown_seconds:
+                return self._trial_started_at + self.cooldown_seconds - now
+            self._trial_started_at = now
+            return 0.0
+
+    def remaining_seconds(self) -> float:
+        """Like wait_seconds, but never starts a half-open trial; for comparing options."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            now = monotonic()
+            remaining = self._opened_at + self.cooldown_seconds - now
+            if self._trial_started_at is not None:
+                remaining = max(remaining, self._trial_started_at + self.cooldown_seconds - now)
+            return max(0.0, remaining)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = []
+            self._opened_at = None
+            self._trial_started_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = monotonic()
+            if self._trial_started_at is not None:
+                # The trial call failed too: stay open for another cool-down
+                self._opened_at = now
+                self._trial_started_at = None
+                return
+            self._failures = [failed_at for failed_at in self._failures if now - failed_at < self.window_seconds]
+            self._failures.append(now)
+            if len(self._failures) >= self.failure_threshold:
+                self._opened_at = now
+                self._failures = []
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(model_arn: str) -> CircuitBreaker:
+    breaker = _breakers.get(model_arn)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(model_arn, CircuitBreaker())
+    return breaker
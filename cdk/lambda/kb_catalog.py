@@ -0,0 +1,80 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Dict, Any, List, Optional
+
+# How long the filtered knowledge base list is served from memory before
+# Bedrock is asked again. Warm invocations inside this window make no calls.
+CATALOG_TTL_SECONDS = float(os.environ.get('KB_CATALOG_TTL_SECONDS', '300'))
+CATALOG_MAX_WORKERS = int(os.environ.get('KB_CATALOG_MAX_WORKERS', '8'))
+
+_lock = threading.Lock()
+_cache: Dict[str, Any] = {
+    'knowledge_bases': None,
+    'expires_at': 0.0
+}
+
+
+def _list_knowledge_base_summaries(bedrock) -> List[Dict[str, Any]]:
+    summaries = []
+    paginator = bedrock.get_paginator('list_knowledge_bases')
+    for page in paginator.paginate():
+        summaries.extend(page.get('knowledgeBaseSummaries', []))
+    return summaries
+
+
+def _is_visible(bedrock, bedrock_client, kb: Dict[str, Any]) -> bool:
+    get_knowledge_base_response = bedrock.get_knowledge_base(
+        knowledgeBaseId=kb['knowledgeBaseId']
+    )
+    tags_response = bedrock_client.list_tags_for_resource(
+        resourceArn=get_knowledge_base_response['knowledgeBase']['knowledgeBaseArn']
+    )
+    tags = tags_response.get('tags', {})
+    return tags.get('public') == 'visible'
+
+
+def _load_visible_knowledge_bases(bedrock, bedrock_client) -> List[Dict[str, str]]:
+    summaries = _list_knowledge_base_summaries(bedrock)
+    if not summaries:
+        return []
+
+    # boto3 clients are thread safe, so the per-KB lookups can share them
+    workers = max(1, min(CATALOG_MAX_WORKERS, len(summaries)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        visible = list(executor.map(
+            lambda kb: _is_visible(bedrock, bedrock_client, kb),
+            summaries
+        ))
+
+    return [
+        {
+            'id': kb['knowledgeBaseId'],
+            'name': kb['name']
+        }
+        for kb, is_visible in zip(summaries, visible)
+        if is_visible
+    ]
+
+
+def get_visible_knowledge_bases(bedrock, bedrock_client) -> List[Dict[str, str]]:
+    """Return the knowledge bases tagged ``public: visible``, cached for CATALOG_TTL_SECONDS."""
+    with _lock:
+        cached = _cache['knowledge_bases']
+        if cached is not None and monotonic() < _cache['expires_at']:
+            return list(cached)
+
+        knowledge_bases = _load_visible_knowledge_bases(bedrock, bedrock_client)
+        _cache['knowledge_bases'] = knowledge_bases
+        _cache['expires_at'] = monotonic() + CATALOG_TTL_SECONDS
+        print(f"Knowledge base catalog refreshed: {len(knowledge_bases)} visible")
+        return list(knowledge_bases)
+
+
+def invalidate(reason: Optional[str] = None) -> None:
+    with _lock:
+        _cache['knowledge_bases'] = None
+        _cache['expires_at'] = 0.0
+    if reason:
+        print(f"Knowledge base catalog invalidated: {reason}")
@@ -0,0 +1,49 @@
+from typing import Dict, Any
+
+NUMBER_OF_RESULTS = 10
+MAX_TOKENS = 4096
+
+
+def build_request(payload: Dict[str, Any], template: str) -> Dict[str, Any]:
+    """The retrieve_and_generate request for a job payload, shared by the worker and the sync path."""
+    text_inference_config = payload['textInferenceConfig']
+    request = {
+        'input': {
+            'text': payload['message']
+        },
+        'retrieveAndGenerateConfiguration': {
+            'type': 'KNOWLEDGE_BASE',
+            'knowledgeBaseConfiguration': {
+                'knowledgeBaseId': payload['knowledgeBaseId'],
+                'modelArn': payload['modelArn'],
+                'retrievalConfiguration': {
+                    'vectorSearchConfiguration': {
+                        'numberOfResults': NUMBER_OF_RESULTS
+                    }
+                },
+                'generationConfiguration': {
+                    'promptTemplate': {
+                        'textPromptTemplate': template
+                    },
+                    'inferenceConfig': {
+                        'textInferenceConfig': {
+                            # The requested maxTokens is not passed through
+                            'maxTokens': MAX_TOKENS,
+                            'temperature': float(text_inference_config['temperature']),
+                            'topP': float(text_inference_config['topP']),
+                            'stopSequences': text_inference_config['stopSequences']
+                        }
+                    }
+                }
+            }
+        }
+    }
+    if payload.get('sessionId'):
+        # Follow-up turn: Bedrock already holds the earlier exchange
+        request['sessionId'] = payload['sessionId']
+    return request
+
+
+def inference_config(request: Dict[str, Any]) -> Dict[str, Any]:
+    return request['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration'][
+        'generationConfiguration']['inferenceConfig']['textInferenceConfig']
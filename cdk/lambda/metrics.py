@@ -0,0 +1,148 @@
+import json
+import os
+import random
+from time import time, perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# CloudWatch Embedded Metric Format: every record printed here becomes a
+# metric in NAMESPACE without a PutMetricData call.
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Ava/Chatbot')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Fraction of requests whose full payloads are written to the log
+DEBUG_LOG_SAMPLE_RATE = float(os.environ.get('DEBUG_LOG_SAMPLE_RATE', '0.01'))
+
+Metric = Tuple[float, str]
+
+
+def emit(metrics: Dict[str, Metric], dimensions: Dict[str, str],
+         dimension_sets: Optional[Iterable[List[str]]] = None,
+         properties: Optional[Dict[str, Any]] = None) -> None:
+    """Print one EMF record; metrics maps name to (value, unit)."""
+    if not METRICS_ENABLED:
+        return
+    dimensions = {key: str(value) for key, value in dimensions.items() if value is not None}
+    if dimension_sets is None:
+        dimension_sets = [list(dimensions)]
+    dimension_sets = [
+        dimension_set for dimension_set in dimension_sets
+        if all(name in dimensions for name in dimension_set)
+    ]
+    record = {
+        '_aws': {
+            'Timestamp': int(time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': dimension_sets,
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+            }]
+        },
+        **(properties or {}),
+        **dimensions,
+        **{name: value for name, (value, _) in metrics.items()}
+    }
+    print(json.dumps(record, default=str))
+
+
+def should_sample() -> bool:
+    return DEBUG_LOG_SAMPLE_RATE > 0 and random.random() < DEBUG_LOG_SAMPLE_RATE
+
+
+def sampled_debug(label: str, value: Any) -> None:
+    """Log a full payload for a sample of requests; serialization only happens when sampled."""
+    if should_sample():
+        print(f"[sampled] {label}: {json.dumps(value, default=str)}")
+
+
+# --- AWS call instrumentation -------------------------------------------------
+#
+# Hooked into botocore's event system, so every DynamoDB, SQS and Bedrock call
+# made through aws_clients is timed without touching the call sites.
+
+def _find_value(params: Any, key: str) -> Optional[str]:
+    if isinstance(params, dict):
+        if isinstance(params.get(key), str):
+            return params[key]
+        for value in params.values():
+            found = _find_value(value, key)
+            if found:
+                return found
+    return None
+
+
+def _body_size(body: Any) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    return 0
+
+
+def _on_parameter_build(params, model, context, **kwargs):
+    context['ava_started'] = perf_counter()
+    context['ava_operation_model'] = model
+    context['ava_model_arn'] = _find_value(params, 'modelArn') or _find_value(params, 'modelId')
+    context['ava_knowledge_base_id'] = _find_value(params, 'knowledgeBaseId')
+
+
+def _on_before_call(model, params, context, **kwargs):
+    context['ava_request_bytes'] = _body_size(params.get('body'))
+
+
+def _emit_call(service_name: str, model, context, response_bytes: int, is_error: bool,
+               error_code: Optional[str] = None) -> None:
+    started = context.get('ava_started')
+    if started is None:
+        return
+    emit(
+        {
+            'Latency': ((perf_counter() - started) * 1000, 'Milliseconds'),
+            'RequestBytes': (context.get('ava_request_bytes', 0), 'Bytes'),
+            'ResponseBytes': (response_bytes, 'Bytes'),
+            'Errors': (1 if is_error else 0, 'Count')
+        },
+        {
+            'Service': service_name,
+            'Operation': model.name,
+            'ModelArn': context.get('ava_model_arn'),
+            'KnowledgeBaseId': context.get('ava_knowledge_base_id')
+        },
+        dimension_sets=[
+            ['Service', 'Operation'],
+            ['Service', 'Operation', 'ModelArn'],
+            ['Service', 'Operation', 'KnowledgeBaseId']
+        ],
+        properties={'ErrorCode': error_code} if error_code else None
+    )
+
+
+def _on_after_call(service_name: str) -> Callable:
+    def handler(http_response, parsed, model, context, **kwargs):
+        if model.has_streaming_output or model.has_event_stream_output:
+            # Reading the body here would consume the stream
+            response_bytes = int(http_response.headers.get('content-length') or 0)
+        else:
+            response_bytes = len(http_response.content or b'')
+        is_error = http_response.status_code >= 300
+        error_code = parsed.get('Error', {}).get('Code') if is_error else None
+        _emit_call(service_name, model, context, response_bytes, is_error, error_code)
+    return handler
+
+
+def _on_after_call_error(service_name: str) -> Callable:
+    def handler(exception, context, **kwargs):
+        model = context.get('ava_operation_model')
+        if model is not None:
+            _emit_call(service_name, model, context, 0, True, type(exception).__name__)
+    return handler
+
+
+def instrument_client(service_client) -> None:
+    service_name = service_client.meta.service_model.service_id.hyphenize()
+    events = service_client.meta.events
+    events.register('before-parameter-build', _on_parameter_build)
+    events.register('before-call', _on_before_call)
+    events.register('after-call', _on_after_call(service_name))
+    events.register('after-call-error', _on_after_call_error(service_name))
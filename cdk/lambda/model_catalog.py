@@ -0,0 +1,125 @@
+import os
+import threading
+import traceback
+from time import monotonic
+from typing import Dict, Any, List, Optional
+
+# How long the discovered model list is served from memory before Bedrock is
+# asked again. Models change far less often than knowledge bases.
+CATALOG_TTL_SECONDS = float(os.environ.get('MODEL_CATALOG_TTL_SECONDS', '3600'))
+# The fallback list is only kept briefly so discovery is retried soon
+FALLBACK_TTL_SECONDS = 60.0
+
+# Comma separated substrings; a model is offered when its id contains one
+MODEL_ALLOWLIST = [
+    pattern.strip()
+    for pattern in os.environ.get(
+        'MODEL_ALLOWLIST',
+        'anthropic.claude-3-opus,anthropic.claude-3-5-haiku,anthropic.claude-3-5-sonnet-20241022-v2,'
+        'anthropic.claude-3-7-sonnet'
+    ).split(',')
+    if pattern.strip()
+]
+
+# Served when discovery fails or finds nothing, so the UI always has a choice
+FALLBACK_MODELS = [
+    {
+        'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-opus-20240229-v1:0',
+        'modelName': 'Claude 3 Opus'
+    },
+    {
+        'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-5-haiku-20241022-v1:0',
+        'modelName': 'Claude 3.5 Haiku'
+    },
+    {
+        'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-5-sonnet-20241022-v2:0',
+        'modelName': 'Claude 3.5 Sonnet v2'
+    },
+    {
+        'modelArn': 'arn:aws:bedrock:us-east-1:509399601784:inference-profile/us.anthropic.claude-3-7-sonnet-20250219-v1:0',
+        'modelName': 'Claude 3.7 Sonnet v1'
+    }
+]
+
+_lock = threading.Lock()
+_cache: Dict[str, Any] = {
+    'models': None,
+    'expires_at': 0.0
+}
+
+
+def is_allowed(model_id: str) -> bool:
+    return any(pattern in model_id for pattern in MODEL_ALLOWLIST)
+
+
+def _list_inference_profiles(bedrock) -> List[Dict[str, Any]]:
+    profiles = []
+    paginator = bedrock.get_paginator('list_inference_profiles')
+    for page in paginator.paginate(typeEquals='SYSTEM_DEFINED'):
+        profiles.extend(page.get('inferenceProfileSummaries', []))
+    return profiles
+
+
+def _list_foundation_models(bedrock) -> List[Dict[str, Any]]:
+    response = bedrock.list_foundation_models(byOutputModality='TEXT', byInferenceType='ON_DEMAND')
+    return response.get('modelSummaries', [])
+
+
+def _load_models(bedrock) -> List[Dict[str, str]]:
+    models = []
+    profile_ids = []
+    for profile in _list_inference_profiles(bedrock):
+        if profile.get('status', 'ACTIVE') != 'ACTIVE' or not is_allowed(profile['inferenceProfileId']):
+            continue
+        profile_ids.append(profile['inferenceProfileId'])
+        models.append({
+            'modelArn': profile['inferenceProfileArn'],
+            'modelName': profile['inferenceProfileName']
+        })
+
+    for model in _list_foundation_models(bedrock):
+        model_id = model['modelId']
+        if not is_allowed(model_id):
+            continue
+        if model.get('modelLifecycle', {}).get('status', 'ACTIVE') != 'ACTIVE':
+            continue
+        # An inference profile already covers the model ('us.' + model id)
+        if any(profile_id.endswith('.' + model_id) for profile_id in profile_ids):
+            continue
+        models.append({
+            'modelArn': model['modelArn'],
+            'modelName': model.get('modelName') or model_id
+        })
+
+    return sorted(models, key=lambda model: model['modelName'])
+
+
+def get_models(bedrock) -> List[Dict[str, str]]:
+    """Return the allowed models, cached for CATALOG_TTL_SECONDS."""
+    with _lock:
+        cached = _cache['models']
+        if cached is not None and monotonic() < _cache['expires_at']:
+            return list(cached)
+
+        try:
+            models = _load_models(bedrock)
+        except Exception:
+            print(traceback.format_exc())
+            models = []
+        ttl = CATALOG_TTL_SECONDS
+        if not models:
+            print("Model discovery found nothing, serving the fallback list")
+            models = FALLBACK_MODELS
+            ttl = min(ttl, FALLBACK_TTL_SECONDS)
+        _cache['models'] = models
+        _cache['expires_at'] = monotonic() + ttl
+        print(f"Model catalog refreshed: {len(models)} models")
+        return list(models)
+
+
+def invalidate(reason: Optional[str] = None) -> None:
+    with _lock:
+        _cache['models'] = None
+        _cache['expires_at'] = 0.0
+    if reason:
+        print(f"Model catalog invalidated: {reason}")
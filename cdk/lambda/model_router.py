@@ -0,0 +1,115 @@
+import json
+import os
+import re
+import threading
+from random import random, choice
+from typing import Collection, Dict, List, Optional, Tuple
+
+import job_retry
+import metrics
+
+# Equivalent targets per requested model, e.g.
+#   {"anthropic.claude-3-5-haiku": [
+#       "arn:aws:bedrock:us-east-1:123456789012:inference-profile/us.anthropic.claude-3-5-haiku-20241022-v1:0",
+#       "arn:aws:bedrock:us-west-2::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0"]}
+# Keys match the requested ARN as a substring, the most specific one wins.
+# The requested ARN is always a candidate.
+MODEL_ROUTES: Dict[str, List[str]] = json.loads(os.environ.get('MODEL_ROUTES') or '{}')
+# Also try the requested model as an on-demand foundation model in this region
+ROUTE_TO_FOUNDATION_MODELS = os.environ.get('ROUTE_TO_FOUNDATION_MODELS', 'false').lower() == 'true'
+
+# Weight of the newest observation in the rolling averages
+EWMA_ALPHA = float(os.environ.get('ROUTING_EWMA_ALPHA', '0.2'))
+# A target that throttles every call scores as (1 + penalty) times its latency
+THROTTLE_PENALTY = float(os.environ.get('ROUTING_THROTTLE_PENALTY', '4'))
+# Latency assumed for a target until its first answer, so an untried target
+# is preferred over one that has only throttled
+PRIOR_LATENCY_MS = float(os.environ.get('ROUTING_PRIOR_LATENCY_MS', '1000'))
+# Share of jobs sent to a random healthy target so stale scores get refreshed
+EXPLORE_RATE = float(os.environ.get('ROUTING_EXPLORE_RATE', '0.05'))
+
+_PROFILE_PREFIX = re.compile(r'^(us|us-gov|eu|apac|ca|jp|au|global)\.')
+
+
+class TargetStats:
+    def __init__(self):
+        self.latency_ms: Optional[float] = None
+        self.throttle_rate = 0.0
+
+    def observe(self, latency_ms: Optional[float], throttled: bool) -> None:
+        self.throttle_rate += EWMA_ALPHA * ((1.0 if throttled else 0.0) - self.throttle_rate)
+        if latency_ms is not None:
+            if self.latency_ms is None:
+                self.latency_ms = latency_ms
+            else:
+                self.latency_ms += EWMA_ALPHA * (latency_ms - self.latency_ms)
+
+    def score(self) -> float:
+        latency_ms = PRIOR_LATENCY_MS if self.latency_ms is None else self.latency_ms
+        return latency_ms * (1 + THROTTLE_PENALTY * self.throttle_rate)
+
+
+_stats: Dict[str, TargetStats] = {}
+_lock = threading.Lock()
+
+
+def model_id(model_arn: str) -> str:
+    """The base model id of a foundation model or inference profile ARN."""
+    return _PROFILE_PREFIX.sub('', model_arn.rsplit('/', 1)[-1])
+
+
+def candidates(model_arn: str) -> List[str]:
+    targets = [model_arn]
+    matches = [key for key in MODEL_ROUTES if key in model_arn]
+    if matches:
+        targets.extend(MODEL_ROUTES[max(matches, key=len)])
+    region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+    if ROUTE_TO_FOUNDATION_MODELS and region and model_arn.startswith('arn:'):
+        targets.append(f"arn:aws:bedrock:{region}::foundation-model/{model_id(model_arn)}")
+    return list(dict.fromkeys(targets))
+
+
+def _stats_for(target: str) -> TargetStats:
+    stats = _stats.get(target)
+    if stats is None:
+        with _lock:
+            stats = _stats.setdefault(target, TargetStats())
+    return stats
+
+
+def choose(model_arn: str, exclude: Collection[str] = ()) -> Tuple[Optional[str], float]:
+    """Pick the healthiest target for a requested model, other than those excluded.
+
+    Returns the target and 0, or None and how long until the first resting
+    target (one whose circuit is open) can be tried again.
+    """
+    targets = [target for target in candidates(model_arn) if target not in exclude]
+    if not targets:
+        return None, 0.0
+    resting = {target: job_retry.breaker_for(target).remaining_seconds() for target in targets}
+    healthy = [target for target in targets if resting[target] <= 0]
+    if not healthy:
+        return None, min(resting.values())
+
+    if len(healthy) > 1 and random() < EXPLORE_RATE:
+        target = choice(healthy)
+    else:
+        # Ties go to the earlier candidate, i.e. the requested model
+        target = min(healthy, key=lambda candidate: _stats_for(candidate).score())
+    # Claims the half-open trial when the target's circuit is just closing
+    wait_seconds = job_retry.breaker_for(target).wait_seconds()
+    if wait_seconds > 0:
+        return None, wait_seconds
+    return target, 0.0
+
+
+def record(target: str, latency_ms: Optional[float], throttled: bool) -> None:
+    """Feed one call's outcome into the target's rolling latency and throttle scores."""
+    stats = _stats_for(target)
+    with _lock:
+        stats.observe(latency_ms, throttled)
+    values = {'TargetThrottles': (1 if throttled else 0, 'Count')}
+    # A throttled call never answered, so it has no latency to report
+    if latency_ms is not None:
+        values['TargetLatency'] = (latency_ms, 'Milliseconds')
+    metrics.emit(values, {'Target': model_id(target)}, properties={'TargetArn': target})
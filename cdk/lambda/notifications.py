@@ -0,0 +1,131 @@
+import json
+import os
+import traceback
+from time import time
+from typing import Dict, Any, Optional
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+STATE_TABLE = os.environ.get('STATE_TABLE')
+WEBSOCKET_ENDPOINT = os.environ.get('WEBSOCKET_ENDPOINT')
+ENABLED = bool(STATE_TABLE) and bool(WEBSOCKET_ENDPOINT)
+
+# A subscription outlives any job; API Gateway drops idle connections after
+# 10 minutes and every connection after 2 hours
+SUBSCRIPTION_TTL_SECONDS = int(os.environ.get('SUBSCRIPTION_TTL_SECONDS', '7200'))
+
+# API Gateway rejects WebSocket messages over 128 KB. Bigger answers are
+# announced without the result and the client fetches them with GET /chatbot.
+MAX_PUSH_BYTES = 120 * 1024
+
+
+def _key(chatbot_request_id: str) -> Dict[str, str]:
+    return {'pk': f"subscription#{chatbot_request_id}"}
+
+
+def _connection_key(connection_id: str) -> Dict[str, str]:
+    return {'pk': f"connection#{connection_id}"}
+
+
+def register_connection(connection_id: str, user_sub: str) -> None:
+    """Remember who opened a connection; only $connect sees the authorizer's result."""
+    aws_clients.state_table().put_item(
+        Item={
+            **_connection_key(connection_id),
+            'user_sub': user_sub,
+            'expires_at': int(time()) + SUBSCRIPTION_TTL_SECONDS
+        }
+    )
+
+
+def connection_owner(connection_id: str) -> Optional[str]:
+    item = aws_clients.state_table().get_item(
+        Key=_connection_key(connection_id),
+        ProjectionExpression='user_sub, expires_at'
+    ).get('Item')
+    # The TTL deletes items late, so expired ones are checked here too
+    if not item or item['expires_at'] < int(time()):
+        return None
+    return item['user_sub']
+
+
+def forget_connection(connection_id: str) -> None:
+    aws_clients.state_table().delete_item(Key=_connection_key(connection_id))
+
+
+def subscribe(chatbot_request_id: str, connection_id: str, user_sub: str) -> bool:
+    """Subscribe a connection to a request; False if someone else holds the subscription.
+
+    The same user may take it over, so a client that reconnects gets a new
+    connection id and still receives its answer.
+    """
+    now = int(time())
+    try:
+        aws_clients.state_table().put_item(
+            Item={
+                **_key(chatbot_request_id),
+                'connection_id': connection_id,
+                'user_sub': user_sub,
+                'expires_at': now + SUBSCRIPTION_TTL_SECONDS
+            },
+            ConditionExpression='attribute_not_exists(pk) OR user_sub = :user_sub OR expires_at < :now',
+            ExpressionAttributeValues={':user_sub': user_sub, ':now': now}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+
+def subscriber(chatbot_request_id: str) -> Optional[str]:
+    """The connection waiting for a request, if there is one."""
+    item = aws_clients.state_table().get_item(
+        Key=_key(chatbot_request_id),
+        ProjectionExpression='connection_id'
+    ).get('Item')
+    return item['connection_id'] if item else None
+
+
+def push(connection_id: str, record: Dict[str, Any]) -> bool:
+    """Send a client record to a connection; False once the connection is gone."""
+    message = json.dumps({'type': 'status', **record}, default=str)
+    if len(message.encode('utf-8')) > MAX_PUSH_BYTES:
+        message = json.dumps({
+            'type': 'status',
+            'chatbot_request_id': record['chatbot_request_id'],
+            'status': record['status'],
+            'fetch': True
+        })
+    try:
+        aws_clients.websocket_management().post_to_connection(
+            ConnectionId=connection_id,
+            Data=message.encode('utf-8')
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'GoneException':
+            raise
+        return False
+
+
+def notify(chatbot_request_id: str, status: str, result: Any, connection_id: Optional[str] = None) -> None:
+    """Push a request's status to its subscriber. Failures are logged, never raised."""
+    if not ENABLED:
+        return
+    try:
+        connection_id = connection_id or subscriber(chatbot_request_id)
+        if not connection_id:
+            return
+        record = {
+            'chatbot_request_id': chatbot_request_id,
+            'status': status,
+            'result': result
+        }
+        if not push(connection_id, record):
+            # The client left; it falls back to polling if it comes back
+            aws_clients.state_table().delete_item(Key=_key(chatbot_request_id))
+    except Exception:
+        print(traceback.format_exc())
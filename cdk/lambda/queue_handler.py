@@ -1,152 +1,473 @@
-import json
 import os
-import boto3
 import logging
 from botocore.exceptions import ClientError
 import traceback
-
-
-dynamodb = boto3.resource('dynamodb')
-bedrock = boto3.client('bedrock-agent')
-bedrock_runtime = boto3.client('bedrock-agent-runtime')
-bedrock_client = boto3.client('bedrock')
-sqs = boto3.client('sqs')
+import answer_cache
+import aws_clients
+import grounded_generation
+import job_retry
+import job_envelope
+import kb_request
+import metrics
+import model_router
+import notifications
+import rate_limiter
+import result_store
+import sessions
+import template_registry
+import usage
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
+from time import perf_counter
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
 QUEUE_URL = os.environ.get('SQS_QUEUE_URL')
-table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
+
+# Number of SQS records from one batch processed in parallel; 1 keeps the
+# worker sequential.
+WORKER_CONCURRENCY = max(1, int(os.environ.get('WORKER_CONCURRENCY', '1')))
+
+# Stream generation through retrieve_and_generate_stream and publish the
+# partial answer to DynamoDB while it is being written.
+WORKER_STREAMING = os.environ.get('WORKER_STREAMING', 'false').lower() == 'true'
+# Partial output is written once this much time has passed or this much text
+# has built up since the previous write, whichever comes first.
+STREAM_FLUSH_INTERVAL_SECONDS = float(os.environ.get('STREAM_FLUSH_INTERVAL_SECONDS', '0.5'))
+STREAM_FLUSH_MIN_CHARS = int(os.environ.get('STREAM_FLUSH_MIN_CHARS', '400'))
+
+# Run retrieval and generation as separate calls so retrieved chunks can be
+# cached and reused across models, templates and inference settings
+WORKER_SPLIT_RETRIEVAL = os.environ.get('WORKER_SPLIT_RETRIEVAL', 'false').lower() == 'true'
+
+# SQS caps a message's visibility timeout at 12 hours
+MAX_VISIBILITY_TIMEOUT_SECONDS = 12 * 60 * 60
+
+_executor = None
+
+
+class DeferredJob(Exception):
+    """Raised when a job should run again later instead of failing now."""
+
+    def __init__(self, delay_seconds, reason):
+        super().__init__(reason)
+        self.delay_seconds = delay_seconds
 
 
 
-def update_dynamodb_record(chatbot_request_id, response, status):
+def update_dynamodb_record(chatbot_request_id, response, status, stored_result=None, details=None):
     
     try:
-        # Update the item
-        response = table.update_item(
+        if stored_result is None and status == 'success':
+            stored_result = result_store.encode(chatbot_request_id, response)
+
+        names = {'#status': 'status', '#result': 'result'}
+        values = {':status': status}
+        assignments = ['#status = :status']
+        # Drop partial streamed output, any payload that overflowed SQS and
+        # whatever form of result the record held before
+        removals = ['stream_text', 'stream_citations', 'payload']
+        if stored_result:
+            for position, (attribute, value) in enumerate(stored_result.items()):
+                assignments.append(f"{attribute} = :stored{position}")
+                values[f":stored{position}"] = value
+            removals.append('#result')
+        else:
+            assignments.append('#result = :result')
+            values[':result'] = response
+        # Which target served the answer and what it used
+        for attribute, value in (details or {}).items():
+            assignments.append(f"{attribute} = :{attribute}")
+            values[f":{attribute}"] = value
+        removals.extend(attribute for attribute in result_store.STORED_ATTRIBUTES
+                        if attribute not in (stored_result or {}))
+
+        # Nothing is read back: the poller fetches the result, not the worker
+        aws_clients.tracking_table().update_item(
+            Key={
+                'chatbot_request_id': chatbot_request_id
+            },
+            UpdateExpression=f"SET {', '.join(assignments)} REMOVE {', '.join(removals)}",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        print(f"Error updating record: {e.response['Error']['Message']}")
+        raise
+
+    # Tell a waiting client straight away instead of leaving it to poll
+    if status == 'success' and isinstance(response, dict):
+        notifications.notify(chatbot_request_id, status, result_store.expand(result_store.compact(response)))
+    else:
+        notifications.notify(chatbot_request_id, status, response)
+    return stored_result
+
+def stream_citation(citation):
+    # Retrieved chunks can run to kilobytes each; partial output only points
+    # at them, and the final result stores them once, compacted
+    return {
+        'generatedResponsePart': citation.get('generatedResponsePart'),
+        'retrievedReferences': [
+            {'location': reference.get('location')}
+            for reference in citation.get('retrievedReferences') or []
+        ]
+    }
+
+def append_stream_chunks(chatbot_request_id, text_chunks, citations):
+    try:
+        aws_clients.tracking_table().update_item(
             Key={
                 'chatbot_request_id': chatbot_request_id
             },
-            UpdateExpression='SET #status = :status, #result = :result',
+            UpdateExpression=(
+                'SET #status = :status, '
+                'stream_text = list_append(if_not_exists(stream_text, :empty), :text), '
+                'stream_citations = list_append(if_not_exists(stream_citations, :empty), :citations)'
+            ),
             ExpressionAttributeNames={
-                '#status': 'status',
-                '#result': 'result'
+                '#status': 'status'
             },
             ExpressionAttributeValues={
-                ':status': status,
-                ':result': response
-            },
-            ReturnValues="UPDATED_NEW"
+                ':status': 'streaming',
+                ':text': [''.join(text_chunks)],
+                ':citations': result_store.to_dynamodb([stream_citation(citation) for citation in citations]),
+                ':empty': []
+            }
         )
-        return response
     except ClientError as e:
-        print(f"Error updating record: {e.response['Error']['Message']}")
+        print(f"Error appending stream chunks: {e.response['Error']['Message']}")
         raise
 
-def handler(event, context):
-    try:
-        # Process SQS messages
-        for sqs_record in event['Records']:
-            print("SQS Record: " + json.dumps(sqs_record, indent=2))
-            # Parse the message body
-            message = json.loads(sqs_record['body'])
-            chatbot_request_id = message['chatbot_request_id']
-            # Read from DynamoDB table
-            response = table.get_item(
-                Key={
-                    'chatbot_request_id': chatbot_request_id
-                }
-            )
-            
-            print(response)
-            # Log the retrieved item
-            if 'Item' in response:
-                logger.info(f"Retrieved item from DynamoDB: {response['Item']}")
-                payload = response['Item']['payload']
-                
-                message = payload['message']
-                knowledgeBaseId = payload['knowledgeBaseId']
-                textPromptTemplate = payload['textPromptTemplate']
-                textInferenceConfig = payload['textInferenceConfig']
-                modelArn = payload['modelArn']
-                
-                maxTokens =textInferenceConfig["maxTokens"]
-                temperature = textInferenceConfig["temperature"]
-                topP = textInferenceConfig["topP"]
-                stopSequences = textInferenceConfig["stopSequences"]
-                
-                
-                logger.info("=== Template Debug Information ===")
-                logger.info(f"Custom template provided: {textPromptTemplate is not None}")
-                if textPromptTemplate is not None:
-                    logger.info(f"Custom template length: {len(textPromptTemplate)}")
-                    logger.info(f"Custom template preview (first 100 chars): {textPromptTemplate[:100]}")
-                
-                print("ModelARN: "+ modelArn)
-                print("knowledge_base_id: "+ knowledgeBaseId)
-                print("Message: "+ message)
-                
-                # Call Bedrock Knowledge Base
+def stream_retrieve_and_generate(chatbot_request_id, request):
+    response = aws_clients.bedrock_agent_runtime().retrieve_and_generate_stream(**request)
+
+    text_parts = []
+    citations = []
+    pending_text = []
+    pending_citations = []
+    pending_chars = 0
+    last_flush = perf_counter()
+    # Cleared once the partial answer no longer fits on the record
+    writing = True
+    # Looked up once, at the first flush, so the client has had time to subscribe
+    connection_id = None
+    looked_up = not notifications.ENABLED
+
+    for event in response['stream']:
+        if 'output' in event:
+            text = event['output'].get('text', '')
+            text_parts.append(text)
+            pending_text.append(text)
+            pending_chars += len(text)
+        elif 'citation' in event:
+            citation_event = event['citation']
+            citation = citation_event.get('citation') or {
+                'generatedResponsePart': citation_event.get('generatedResponsePart'),
+                'retrievedReferences': citation_event.get('retrievedReferences', [])
+            }
+            citations.append(citation)
+            pending_citations.append(citation)
+
+        # Coalesce tokens so a long answer costs a handful of writes, not one per token
+        if writing and (pending_text or pending_citations) and (
+            pending_chars >= STREAM_FLUSH_MIN_CHARS
+            or perf_counter() - last_flush >= STREAM_FLUSH_INTERVAL_SECONDS
+        ):
+            try:
+                append_stream_chunks(chatbot_request_id, pending_text, pending_citations)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationException':
+                    raise
+                # The item size limit: the final write still stores the whole answer
+                print(f"Stopped writing partial output for {chatbot_request_id}: {e.response['Error']['Message']}")
+                writing = False
+                continue
+            if not looked_up:
+                looked_up = True
                 try:
-                    kb_response = bedrock_runtime.retrieve_and_generate(
-                        input={
-                            'text': message
-                        },
-                        retrieveAndGenerateConfiguration={
-                            'type': 'KNOWLEDGE_BASE',
-                            'knowledgeBaseConfiguration': {
-                                "knowledgeBaseId" :  knowledgeBaseId,
-                                "modelArn": modelArn,
-                                'retrievalConfiguration': {
-                                    'vectorSearchConfiguration': {
-                                        'numberOfResults': 10
-                                    }
-                                },
-                                'generationConfiguration': {
-                                    'promptTemplate': {
-                                        'textPromptTemplate': textPromptTemplate if textPromptTemplate is not None else None
-                                    },
-                                    "inferenceConfig": { 
-                                        "textInferenceConfig": { 
-                                            # "maxTokens": int(maxTokens),
-                                            "maxTokens": 4096,
-                                                "temperature": float(temperature),
-                                                "topP": float(topP),
-                                                "stopSequences": stopSequences
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    )
-                    
-                    # Update DynamoDB with the response
-                    update_dynamodb_record(chatbot_request_id, kb_response, 'success')
-                    
-                    # Delete the SQS message since processing was successful
-                    sqs.delete_message(
-                        QueueUrl=QUEUE_URL,
-                        ReceiptHandle=sqs_record['receiptHandle']
-                    )
-                    
-                except Exception as e:
-                    traceback_str = traceback.format_exc()
-                    print(traceback_str)
-                    logger.error(f"Error processing request: {str(e)}")
-                    update_dynamodb_record(chatbot_request_id, str(e), 'error')
-
-                
-    
+                    connection_id = notifications.subscriber(chatbot_request_id)
+                except ClientError as e:
+                    print(f"Error looking up subscriber: {e.response['Error']['Message']}")
+            if connection_id:
+                notifications.notify(chatbot_request_id, 'streaming', {
+                    'output': {
+                        'text': ''.join(text_parts)
+                    },
+                    'citations': [stream_citation(citation) for citation in citations]
+                }, connection_id)
+            pending_text = []
+            pending_citations = []
+            pending_chars = 0
+            last_flush = perf_counter()
+
+    # Whatever is still pending goes out with the final result
+    return {
+        'output': {
+            'text': ''.join(text_parts)
+        },
+        'citations': citations,
+        'sessionId': response.get('sessionId')
+    }
+
+def retrieve_and_generate(chatbot_request_id, request):
+    if WORKER_STREAMING:
+        return stream_retrieve_and_generate(chatbot_request_id, request)
+    return aws_clients.bedrock_agent_runtime().retrieve_and_generate(**request)
+
+def retrieve_and_generate_in_session(chatbot_request_id, request):
+    try:
+        return retrieve_and_generate(chatbot_request_id, request)
+    except ClientError as e:
+        if 'sessionId' not in request or e.response['Error']['Code'] != 'ValidationException':
+            raise
+        # The session expired or is unknown to Bedrock: answer without it and
+        # let the conversation continue in the session this call starts
+        print(f"Session {request['sessionId']} rejected, starting a new one: {e.response['Error']['Message']}")
+        request = {key: value for key, value in request.items() if key != 'sessionId'}
+        return retrieve_and_generate(chatbot_request_id, request)
+
+def remember_session(conversation_key, session_id):
+    if not conversation_key or not session_id or not sessions.ENABLED:
+        return
+    try:
+        sessions.save(conversation_key, session_id)
+    except Exception as e:
+        # The answer is still good; the next turn just starts a new session
+        print(f"Error saving session for {conversation_key}: {str(e)}")
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY)
+    return _executor
+
+def process_record(sqs_record):
+    metrics.sampled_debug('SQS record', sqs_record)
+    # Parse the message body
+    chatbot_request_id, payload = job_envelope.parse_message(sqs_record['body'])
+
+    if payload is None:
+        # Oversized or legacy job: the payload lives on the DynamoDB record
+        response = aws_clients.tracking_table().get_item(
+            Key={
+                'chatbot_request_id': chatbot_request_id
+            }
+        )
+
+        if 'Item' not in response:
+            logger.info(f"No item found for chatbot_request_id: {chatbot_request_id}")
+            return
+
+        payload = response['Item']['payload']
+
+    deliveries = int((sqs_record.get('attributes') or {}).get('ApproximateReceiveCount', '1'))
+    if deliveries > job_retry.MAX_DELIVERIES:
+        # Out of attempts and deferrals: fail the job now rather than let the
+        # message reach the dead-letter queue with its record still processing
+        error = f"Gave up after {deliveries - 1} deliveries without an answer"
+        logger.error(f"{chatbot_request_id}: {error}")
+        metrics.emit({'RecordsExhausted': (1, 'Count')}, {'Function': 'QueueWorker'})
+        update_dynamodb_record(chatbot_request_id, error, 'error')
+        publish_to_answer_cache(payload.get('cacheKey'), chatbot_request_id, error, 'error')
+        return
+
+    message = payload['message']
+    knowledgeBaseId = payload['knowledgeBaseId']
+    modelArn = payload['modelArn']
+
+    metrics.sampled_debug('Job payload', payload)
+
+    # Call Bedrock Knowledge Base
+    try:
+        textPromptTemplate = template_registry.template_for(payload)
+        request = kb_request.build_request(payload, textPromptTemplate)
+
+        # Send the job to the healthiest equivalent of the requested model; a
+        # target that keeps failing gets a rest before anything else is sent to it
+        target, wait_seconds = model_router.choose(modelArn)
+        if target is None:
+            raise DeferredJob(wait_seconds, f"Circuit for every target of {modelArn} is open")
+
+        inference_config = kb_request.inference_config(request)
+        tokens = rate_limiter.estimate_tokens((textPromptTemplate or '') + message, inference_config['maxTokens'])
+        over_budget = {}
+        while True:
+            wait_seconds = rate_limiter.acquire(target, tokens)
+            if wait_seconds <= 0:
+                break
+            # An equivalent target may still have budget to spare
+            over_budget[target] = wait_seconds
+            target, _ = model_router.choose(modelArn, exclude=over_budget)
+            if target is None:
+                raise DeferredJob(min(over_budget.values()), f"Every available target of {modelArn} is over its rate budget")
+
+        breaker = job_retry.breaker_for(target)
+        knowledge_base_config = request['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']
+        knowledge_base_config['modelArn'] = target
+
+        started = perf_counter()
+        try:
+            if WORKER_SPLIT_RETRIEVAL:
+                kb_response = grounded_generation.retrieve_then_generate(
+                    knowledgeBaseId,
+                    message,
+                    target,
+                    textPromptTemplate,
+                    knowledge_base_config['retrievalConfiguration'],
+                    inference_config
+                )
             else:
-                logger.info(f"No item found for chatbot_request_id: {message['chatbot_request_id']}")
-                
-        return {
-            'statusCode': 200,
-            'body': json.dumps('Messages processed successfully')
-        }
-        
+                kb_response = retrieve_and_generate_in_session(chatbot_request_id, request)
+                remember_session(payload.get('conversationKey'), kb_response.get('sessionId'))
+        except Exception as e:
+            # A target that keeps timing out or erroring is as unusable as one
+            # that throttles; errors in the request itself say nothing about it
+            if job_retry.is_transient(e):
+                breaker.record_failure()
+            if job_retry.is_throttling(e):
+                model_router.record(target, None, throttled=True)
+            raise
+        generation_ms = (perf_counter() - started) * 1000
+        breaker.record_success()
+        model_router.record(target, generation_ms, throttled=False)
+        measured = usage.measure(kb_response, (textPromptTemplate or '') + message, generation_ms)
+        usage.record(payload.get('userSub'), target, measured)
+
+        # Update DynamoDB with the response
+        stored_result = update_dynamodb_record(
+            chatbot_request_id, kb_response, 'success',
+            details={'served_model_arn': target, **measured}
+        )
+        publish_to_answer_cache(payload.get('cacheKey'), chatbot_request_id, kb_response, 'success', stored_result)
+
+    except DeferredJob:
+        raise
     except Exception as e:
+        if job_retry.is_transient(e):
+            attempts = record_attempt(chatbot_request_id, e)
+            if attempts < job_retry.MAX_ATTEMPTS:
+                raise DeferredJob(
+                    job_retry.backoff_seconds(attempts),
+                    f"Attempt {attempts} of {job_retry.MAX_ATTEMPTS} failed: {str(e)}"
+                ) from e
         traceback_str = traceback.format_exc()
         print(traceback_str)
-        logger.error(f"Error processing messages: {str(e)}")
-        raise
\ No newline at end of file
+        logger.error(f"Error processing request: {str(e)}")
+        update_dynamodb_record(chatbot_request_id, str(e), 'error')
+        publish_to_answer_cache(payload.get('cacheKey'), chatbot_request_id, str(e), 'error')
+
+def record_attempt(chatbot_request_id, error):
+    # Partial output from a streamed attempt is discarded so the next one starts clean
+    response = aws_clients.tracking_table().update_item(
+        Key={
+            'chatbot_request_id': chatbot_request_id
+        },
+        UpdateExpression='SET #status = :processing, last_error = :error ADD attempts :one REMOVE stream_text, stream_citations',
+        ExpressionAttributeNames={
+            '#status': 'status'
+        },
+        ExpressionAttributeValues={
+            ':processing': 'processing',
+            ':error': f"{job_retry.error_code(error)}: {str(error)}"[:1000],
+            ':one': 1
+        },
+        ReturnValues='UPDATED_NEW'
+    )
+    return int(response['Attributes']['attempts'])
+
+def publish_to_answer_cache(cache_key, chatbot_request_id, response, status, stored_result=None):
+    if not cache_key or not answer_cache.ENABLED:
+        return
+    try:
+        if status == 'success':
+            waiters = answer_cache.complete(cache_key, chatbot_request_id, response, stored_result)
+        else:
+            waiters = answer_cache.abandon(cache_key, chatbot_request_id)
+    except Exception as e:
+        # The requester already has its answer; a cache failure must not redo the job
+        traceback_str = traceback.format_exc()
+        print(traceback_str)
+        logger.error(f"Error publishing to answer cache: {str(e)}")
+        try:
+            # Releasing the entry still hands back who is waiting for the answer
+            waiters = answer_cache.abandon(cache_key, chatbot_request_id)
+        except Exception as e:
+            logger.error(f"Error releasing answer cache entry: {str(e)}")
+            return
+    # Identical questions that arrived while this one ran share its answer
+    for waiter_id in waiters:
+        try:
+            update_dynamodb_record(waiter_id, response, status, stored_result)
+        except Exception as e:
+            logger.error(f"Error answering waiting request {waiter_id}: {str(e)}")
+
+def defer_message(sqs_record, delay_seconds):
+    # Hidden for the delay, the message comes back once the budget allows
+    visibility_timeout = int(min(MAX_VISIBILITY_TIMEOUT_SECONDS, max(1, delay_seconds + uniform(0, 1))))
+    aws_clients.sqs().change_message_visibility(
+        QueueUrl=QUEUE_URL,
+        ReceiptHandle=sqs_record['receiptHandle'],
+        VisibilityTimeout=visibility_timeout
+    )
+    return visibility_timeout
+
+def _timed_process_record(sqs_record):
+    started = perf_counter()
+    failed = False
+    deferred = False
+    try:
+        process_record(sqs_record)
+        return None
+    except DeferredJob as e:
+        deferred = True
+        try:
+            visibility_timeout = defer_message(sqs_record, e.delay_seconds)
+            print(f"Deferred message {sqs_record['messageId']} for {visibility_timeout}s: {str(e)}")
+        except Exception:
+            # SQS redelivers after the queue's own visibility timeout instead
+            traceback_str = traceback.format_exc()
+            print(traceback_str)
+        return {'itemIdentifier': sqs_record['messageId']}
+    except Exception as e:
+        failed = True
+        traceback_str = traceback.format_exc()
+        print(traceback_str)
+        logger.error(f"Error processing message {sqs_record['messageId']}: {str(e)}")
+        return {'itemIdentifier': sqs_record['messageId']}
+    finally:
+        metrics.emit(
+            {
+                'RecordLatency': ((perf_counter() - started) * 1000, 'Milliseconds'),
+                'RecordFailures': (1 if failed else 0, 'Count'),
+                'RecordsDeferred': (1 if deferred else 0, 'Count')
+            },
+            {'Function': 'QueueWorker'},
+            properties={'MessageId': sqs_record['messageId']}
+        )
+
+def handler(event, context):
+    records = event['Records']
+    started = perf_counter()
+
+    # Records are independent jobs, so a batch can run side by side. Messages
+    # that fail are handed back to SQS through batchItemFailures; everything
+    # else is deleted by the event source mapping when we return.
+    if WORKER_CONCURRENCY > 1 and len(records) > 1:
+        results = list(get_executor().map(_timed_process_record, records))
+    else:
+        results = [_timed_process_record(sqs_record) for sqs_record in records]
+
+    batch_item_failures = [result for result in results if result is not None]
+    metrics.emit(
+        {
+            'BatchLatency': ((perf_counter() - started) * 1000, 'Milliseconds'),
+            'BatchSize': (len(records), 'Count'),
+            'BatchFailures': (len(batch_item_failures), 'Count')
+        },
+        {'Function': 'QueueWorker'},
+        properties={'Concurrency': min(WORKER_CONCURRENCY, len(records))}
+    )
+
+    return {
+        'batchItemFailures': batch_item_failures
+    }
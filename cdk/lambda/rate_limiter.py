@@ -0,0 +1,112 @@
+import json
+import os
+from decimal import Decimal
+from time import time
+from typing import Dict, Optional
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+STATE_TABLE = os.environ.get('STATE_TABLE')
+
+# Per-model budgets, e.g.
+#   {"anthropic.claude-3-opus": {"rpm": 50, "tpm": 400000}, "default": {"rpm": 500}}
+# Keys match a model ARN exactly or as a substring; a missing or zero budget
+# means unlimited.
+MODEL_RATE_LIMITS: Dict[str, Dict[str, float]] = json.loads(os.environ.get('MODEL_RATE_LIMITS') or '{}')
+
+# Knowledge base chunks sent to the model on top of the prompt and question
+RETRIEVED_CONTEXT_TOKENS = int(os.environ.get('RATE_LIMIT_RETRIEVED_CONTEXT_TOKENS', '3000'))
+MAX_ACQUIRE_ATTEMPTS = 3
+CHARS_PER_TOKEN = 4
+
+
+def budget_for(model_arn: str) -> Optional[Dict[str, float]]:
+    if model_arn in MODEL_RATE_LIMITS:
+        budget = MODEL_RATE_LIMITS[model_arn]
+    else:
+        matches = [key for key in MODEL_RATE_LIMITS if key != 'default' and key in (model_arn or '')]
+        # The most specific pattern wins
+        budget = MODEL_RATE_LIMITS[max(matches, key=len)] if matches else MODEL_RATE_LIMITS.get('default')
+    if not budget or not (budget.get('rpm') or budget.get('tpm')):
+        return None
+    return budget
+
+
+def estimate_tokens(prompt_text: str, max_tokens: int) -> int:
+    """Quota usage is charged up front on the prompt plus the requested output."""
+    return len(prompt_text or '') // CHARS_PER_TOKEN + RETRIEVED_CONTEXT_TOKENS + int(max_tokens or 0)
+
+
+def _key(model_arn: str) -> Dict[str, str]:
+    return {'pk': f"ratelimit#{model_arn}"}
+
+
+def _to_decimal(value: float) -> Decimal:
+    return Decimal(str(round(value, 3)))
+
+
+def _refill(available: float, capacity: float, elapsed_ms: int) -> float:
+    return min(capacity, available + capacity * elapsed_ms / 60000.0)
+
+
+def acquire(model_arn: str, tokens: int) -> float:
+    """Take one request and `tokens` tokens from a model's shared bucket.
+
+    Returns 0 when the call may go ahead, otherwise the seconds to wait until
+    the bucket holds enough; nothing is taken in that case. Buckets hold one
+    minute of budget and refill continuously, and every worker container
+    shares them through the state table with optimistic locking.
+    """
+    budget = budget_for(model_arn)
+    if budget is None or not STATE_TABLE:
+        return 0.0
+    rpm = float(budget.get('rpm') or 0)
+    tpm = float(budget.get('tpm') or 0)
+    table = aws_clients.state_table()
+
+    for _ in range(MAX_ACQUIRE_ATTEMPTS):
+        now = int(time() * 1000)
+        item = table.get_item(Key=_key(model_arn), ConsistentRead=True).get('Item')
+        if item:
+            elapsed_ms = max(0, now - int(item['refilled_at']))
+            requests = _refill(float(item.get('requests', rpm)), rpm, elapsed_ms)
+            available_tokens = _refill(float(item.get('tokens', tpm)), tpm, elapsed_ms)
+        else:
+            requests, available_tokens = rpm, tpm
+
+        # A single job bigger than the whole budget would otherwise wait forever
+        tokens_needed = min(tokens, tpm) if tpm else 0
+        waits = []
+        if rpm and requests < 1:
+            waits.append((1 - requests) * 60.0 / rpm)
+        if tpm and available_tokens < tokens_needed:
+            waits.append((tokens_needed - available_tokens) * 60.0 / tpm)
+        if waits:
+            return max(waits)
+
+        condition = 'refilled_at = :previous' if item else 'attribute_not_exists(pk)'
+        values = {
+            ':requests': _to_decimal(requests - 1 if rpm else 0),
+            ':tokens': _to_decimal(available_tokens - tokens_needed if tpm else 0),
+            ':now': now,
+            ':expires_at': now // 1000 + 3600
+        }
+        if item:
+            values[':previous'] = item['refilled_at']
+        try:
+            table.update_item(
+                Key=_key(model_arn),
+                UpdateExpression='SET requests = :requests, tokens = :tokens, refilled_at = :now, expires_at = :expires_at',
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values
+            )
+            return 0.0
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # Another worker took from the bucket in the meantime; re-read it
+
+    # Heavy contention: back off briefly rather than spin on the bucket
+    return 1.0
@@ -0,0 +1,112 @@
+import decimal
+import json
+import os
+import zlib
+from typing import Dict, Any, List, Optional
+
+from boto3.dynamodb.types import Binary
+
+import aws_clients
+
+# Results whose compressed form is bigger than this go to S3 instead of the
+# tracking record, well clear of DynamoDB's 400 KB item limit
+RESULT_INLINE_MAX_BYTES = int(os.environ.get('RESULT_INLINE_MAX_BYTES', str(100 * 1024)))
+RESULT_BUCKET = os.environ.get('RESULT_BUCKET')
+RESULT_KEY_PREFIX = 'results/'
+
+FORMAT_VERSION = 1
+INLINE_ATTRIBUTE = 'result_z'
+REFERENCE_ATTRIBUTE = 'result_ref'
+STORED_ATTRIBUTES = (INLINE_ATTRIBUTE, REFERENCE_ATTRIBUTE)
+
+# Transport details Bedrock returns alongside the answer
+_DROPPED_KEYS = ('ResponseMetadata',)
+
+
+def compact(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop transport metadata and store each retrieved reference once.
+
+    Citations keep their generated text and point at references by index,
+    since several citations usually quote the same chunks.
+    """
+    compacted = {key: value for key, value in result.items() if key not in _DROPPED_KEYS + ('citations',)}
+    references: List[Any] = []
+    positions: Dict[str, int] = {}
+    citations = []
+    for citation in result.get('citations') or []:
+        indexes = []
+        for reference in citation.get('retrievedReferences') or []:
+            fingerprint = json.dumps(reference, sort_keys=True, default=str)
+            if fingerprint not in positions:
+                positions[fingerprint] = len(references)
+                references.append(reference)
+            indexes.append(positions[fingerprint])
+        citations.append({
+            'generatedResponsePart': citation.get('generatedResponsePart'),
+            'refs': indexes
+        })
+    compacted['v'] = FORMAT_VERSION
+    compacted['citations'] = citations
+    compacted['references'] = references
+    return compacted
+
+
+def expand(compacted: Dict[str, Any]) -> Dict[str, Any]:
+    """Rebuild the retrieve_and_generate response shape the client renders."""
+    references = compacted.get('references', [])
+    result = {key: value for key, value in compacted.items() if key not in ('v', 'citations', 'references')}
+    result['citations'] = [
+        {
+            'generatedResponsePart': citation.get('generatedResponsePart'),
+            'retrievedReferences': [references[index] for index in citation.get('refs', [])]
+        }
+        for citation in compacted.get('citations', [])
+    ]
+    return result
+
+
+def to_dynamodb(value: Any) -> Any:
+    """Copy of a Bedrock response part that DynamoDB accepts: Decimal rather than float."""
+    return json.loads(json.dumps(value, default=str), parse_float=decimal.Decimal)
+
+
+def _encode(result: Dict[str, Any]) -> bytes:
+    body = json.dumps(compact(result), separators=(',', ':'), default=str)
+    return zlib.compress(body.encode('utf-8'))
+
+
+def _decode(data: bytes) -> Dict[str, Any]:
+    return expand(json.loads(zlib.decompress(data).decode('utf-8')))
+
+
+def encode(chatbot_request_id: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the record attributes that store a result.
+
+    The compressed result is kept on the record as a binary attribute, or in
+    S3 when it is too big, in which case the record only holds its key.
+    """
+    data = _encode(result)
+    if len(data) <= RESULT_INLINE_MAX_BYTES or not RESULT_BUCKET:
+        return {INLINE_ATTRIBUTE: Binary(data)}
+    key = f"{RESULT_KEY_PREFIX}{chatbot_request_id}.json.z"
+    aws_clients.s3().put_object(
+        Bucket=RESULT_BUCKET,
+        Key=key,
+        Body=data,
+        ContentType='application/octet-stream'
+    )
+    print(f"Result for {chatbot_request_id} stored in S3: {len(data)} bytes")
+    return {REFERENCE_ATTRIBUTE: key}
+
+
+def decode(item: Dict[str, Any]) -> Optional[Any]:
+    """Return the result held by a tracking record, whichever way it was stored."""
+    inline = item.get(INLINE_ATTRIBUTE)
+    if inline is not None:
+        return _decode(bytes(inline.value if isinstance(inline, Binary) else inline))
+    key = item.get(REFERENCE_ATTRIBUTE)
+    if key:
+        response = aws_clients.s3().get_object(Bucket=RESULT_BUCKET, Key=key)
+        return _decode(response['Body'].read())
+    # Errors, in-flight records and records written before compaction
+    return item.get('result')
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import zlib
+from time import time
+from typing import Dict, Any, List, Optional
+
+from boto3.dynamodb.types import Binary
+
+import answer_cache
+import aws_clients
+from local_cache import LocalTTLCache
+
+STATE_TABLE = os.environ.get('STATE_TABLE')
+
+# Retrieved chunks change only when the knowledge base is re-synced, so they
+# can be shared across models, templates and inference settings for a while
+RETRIEVAL_CACHE_TTL_SECONDS = int(os.environ.get('RETRIEVAL_CACHE_TTL_SECONDS', '900'))
+RETRIEVAL_CACHE_LOCAL_TTL_SECONDS = float(os.environ.get('RETRIEVAL_CACHE_LOCAL_TTL_SECONDS', '60'))
+RETRIEVAL_CACHE_LOCAL_SIZE = int(os.environ.get('RETRIEVAL_CACHE_LOCAL_SIZE', '64'))
+
+_local = LocalTTLCache(RETRIEVAL_CACHE_LOCAL_SIZE, RETRIEVAL_CACHE_LOCAL_TTL_SECONDS)
+
+
+def _now_ms() -> int:
+    return int(time() * 1000)
+
+
+def cache_key(knowledge_base_id: str, query: str, retrieval_config: Dict[str, Any]) -> str:
+    material = {
+        'knowledgeBaseId': knowledge_base_id,
+        'query': answer_cache.normalize_message(query),
+        'retrievalConfiguration': retrieval_config
+    }
+    encoded = json.dumps(material, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _entry_key(key: str) -> Dict[str, str]:
+    return {'pk': f"retrieval#{key}"}
+
+
+def _lookup(key: str, knowledge_base_id: str) -> Optional[List[Dict[str, Any]]]:
+    # The entry and the KB invalidation marker come back in one round trip,
+    # so DELETE /answer-cache drops cached chunks along with cached answers
+    response = aws_clients.state_table().meta.client.batch_get_item(
+        RequestItems={
+            STATE_TABLE: {
+                'Keys': [
+                    _entry_key(key),
+                    answer_cache.invalidation_key(knowledge_base_id)
+                ]
+            }
+        }
+    )
+    items = {
+        item['pk']: item
+        for item in response.get('Responses', {}).get(STATE_TABLE, [])
+    }
+    marker = items.get(answer_cache.invalidation_key(knowledge_base_id)['pk'], {})
+    entry = items.get(_entry_key(key)['pk'])
+    if (
+        not entry
+        or int(entry.get('expires_at', 0)) <= time()
+        or int(entry.get('created_at', 0)) <= int(marker.get('invalidated_at', 0))
+    ):
+        return None
+    return json.loads(zlib.decompress(bytes(entry['results'].value)).decode('utf-8'))
+
+
+def _store(key: str, knowledge_base_id: str, results: List[Dict[str, Any]]) -> None:
+    now = _now_ms()
+    body = json.dumps(results, separators=(',', ':'), default=str).encode('utf-8')
+    aws_clients.state_table().put_item(
+        Item={
+            **_entry_key(key),
+            'knowledgeBaseId': knowledge_base_id,
+            'results': Binary(zlib.compress(body)),
+            'created_at': now,
+            'expires_at': now // 1000 + RETRIEVAL_CACHE_TTL_SECONDS
+        }
+    )
+
+
+def retrieve(knowledge_base_id: str, query: str, retrieval_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return the knowledge base chunks for a query, from cache when possible."""
+    key = cache_key(knowledge_base_id, query, retrieval_config)
+    results = _local.get(key)
+    if results is not None:
+        return results
+
+    if STATE_TABLE:
+        results = _lookup(key, knowledge_base_id)
+        if results is not None:
+            _local.put(key, results)
+            return results
+
+    response = aws_clients.bedrock_agent_runtime().retrieve(
+        knowledgeBaseId=knowledge_base_id,
+        retrievalQuery={
+            'text': query
+        },
+        retrievalConfiguration=retrieval_config
+    )
+    results = [
+        {name: result[name] for name in ('content', 'location', 'metadata') if name in result}
+        for result in response.get('retrievalResults', [])
+    ]
+    if STATE_TABLE:
+        try:
+            _store(key, knowledge_base_id, results)
+        except Exception as e:
+            # The chunks are in hand; failing to cache them must not fail the job
+            print(f"Error caching retrieval results: {str(e)}")
+    _local.put(key, results)
+    return results
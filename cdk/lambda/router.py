@@ -0,0 +1,155 @@
+import hashlib
+import json
+import traceback
+from time import perf_counter
+from typing import Callable, Dict, Any, List, Optional
+
+import metrics
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': '*',
+    'Access-Control-Allow-Methods': 'GET,POST,DELETE,OPTIONS'
+}
+
+RouteHandler = Callable[[Dict[str, Any], Any], Dict[str, Any]]
+
+
+def json_response(status_code: int, body: Any, encoder: Optional[type] = None,
+                  headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**CORS_HEADERS, **(headers or {})},
+        'body': json.dumps(body, cls=encoder)
+    }
+
+
+def cacheable_json_response(event: Dict[str, Any], body: Any, max_age: int,
+                            encoder: Optional[type] = None) -> Dict[str, Any]:
+    """A 200 with an ETag, or an empty 304 when the client already holds that version."""
+    payload = json.dumps(body, cls=encoder)
+    etag = '"' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32] + '"'
+    headers = {
+        **CORS_HEADERS,
+        'ETag': etag,
+        'Cache-Control': f"private, max-age={int(max_age)}"
+    }
+    request_headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    if_none_match = request_headers.get('if-none-match') or ''
+    # Weak validators compare equal to strong ones for a GET
+    candidates = {tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')}
+    if etag in candidates or '*' in candidates:
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    return {'statusCode': 200, 'headers': headers, 'body': payload}
+
+
+def error_response(status_code: int, message: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return json_response(status_code, {'error': message}, headers=headers)
+
+
+def _normalize_path(path: Optional[str]) -> str:
+    if not path:
+        return '/'
+    return '/' + path.strip('/')
+
+
+class RouteStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms: float, is_error: bool) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        if is_error:
+            self.errors += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / self.count, 1) if self.count else 0.0,
+            'max_ms': round(self.max_ms, 1)
+        }
+
+
+class Route:
+    def __init__(self, method: str, path: str, handler: RouteHandler):
+        self.method = method.upper()
+        self.path = _normalize_path(path)
+        self.handler = handler
+        self.name = f"{self.method} {self.path}"
+        self.stats = RouteStats()
+
+
+class Router:
+    """Dispatches API Gateway proxy events through a declarative route table."""
+
+    def __init__(self):
+        self.routes: List[Route] = []
+        self._by_path: Dict[str, Dict[str, Route]] = {}
+
+    def add(self, method: str, path: str, handler: RouteHandler) -> Route:
+        route = Route(method, path, handler)
+        methods = self._by_path.setdefault(route.path, {})
+        if route.method in methods:
+            raise ValueError(f"Route already registered: {route.name}")
+        methods[route.method] = route
+        self.routes.append(route)
+        return route
+
+    def route(self, method: str, path: str) -> Callable[[RouteHandler], RouteHandler]:
+        def register(handler: RouteHandler) -> RouteHandler:
+            self.add(method, path, handler)
+            return handler
+        return register
+
+    def resolve(self, method: str, path: str) -> Dict[str, Any]:
+        methods = self._by_path.get(_normalize_path(path))
+        if methods is None:
+            return {'route': None, 'status_code': 404}
+        route = methods.get((method or '').upper())
+        if route is None:
+            return {'route': None, 'status_code': 405, 'allow': sorted(methods)}
+        return {'route': route, 'status_code': 200}
+
+    def dispatch(self, event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        method = event.get('httpMethod')
+        path = event.get('path')
+        match = self.resolve(method, path)
+        route = match['route']
+
+        if route is None:
+            if match['status_code'] == 405:
+                return error_response(405, 'Method not allowed', headers={'Allow': ','.join(match['allow'])})
+            return error_response(404, f"No route for {path}")
+
+        started = perf_counter()
+        response = None
+        try:
+            response = route.handler(event, context)
+            return response
+        except Exception as e:
+            traceback_str = traceback.format_exc()
+            print(traceback_str)
+            response = error_response(500, str(e))
+            return response
+        finally:
+            elapsed_ms = (perf_counter() - started) * 1000
+            status_code = response['statusCode'] if response else 500
+            route.stats.record(elapsed_ms, status_code >= 500)
+            metrics.emit(
+                {
+                    'Latency': (elapsed_ms, 'Milliseconds'),
+                    'Errors': (1 if status_code >= 500 else 0, 'Count'),
+                    'ClientErrors': (1 if 400 <= status_code < 500 else 0, 'Count')
+                },
+                {'Route': route.name},
+                properties={'StatusCode': status_code}
+            )
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {route.name: route.stats.as_dict() for route in self.routes}
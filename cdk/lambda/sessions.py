@@ -0,0 +1,46 @@
+import os
+from time import time
+from typing import Dict, Optional
+
+import aws_clients
+
+STATE_TABLE = os.environ.get('STATE_TABLE')
+ENABLED = bool(STATE_TABLE) and os.environ.get('SESSIONS_ENABLED', 'true').lower() == 'true'
+
+# A conversation left alone this long starts a fresh Bedrock session; the
+# state table's TTL removes the mapping afterwards
+SESSION_IDLE_SECONDS = int(os.environ.get('SESSION_IDLE_SECONDS', '1800'))
+MAX_CONVERSATION_ID_LENGTH = 128
+
+
+def conversation_key(user_id: Optional[str], conversation_id: str) -> str:
+    # Scoped to the caller so one user cannot continue another's session
+    return f"{user_id or 'anonymous'}#{str(conversation_id)[:MAX_CONVERSATION_ID_LENGTH]}"
+
+
+def _key(conversation_key: str) -> Dict[str, str]:
+    return {'pk': f"session#{conversation_key}"}
+
+
+def get(conversation_key: str) -> Optional[str]:
+    """Return the Bedrock sessionId of a live conversation, if it has one."""
+    response = aws_clients.state_table().get_item(
+        Key=_key(conversation_key),
+        ProjectionExpression='session_id, expires_at'
+    )
+    item = response.get('Item')
+    # TTL deletion lags, so expiry is checked here as well
+    if not item or int(item.get('expires_at', 0)) <= time():
+        return None
+    return item.get('session_id')
+
+
+def save(conversation_key: str, session_id: str) -> None:
+    """Remember a conversation's sessionId and push its idle expiry out."""
+    aws_clients.state_table().put_item(
+        Item={
+            **_key(conversation_key),
+            'session_id': session_id,
+            'expires_at': int(time()) + SESSION_IDLE_SECONDS
+        }
+    )
@@ -0,0 +1,123 @@
+import hashlib
+import os
+from time import time
+from typing import Dict, Optional
+
+import aws_clients
+from local_cache import LocalTTLCache
+
+STATE_TABLE = os.environ.get('STATE_TABLE')
+ENABLED = bool(STATE_TABLE)
+
+# Bump when the way templates are validated or filled changes, so ids made
+# under the old rules are never mistaken for ones made under the new
+TEMPLATE_VERSION = 1
+REQUIRED_PLACEHOLDERS = ('$search_results$',)
+
+# Stored templates live this long after they were last submitted
+TEMPLATE_TTL_SECONDS = int(os.environ.get('TEMPLATE_TTL_SECONDS', str(30 * 24 * 60 * 60)))
+# Template text never changes under an id; the local expiry only makes the
+# API re-register a template now and then to push its stored expiry out
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', '32'))
+TEMPLATE_CACHE_TTL_SECONDS = float(os.environ.get('TEMPLATE_CACHE_TTL_SECONDS', '3600'))
+
+DEFAULT_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompt_template.txt')
+
+_local = LocalTTLCache(TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_TTL_SECONDS)
+_default = {}
+
+
+class InvalidTemplate(ValueError):
+    pass
+
+
+class TemplateNotFound(LookupError):
+    pass
+
+
+def template_id(text: str) -> str:
+    return f"v{TEMPLATE_VERSION}-{hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]}"
+
+
+def validate(text: str) -> None:
+    missing = [placeholder for placeholder in REQUIRED_PLACEHOLDERS if placeholder not in text]
+    if missing:
+        raise InvalidTemplate(f"Prompt template is missing {', '.join(missing)}")
+
+
+def default_template() -> str:
+    """The bundled template, read and validated once per container."""
+    if 'text' not in _default:
+        with open(DEFAULT_TEMPLATE_PATH, 'r') as template_file:
+            text = template_file.read()
+        validate(text)
+        _default['id'] = template_id(text)
+        _default['text'] = text
+    return _default['text']
+
+
+def default_template_id() -> str:
+    default_template()
+    return _default['id']
+
+
+def _key(template_id: str) -> Dict[str, str]:
+    return {'pk': f"template#{template_id}"}
+
+
+def register(text: Optional[str]) -> str:
+    """Store a template once and return its id; no text means the default template."""
+    if not text:
+        return default_template_id()
+    identifier = template_id(text)
+    if identifier == default_template_id() or _local.get(identifier) is not None:
+        return identifier
+
+    validate(text)
+    # Re-registering only refreshes the expiry; the text under an id never changes
+    aws_clients.state_table().update_item(
+        Key=_key(identifier),
+        UpdateExpression='SET template_text = if_not_exists(template_text, :text), '
+                         'template_version = :version, expires_at = :expires_at',
+        ExpressionAttributeValues={
+            ':text': text,
+            ':version': TEMPLATE_VERSION,
+            ':expires_at': int(time()) + TEMPLATE_TTL_SECONDS
+        }
+    )
+    _local.put(identifier, text)
+    return identifier
+
+
+def template_reference(text: Optional[str]) -> Dict[str, str]:
+    """The job payload fields naming a template: its id, or the text itself without a registry."""
+    if not text or ENABLED:
+        return {'templateId': register(text)}
+    validate(text)
+    return {'textPromptTemplate': text}
+
+
+def resolve(template_id: str) -> str:
+    if template_id == default_template_id():
+        return default_template()
+    text = _local.get(template_id)
+    if text is not None:
+        return text
+
+    item = aws_clients.state_table().get_item(
+        Key=_key(template_id),
+        ProjectionExpression='template_text'
+    ).get('Item')
+    if not item:
+        raise TemplateNotFound(f"Prompt template {template_id} is not registered")
+    _local.put(template_id, item['template_text'])
+    return item['template_text']
+
+
+def template_for(payload: Dict[str, str]) -> str:
+    # Jobs queued before the registry existed carry the text inline
+    if payload.get('textPromptTemplate'):
+        return payload['textPromptTemplate']
+    if payload.get('templateId'):
+        return resolve(payload['templateId'])
+    return default_template()
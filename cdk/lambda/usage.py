@@ -0,0 +1,197 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from time import sleep, time
+from typing import Dict, Any, List, Optional, Tuple
+
+import aws_clients
+import model_router
+import rate_limiter
+from local_cache import LocalTTLCache
+
+STATE_TABLE = os.environ.get('STATE_TABLE')
+ENABLED = bool(STATE_TABLE) and os.environ.get('USAGE_ENABLED', 'true').lower() == 'true'
+
+# Daily counters are kept this long before the state table's TTL removes them
+USAGE_TTL_SECONDS = int(os.environ.get('USAGE_TTL_SECONDS', str(90 * 24 * 60 * 60)))
+MAX_USAGE_DAYS = 31
+
+# Per-user daily quotas, e.g.
+#   {"*": {"daily_tokens": 2000000, "daily_requests": 1000},
+#    "claude-3-5-sonnet": {"daily_tokens": 200000}}
+# "*" caps a user's total across models; other keys match model ids as a
+# substring, the most specific one wins. No quota means unlimited.
+USAGE_QUOTAS: Dict[str, Dict[str, int]] = json.loads(os.environ.get('USAGE_QUOTAS') or '{}')
+# A user over a model's quota is moved to this model instead of being
+# rejected; empty rejects
+DOWNGRADE_MODEL_ARN = os.environ.get('USAGE_DOWNGRADE_MODEL_ARN', '')
+# Quota checks may read counters this stale, saving a read per request
+QUOTA_CACHE_SECONDS = float(os.environ.get('USAGE_QUOTA_CACHE_SECONDS', '30'))
+
+COUNTERS = ('requests', 'input_tokens', 'output_tokens', 'generation_ms')
+TOTAL = '*'
+
+_local = LocalTTLCache(256, QUOTA_CACHE_SECONDS)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _day(timestamp: Optional[float] = None) -> str:
+    return datetime.fromtimestamp(time() if timestamp is None else timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+
+def seconds_until_reset() -> int:
+    """Seconds until the daily counters start over at midnight UTC."""
+    now = datetime.now(timezone.utc)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(1, int((midnight - now).total_seconds()))
+
+
+def _user_key(user_sub: Optional[str], day: str) -> Dict[str, str]:
+    return {'pk': f"usage#user#{user_sub or 'anonymous'}#{day}"}
+
+
+def _model_key(model: str, day: str) -> Dict[str, str]:
+    return {'pk': f"usage#model#{model}#{day}"}
+
+
+def measure(response: Dict[str, Any], prompt_text: str, generation_ms: float) -> Dict[str, Any]:
+    """Token counts and generation time of one answer.
+
+    Converse reports real token counts; retrieve_and_generate reports none, so
+    they are estimated from the text the way the rate limiter charges them.
+    """
+    reported = response.get('usage') or {}
+    if reported.get('inputTokens') is not None:
+        return {
+            'input_tokens': int(reported['inputTokens']),
+            'output_tokens': int(reported.get('outputTokens') or 0),
+            'generation_ms': int(generation_ms),
+            'usage_estimated': False
+        }
+    text = (response.get('output') or {}).get('text') or ''
+    return {
+        'input_tokens': len(prompt_text or '') // rate_limiter.CHARS_PER_TOKEN + rate_limiter.RETRIEVED_CONTEXT_TOKENS,
+        'output_tokens': len(text) // rate_limiter.CHARS_PER_TOKEN,
+        'generation_ms': int(generation_ms),
+        'usage_estimated': True
+    }
+
+
+def _add(key: Dict[str, str], measured: Dict[str, Any], models: List[str], extra: Dict[str, str]) -> None:
+    names = {}
+    values = {':expires_at': int(time()) + USAGE_TTL_SECONDS}
+    additions = []
+    for counter in COUNTERS:
+        values[f":{counter}"] = 1 if counter == 'requests' else measured[counter]
+        for position, model in enumerate(models):
+            names[f"#{counter}{position}"] = f"{counter}#{model}"
+            additions.append(f"#{counter}{position} :{counter}")
+    assignments = ['expires_at = if_not_exists(expires_at, :expires_at)']
+    for attribute, value in extra.items():
+        assignments.append(f"{attribute} = :{attribute}")
+        values[f":{attribute}"] = value
+    aws_clients.state_table().update_item(
+        Key=key,
+        UpdateExpression=f"ADD {', '.join(additions)} SET {', '.join(assignments)}",
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def record(user_sub: Optional[str], model_arn: str, measured: Dict[str, Any]) -> None:
+    """Add one answer to the user's and the model's counters for today; never raises."""
+    if not ENABLED:
+        return
+    day = _day()
+    model = model_router.model_id(model_arn)
+    try:
+        # Atomic ADDs, so concurrent workers never lose an update
+        _add(_user_key(user_sub, day), measured, [TOTAL, model], {'usage_date': day})
+        _add(_model_key(model, day), measured, [TOTAL], {'usage_date': day})
+    except Exception as e:
+        print(f"Error recording usage for {user_sub}: {str(e)}")
+    _local.discard((user_sub, day))
+
+
+def _parse(item: Dict[str, Any]) -> Dict[str, Any]:
+    models: Dict[str, Dict[str, int]] = {}
+    for attribute, value in item.items():
+        counter, separator, model = attribute.partition('#')
+        if separator and counter in COUNTERS:
+            models.setdefault(model, dict.fromkeys(COUNTERS, 0))[counter] = int(value)
+    totals = models.pop(TOTAL, dict.fromkeys(COUNTERS, 0))
+    return {**totals, 'models': models}
+
+
+def daily_usage(user_sub: str, days: int) -> List[Dict[str, Any]]:
+    """The user's counters for the last `days` days, newest first; days without use are left out."""
+    now = time()
+    dates = [_day(now - offset * 24 * 60 * 60) for offset in range(min(days, MAX_USAGE_DAYS))]
+    table = aws_clients.state_table()
+    items = {}
+    request_items = {table.name: {'Keys': [_user_key(user_sub, day) for day in dates]}}
+    for attempt in range(3):
+        response = table.meta.client.batch_get_item(RequestItems=request_items)
+        for item in response.get('Responses', {}).get(table.name, []):
+            items[item['pk']] = item
+        request_items = response.get('UnprocessedKeys')
+        if not request_items:
+            break
+        sleep(0.05 * (2 ** attempt))
+    return [
+        {'date': day, **_parse(items[_user_key(user_sub, day)['pk']])}
+        for day in dates if _user_key(user_sub, day)['pk'] in items
+    ]
+
+
+def _today(user_sub: str) -> Dict[str, Any]:
+    day = _day()
+    usage = _local.get((user_sub, day))
+    if usage is None:
+        response = aws_clients.state_table().get_item(Key=_user_key(user_sub, day))
+        usage = _parse(response.get('Item') or {})
+        _local.put((user_sub, day), usage)
+    return usage
+
+
+def quota_for(model_arn: str) -> Optional[Dict[str, int]]:
+    model = model_router.model_id(model_arn or '')
+    matches = [key for key in USAGE_QUOTAS if key != TOTAL and key in model]
+    return USAGE_QUOTAS[max(matches, key=len)] if matches else None
+
+
+def _over(usage: Dict[str, int], quota: Optional[Dict[str, int]]) -> bool:
+    if not quota:
+        return False
+    tokens = usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+    return (
+        bool(quota.get('daily_tokens')) and tokens >= quota['daily_tokens']
+        or bool(quota.get('daily_requests')) and usage.get('requests', 0) >= quota['daily_requests']
+    )
+
+
+def check(user_sub: Optional[str], model_arn: str) -> Tuple[str, bool]:
+    """Return the model a user's request may use and whether it was downgraded.
+
+    Raises QuotaExceeded when the user is over a quota that no downgrade
+    gets them under. Callers who are not signed in share one usage bucket
+    and are not held to per-user quotas.
+    """
+    if not ENABLED or not USAGE_QUOTAS or not user_sub:
+        return model_arn, False
+    usage = _today(user_sub)
+    if _over(usage, USAGE_QUOTAS.get(TOTAL)):
+        raise QuotaExceeded('Daily usage quota exceeded')
+
+    def model_usage(arn):
+        return usage['models'].get(model_router.model_id(arn), {})
+
+    if not _over(model_usage(model_arn), quota_for(model_arn)):
+        return model_arn, False
+    if (DOWNGRADE_MODEL_ARN and DOWNGRADE_MODEL_ARN != model_arn
+            and not _over(model_usage(DOWNGRADE_MODEL_ARN), quota_for(DOWNGRADE_MODEL_ARN))):
+        return DOWNGRADE_MODEL_ARN, True
+    raise QuotaExceeded(f"Daily usage quota for {model_router.model_id(model_arn)} exceeded")
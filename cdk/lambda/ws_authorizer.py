@@ -0,0 +1,57 @@
+import base64
+import json
+import os
+import traceback
+from typing import Dict, Any, Optional
+
+import aws_clients
+
+USER_POOL_ID = os.environ.get('USER_POOL_ID', '')
+USER_POOL_CLIENT_ID = os.environ.get('USER_POOL_CLIENT_ID', '')
+
+
+def _claims(token: str) -> Dict[str, Any]:
+    # Only read once GetUser has accepted the token, which checks its signature
+    payload = token.split('.')[1]
+    return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+
+
+def authorize(token: str) -> Optional[str]:
+    """Return the Cognito subject of an access token issued to the app client, or None."""
+    try:
+        # Rejects tokens that are forged, expired or revoked by a sign out
+        user = aws_clients.client('cognito-idp').get_user(AccessToken=token)
+        claims = _claims(token)
+    except Exception:
+        print(traceback.format_exc())
+        return None
+    region = USER_POOL_ID.split('_')[0]
+    if claims.get('iss') != f"https://cognito-idp.{region}.amazonaws.com/{USER_POOL_ID}":
+        return None
+    if claims.get('client_id') != USER_POOL_CLIENT_ID or claims.get('token_use') != 'access':
+        return None
+    attributes = {attribute['Name']: attribute['Value'] for attribute in user.get('UserAttributes', [])}
+    return attributes.get('sub')
+
+
+def handler(event, context):
+    # Browsers cannot set headers on a WebSocket, so the token comes in the query string
+    token = (event.get('queryStringParameters') or {}).get('token')
+    user_sub = authorize(token) if token else None
+    if not user_sub:
+        # API Gateway answers 401 and closes the connection
+        raise Exception('Unauthorized')
+    return {
+        'principalId': user_sub,
+        'policyDocument': {
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Action': 'execute-api:Invoke',
+                'Effect': 'Allow',
+                'Resource': event['methodArn']
+            }]
+        },
+        'context': {
+            'sub': user_sub
+        }
+    }
@@ -0,0 +1,69 @@
+import json
+import traceback
+
+import aws_clients
+import index
+import notifications
+
+# Statuses a client gets pushed right away when it subscribes late
+PUSHED_ON_SUBSCRIBE = ('success', 'error', 'streaming')
+
+
+def record_owner(chatbot_request_id):
+    """Return (exists, user_sub) of a request's record."""
+    item = aws_clients.tracking_table().get_item(
+        Key={'chatbot_request_id': str(chatbot_request_id)},
+        ProjectionExpression='chatbot_request_id, user_sub'
+    ).get('Item')
+    return (item is not None, (item or {}).get('user_sub'))
+
+
+def connect(connection_id, request_context):
+    # The $connect authorizer put the caller's Cognito subject in the context
+    user_sub = (request_context.get('authorizer') or {}).get('sub')
+    if not user_sub:
+        return {'statusCode': 403}
+    notifications.register_connection(connection_id, user_sub)
+    return {'statusCode': 200}
+
+
+def subscribe(connection_id, body):
+    chatbot_request_id = body.get('chatbot_request_id')
+    if not chatbot_request_id:
+        return {'statusCode': 400, 'body': 'chatbot_request_id is required'}
+
+    user_sub = notifications.connection_owner(connection_id)
+    exists, owner = record_owner(chatbot_request_id)
+    if not exists:
+        return {'statusCode': 404, 'body': 'Request not found'}
+    # Answers are only pushed to the user who asked
+    if not user_sub or owner != user_sub:
+        return {'statusCode': 403, 'body': 'Forbidden'}
+    if not notifications.subscribe(chatbot_request_id, connection_id, user_sub):
+        return {'statusCode': 409, 'body': 'Already subscribed'}
+    # The job may have finished before the client subscribed; the worker
+    # reads the subscription after writing the record, so one side sees the other
+    record = index.get_record(chatbot_request_id, user_sub)
+    if record and record['status'] in PUSHED_ON_SUBSCRIBE:
+        notifications.push(connection_id, json.loads(json.dumps(record, cls=index.CustomJSONEncoder)))
+    return {'statusCode': 200}
+
+
+def handler(event, context):
+    request_context = event.get('requestContext', {})
+    route_key = request_context.get('routeKey')
+    connection_id = request_context.get('connectionId')
+
+    try:
+        if route_key == '$connect':
+            return connect(connection_id, request_context)
+        if route_key == '$disconnect':
+            # Subscriptions expire on their own
+            notifications.forget_connection(connection_id)
+            return {'statusCode': 200}
+        if route_key == 'subscribe':
+            return subscribe(connection_id, json.loads(event.get('body') or '{}'))
+        return {'statusCode': 400, 'body': f"Unknown action: {route_key}"}
+    except Exception:
+        print(traceback.format_exc())
+        return {'statusCode': 500}
@@ -1,10 +1,14 @@
 import aws_cdk
 from constructs import Construct
+from typing import Optional
 from aws_cdk import (
     SecretValue,
     Stack,
     aws_cognito as cognito,
     aws_apigateway as apigateway,
+    aws_apigatewayv2 as apigatewayv2,
+    aws_apigatewayv2_authorizers as apigatewayv2_authorizers,
+    aws_apigatewayv2_integrations as apigatewayv2_integrations,
     aws_lambda as lambda_,
     aws_s3 as s3,
     aws_iam as iam,
@@ -16,8 +20,11 @@ from aws_cdk import (
     RemovalPolicy,
 )
 
+from stacks.worker_pipeline import DEFAULT_WORKER_PROFILE, WorkerPerformanceProfile, WorkerPipeline
+
 class MainStack(Stack):
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str,
+                 worker_profile: Optional[WorkerPerformanceProfile] = None, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         # Create Cognito User Pool
@@ -111,6 +118,9 @@ class MainStack(Stack):
             )
         )
 
+        # How long requests and their answers are kept for a user's history
+        record_retention = Duration.days(30)
+
         # Create DynamoDB table
         dynamodb_table = aws_cdk.aws_dynamodb.Table(
             self, "AvaDataTable",
@@ -119,15 +129,53 @@ class MainStack(Stack):
                 name="chatbot_request_id", 
                 type=aws_cdk.aws_dynamodb.AttributeType.STRING
             ),
+            time_to_live_attribute="expires_at",
             removal_policy=RemovalPolicy.DESTROY,
             billing_mode=aws_cdk.aws_dynamodb.BillingMode.PAY_PER_REQUEST,
         )
-        # Create SQS Queue
-        queue = aws_cdk.aws_sqs.Queue(
-            self, "AvaQueue",
-            visibility_timeout=Duration.seconds(300),
-            retention_period=Duration.days(14)
+        # A user's requests, newest first, for GET /chatbot/history. Only
+        # records with a user_sub are indexed.
+        dynamodb_table.add_global_secondary_index(
+            index_name="user-history",
+            partition_key=aws_cdk.aws_dynamodb.Attribute(
+                name="user_sub",
+                type=aws_cdk.aws_dynamodb.AttributeType.STRING
+            ),
+            sort_key=aws_cdk.aws_dynamodb.Attribute(
+                name="created_at",
+                type=aws_cdk.aws_dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=aws_cdk.aws_dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["status", "message", "knowledge_base_id"]
         )
+        # Shared state for caches and coordination between requests
+        state_table = aws_cdk.aws_dynamodb.Table(
+            self, "AvaStateTable",
+            table_name="ava-chatbot-state-table",
+            partition_key=aws_cdk.aws_dynamodb.Attribute(
+                name="pk",
+                type=aws_cdk.aws_dynamodb.AttributeType.STRING
+            ),
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+            billing_mode=aws_cdk.aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+        # Answers too large for a tracking record; they live as long as the
+        # record that points at them
+        result_bucket = s3.Bucket(
+            self, "AvaResultBucket",
+            block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            encryption=s3.BucketEncryption.S3_MANAGED,
+            enforce_ssl=True,
+            lifecycle_rules=[
+                s3.LifecycleRule(prefix="results/", expiration=record_retention)
+            ],
+            removal_policy=RemovalPolicy.DESTROY,
+            auto_delete_objects=True
+        )
+        # Job queue, dead-letter queue and worker capacity; see worker_pipeline.py
+        worker_pipeline = WorkerPipeline(self, "WorkerPipeline", worker_profile or DEFAULT_WORKER_PROFILE)
+        queue = worker_pipeline.queue
 
         # Create main Lambda function
         lambda_function = lambda_.Function(
@@ -140,7 +188,14 @@ class MainStack(Stack):
             timeout=Duration.seconds(30),
             environment={
                 "DYNAMODB_TABLE": dynamodb_table.table_name,
-                "SQS_QUEUE_URL": queue.queue_url
+                "STATE_TABLE": state_table.table_name,
+                "RESULT_BUCKET": result_bucket.bucket_name,
+                "SQS_QUEUE_URL": queue.queue_url,
+                "RECORD_TTL_SECONDS": str(int(record_retention.to_seconds())),
+                "HISTORY_INDEX": "user-history",
+                # Per-user daily {"daily_tokens": ..., "daily_requests": ...} quotas; see usage.py
+                "USAGE_QUOTAS": "{}",
+                "USAGE_DOWNGRADE_MODEL_ARN": ""
             }
         )
 
@@ -157,7 +212,12 @@ class MainStack(Stack):
         # Add SQS permissions
         queue_handler_role.add_to_policy(
             iam.PolicyStatement(
-                actions=["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes"],
+                actions=[
+                    "sqs:ReceiveMessage",
+                    "sqs:DeleteMessage",
+                    "sqs:GetQueueAttributes",
+                    "sqs:ChangeMessageVisibility"
+                ],
                 resources=[queue.queue_arn]
             )
         )
@@ -218,22 +278,93 @@ class MainStack(Stack):
             handler="queue_handler.handler",
             code=lambda_.Code.from_asset("lambda"),
             role=queue_handler_role,
-            timeout=Duration.seconds(30),
+            **worker_pipeline.function_options(),
             environment={
                 "DYNAMODB_TABLE": dynamodb_table.table_name,
-                "SQS_QUEUE_URL": queue.queue_url
+                "STATE_TABLE": state_table.table_name,
+                "RESULT_BUCKET": result_bucket.bucket_name,
+                "SQS_QUEUE_URL": queue.queue_url,
+                **worker_pipeline.environment(),
+                "WORKER_STREAMING": "true",
+                "WORKER_SPLIT_RETRIEVAL": "false",
+                # Per-model {"rpm": ..., "tpm": ...} budgets; see rate_limiter.py
+                "MODEL_RATE_LIMITS": "{}",
+                # Equivalent profiles and models a job may be routed to; see model_router.py
+                "MODEL_ROUTES": "{}",
+                "ROUTE_TO_FOUNDATION_MODELS": "false"
             }
         )
 
-        # Add SQS trigger to queue handler Lambda
-        queue_handler.add_event_source(
-            aws_cdk.aws_lambda_event_sources.SqsEventSource(queue)
+        # WebSocket API that pushes finished answers to the client, so polling
+        # is only a fallback. Connections are authorized with the user's Cognito
+        # access token and may only subscribe to their own requests.
+        websocket_authorizer_function = lambda_.Function(
+            self, "AvaWebSocketAuthorizerFunction",
+            function_name="ava-websocket-authorizer-lambda-function",
+            runtime=lambda_.Runtime.PYTHON_3_13,
+            handler="ws_authorizer.handler",
+            code=lambda_.Code.from_asset("lambda"),
+            timeout=Duration.seconds(10),
+            environment={
+                "USER_POOL_ID": user_pool.user_pool_id,
+                "USER_POOL_CLIENT_ID": user_pool_client.user_pool_client_id
+            }
+        )
+        websocket_function = lambda_.Function(
+            self, "AvaWebSocketFunction",
+            function_name="ava-websocket-lambda-function",
+            runtime=lambda_.Runtime.PYTHON_3_13,
+            handler="ws_handler.handler",
+            code=lambda_.Code.from_asset("lambda"),
+            timeout=Duration.seconds(10),
+            environment={
+                "DYNAMODB_TABLE": dynamodb_table.table_name,
+                "STATE_TABLE": state_table.table_name,
+                "RESULT_BUCKET": result_bucket.bucket_name
+            }
+        )
+        websocket_integration = apigatewayv2_integrations.WebSocketLambdaIntegration(
+            "AvaWebSocketIntegration", websocket_function
+        )
+        websocket_api = apigatewayv2.WebSocketApi(
+            self, "AvaWebSocketApi",
+            api_name="ava-websocket-api",
+            connect_route_options=apigatewayv2.WebSocketRouteOptions(
+                integration=websocket_integration,
+                authorizer=apigatewayv2_authorizers.WebSocketLambdaAuthorizer(
+                    "AvaWebSocketAuthorizer", websocket_authorizer_function,
+                    identity_source=["route.request.querystring.token"]
+                )
+            ),
+            disconnect_route_options=apigatewayv2.WebSocketRouteOptions(integration=websocket_integration)
         )
+        websocket_api.add_route("subscribe", integration=websocket_integration)
+        websocket_stage = apigatewayv2.WebSocketStage(
+            self, "AvaWebSocketStage",
+            web_socket_api=websocket_api,
+            stage_name="prod",
+            auto_deploy=True
+        )
+        for function in (websocket_function, queue_handler):
+            function.add_environment("WEBSOCKET_ENDPOINT", websocket_stage.callback_url)
+            websocket_stage.grant_management_api_access(function)
+        dynamodb_table.grant_read_data(websocket_function)
+        state_table.grant_read_write_data(websocket_function)
+        result_bucket.grant_read(websocket_function)
+
+        # Add SQS trigger to queue handler Lambda
+        worker_pipeline.connect(queue_handler)
 
         # Add DynamoDB permissions to main Lambda
         dynamodb_table.grant_write_data(lambda_function)
         dynamodb_table.grant_read_data(lambda_function)
         dynamodb_table.grant_read_data(queue_handler)
+        state_table.grant_read_write_data(lambda_function)
+        state_table.grant_read_write_data(queue_handler)
+        result_bucket.grant_read(lambda_function)
+        # Inline answers too big for their record overflow to the bucket as well
+        result_bucket.grant_put(lambda_function)
+        result_bucket.grant_put(queue_handler)
 
         # Add SQS permissions to main Lambda
         queue.grant_send_messages(lambda_function)
@@ -301,6 +432,39 @@ class MainStack(Stack):
             authorizer=auth
         )   
 
+        chatbot_batch = chatbot.add_resource("batch")
+        for method in ("GET", "POST"):
+            chatbot_batch.add_method(
+                method,
+                integration=api_integration,
+                authorization_type=apigateway.AuthorizationType.COGNITO,
+                authorizer=auth
+            )
+
+        chatbot_history = chatbot.add_resource("history")
+        chatbot_history.add_method(
+            "GET",
+            integration=api_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=auth
+        )
+
+        usage = api.root.add_resource("usage")
+        usage.add_method(
+            "GET",
+            integration=api_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=auth
+        )
+
+        answer_cache = api.root.add_resource("answer-cache")
+        answer_cache.add_method(
+            "DELETE",
+            integration=api_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=auth
+        )
+
         # Create separate API Gateway for Vue.js Chatbot (Regional/Public)
         vuejs_api = apigateway.RestApi(
             self, "AvaApiVueJs",
@@ -369,6 +533,39 @@ class MainStack(Stack):
             authorizer=vuejs_auth
         )
 
+        vuejs_chatbot_batch = vuejs_chatbot.add_resource("batch")
+        for method in ("GET", "POST"):
+            vuejs_chatbot_batch.add_method(
+                method,
+                integration=vuejs_api_integration,
+                authorization_type=apigateway.AuthorizationType.COGNITO,
+                authorizer=vuejs_auth
+            )
+
+        vuejs_chatbot_history = vuejs_chatbot.add_resource("history")
+        vuejs_chatbot_history.add_method(
+            "GET",
+            integration=vuejs_api_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=vuejs_auth
+        )
+
+        vuejs_usage = vuejs_api.root.add_resource("usage")
+        vuejs_usage.add_method(
+            "GET",
+            integration=vuejs_api_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=vuejs_auth
+        )
+
+        vuejs_answer_cache = vuejs_api.root.add_resource("answer-cache")
+        vuejs_answer_cache.add_method(
+            "DELETE",
+            integration=vuejs_api_integration,
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=vuejs_auth
+        )
+
 
 
 
@@ -417,5 +614,7 @@ class MainStack(Stack):
         CfnOutput(self, "IdentityPoolId", value=identity_pool.ref)
         CfnOutput(self, "ApiUrl", value=api.url)
         CfnOutput(self, "VueJsApiUrl", value=vuejs_api.url)
+        CfnOutput(self, "WebSocketUrl", value=websocket_stage.url)
+        CfnOutput(self, "DeadLetterQueueUrl", value=worker_pipeline.dead_letter_queue.queue_url)
    
      
\ No newline at end of file
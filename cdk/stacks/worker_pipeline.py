@@ -0,0 +1,133 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from aws_cdk import (
+    Duration,
+    aws_lambda as lambda_,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_sqs as sqs,
+)
+from constructs import Construct
+
+# Limits of SQS and of Lambda's SQS event source
+MAX_VISIBILITY_TIMEOUT_SECONDS = 12 * 60 * 60
+MAX_BATCH_SIZE = 10000
+MAX_BATCH_SIZE_WITHOUT_WINDOW = 10
+MIN_MAX_CONCURRENCY = 2
+MAX_MAX_CONCURRENCY = 1000
+MAX_LAMBDA_TIMEOUT_SECONDS = 900
+
+
+@dataclass(frozen=True)
+class WorkerPerformanceProfile:
+    """Capacity settings for the queue worker, kept in one place so changes are reviewed as data."""
+
+    # Lambda
+    memory_size_mb: int = 512
+    # Long enough for a streamed 4096-token answer from the slowest model
+    timeout_seconds: int = 180
+    # Concurrent invocations the SQS pollers may start; Bedrock quotas, not
+    # Lambda, are what runs out first
+    max_concurrency: int = 10
+    reserved_concurrency: Optional[int] = None
+    # Records of one batch processed in parallel inside an invocation
+    worker_threads: int = 10
+
+    # Event source
+    batch_size: int = 10
+    # Waiting to fill a batch adds latency to every request, so it is off
+    max_batching_window_seconds: int = 0
+
+    # Queue. AWS recommends a visibility timeout of six times the function
+    # timeout, so a batch that is retried by Lambda is not handed out twice.
+    visibility_timeout_multiplier: int = 6
+    retention_days: int = 14
+
+    # Redrive. A message is received once per attempt and once per deferral
+    # (rate limit or open circuit), so both have to fit before the DLQ. The
+    # worker fails a job delivered more often than that, so a record is never
+    # left processing while its message sits in the DLQ.
+    retry_max_attempts: int = 5
+    max_deferrals: int = 10
+    max_receive_count: int = 20
+    dlq_retention_days: int = 14
+
+    @property
+    def visibility_timeout_seconds(self) -> int:
+        return self.timeout_seconds * self.visibility_timeout_multiplier + self.max_batching_window_seconds
+
+    def validate(self) -> None:
+        if not 1 <= self.timeout_seconds <= MAX_LAMBDA_TIMEOUT_SECONDS:
+            raise ValueError(f"timeout_seconds must be between 1 and {MAX_LAMBDA_TIMEOUT_SECONDS}")
+        if self.visibility_timeout_seconds > MAX_VISIBILITY_TIMEOUT_SECONDS:
+            raise ValueError("visibility timeout derived from timeout_seconds exceeds the SQS maximum")
+        if self.visibility_timeout_multiplier < 1:
+            raise ValueError("visibility_timeout_multiplier must be at least 1")
+        if not 1 <= self.batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+        if self.batch_size > MAX_BATCH_SIZE_WITHOUT_WINDOW and self.max_batching_window_seconds < 1:
+            raise ValueError(f"batch_size above {MAX_BATCH_SIZE_WITHOUT_WINDOW} needs a batching window")
+        if not 0 <= self.max_batching_window_seconds <= 300:
+            raise ValueError("max_batching_window_seconds must be between 0 and 300")
+        if not MIN_MAX_CONCURRENCY <= self.max_concurrency <= MAX_MAX_CONCURRENCY:
+            raise ValueError(f"max_concurrency must be between {MIN_MAX_CONCURRENCY} and {MAX_MAX_CONCURRENCY}")
+        if self.reserved_concurrency is not None and self.reserved_concurrency < self.max_concurrency:
+            # The pollers would keep invoking a function that is throttled
+            raise ValueError("reserved_concurrency must be at least max_concurrency")
+        if self.max_receive_count <= self.retry_max_attempts + self.max_deferrals:
+            raise ValueError("max_receive_count must exceed retry_max_attempts plus max_deferrals")
+        if self.worker_threads < 1:
+            raise ValueError("worker_threads must be at least 1")
+
+
+DEFAULT_WORKER_PROFILE = WorkerPerformanceProfile()
+
+
+class WorkerPipeline(Construct):
+    """The job queue, its dead-letter queue and the worker's event source, sized by a profile."""
+
+    def __init__(self, scope: Construct, construct_id: str, profile: WorkerPerformanceProfile) -> None:
+        super().__init__(scope, construct_id)
+        profile.validate()
+        self.profile = profile
+
+        self.dead_letter_queue = sqs.Queue(
+            self, "DeadLetterQueue",
+            retention_period=Duration.days(profile.dlq_retention_days)
+        )
+        self.queue = sqs.Queue(
+            self, "Queue",
+            visibility_timeout=Duration.seconds(profile.visibility_timeout_seconds),
+            retention_period=Duration.days(profile.retention_days),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=profile.max_receive_count,
+                queue=self.dead_letter_queue
+            )
+        )
+
+    def function_options(self) -> dict:
+        """Keyword arguments for the worker's lambda_.Function."""
+        return {
+            'memory_size': self.profile.memory_size_mb,
+            'timeout': Duration.seconds(self.profile.timeout_seconds),
+            'reserved_concurrent_executions': self.profile.reserved_concurrency
+        }
+
+    def environment(self) -> dict:
+        return {
+            'WORKER_CONCURRENCY': str(self.profile.worker_threads),
+            'RETRY_MAX_ATTEMPTS': str(self.profile.retry_max_attempts),
+            'MAX_DEFERRALS': str(self.profile.max_deferrals)
+        }
+
+    def connect(self, worker: lambda_.Function) -> None:
+        worker.add_event_source(lambda_event_sources.SqsEventSource(
+            self.queue,
+            batch_size=self.profile.batch_size,
+            max_batching_window=(
+                Duration.seconds(self.profile.max_batching_window_seconds)
+                if self.profile.max_batching_window_seconds else None
+            ),
+            max_concurrency=self.profile.max_concurrency,
+            report_batch_item_failures=True
+        ))
@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+# The Lambda handlers are flat modules, imported the way the Lambda runtime does
+LAMBDA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lambda'))
+sys.path.insert(0, LAMBDA_DIR)
+
+TRACKING_TABLE = 'ava-test-tracking'
+STATE_TABLE = 'ava-test-state'
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Tracking table, state table and job queue in moto, with fresh clients."""
+    moto = pytest.importorskip('moto')
+    for name, value in {
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'DYNAMODB_TABLE': TRACKING_TABLE,
+        'STATE_TABLE': STATE_TABLE
+    }.items():
+        monkeypatch.setenv(name, value)
+
+    import aws_clients
+    import metrics
+    monkeypatch.setattr(metrics, 'METRICS_ENABLED', False)
+
+    with moto.mock_aws():
+        import boto3
+        dynamodb = boto3.client('dynamodb')
+        dynamodb.create_table(
+            TableName=TRACKING_TABLE,
+            KeySchema=[{'AttributeName': 'chatbot_request_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'chatbot_request_id', 'AttributeType': 'S'},
+                {'AttributeName': 'user_sub', 'AttributeType': 'S'},
+                {'AttributeName': 'created_at', 'AttributeType': 'N'}
+            ],
+            # The same per-user history index MainStack adds
+            GlobalSecondaryIndexes=[{
+                'IndexName': 'user-history',
+                'KeySchema': [
+                    {'AttributeName': 'user_sub', 'KeyType': 'HASH'},
+                    {'AttributeName': 'created_at', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {
+                    'ProjectionType': 'INCLUDE',
+                    'NonKeyAttributes': ['status', 'message', 'knowledge_base_id']
+                }
+            }],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        dynamodb.create_table(
+            TableName=STATE_TABLE,
+            KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        queue_url = boto3.client('sqs').create_queue(QueueName='ava-test-queue')['QueueUrl']
+        aws_clients.reset()
+        yield queue_url
+        aws_clients.reset()
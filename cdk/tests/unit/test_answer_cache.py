@@ -0,0 +1,121 @@
+import json
+import os
+
+import boto3
+import pytest
+
+import answer_cache
+import aws_clients
+import fast_path
+import index
+import queue_handler
+import result_store
+
+RESULT = {'output': {'text': 'The tone was upbeat.'}, 'citations': []}
+
+
+@pytest.fixture
+def cache(aws, monkeypatch):
+    monkeypatch.setattr(answer_cache, 'STATE_TABLE', os.environ['STATE_TABLE'])
+    answer_cache._local.clear()
+    yield
+    answer_cache._local.clear()
+
+
+def expire_claim(cache_key):
+    aws_clients.state_table().update_item(
+        Key=answer_cache._entry_key(cache_key),
+        UpdateExpression='SET expires_at = :expired',
+        ExpressionAttributeValues={':expired': 0}
+    )
+
+
+def test_identical_requests_wait_on_the_first(cache):
+    assert answer_cache.claim('k1', 'kb1', 'owner') == (answer_cache.OWNER, None)
+    assert answer_cache.claim('k1', 'kb1', 'waiter') == (answer_cache.WAITER, None)
+
+    assert answer_cache.complete('k1', 'owner', RESULT) == ['waiter']
+    assert answer_cache.claim('k1', 'kb1', 'late') == (answer_cache.HIT, RESULT)
+    assert answer_cache.lookup('k1', 'kb1') == (RESULT, 0)
+
+
+def test_takeover_keeps_the_waiters_of_an_expired_claim(cache):
+    answer_cache.claim('k1', 'kb1', 'owner1')
+    answer_cache.claim('k1', 'kb1', 'waiter1')
+    expire_claim('k1')
+
+    assert answer_cache.claim('k1', 'kb1', 'owner2') == (answer_cache.OWNER, None)
+    answer_cache.claim('k1', 'kb1', 'waiter2')
+
+    # The first owner lost the entry; the one that took it over answers everyone
+    assert answer_cache.complete('k1', 'owner1', RESULT) == []
+    assert answer_cache.complete('k1', 'owner2', RESULT) == ['waiter1', 'waiter2']
+
+
+def test_abandoned_claims_can_be_taken_again(cache):
+    answer_cache.claim('k1', 'kb1', 'owner1')
+    answer_cache.claim('k1', 'kb1', 'waiter1')
+    assert answer_cache.abandon('k1', 'owner1') == ['waiter1']
+    assert answer_cache.claim('k1', 'kb1', 'owner2') == (answer_cache.OWNER, None)
+    assert answer_cache.complete('k1', 'owner2', RESULT) == []
+
+
+def test_large_answers_are_cached_through_the_result_store(cache, monkeypatch):
+    boto3.client('s3').create_bucket(Bucket='ava-test-results')
+    monkeypatch.setattr(result_store, 'RESULT_BUCKET', 'ava-test-results')
+    monkeypatch.setattr(result_store, 'RESULT_INLINE_MAX_BYTES', 10)
+
+    answer_cache.claim('k1', 'kb1', 'owner')
+    answer_cache.complete('k1', 'owner', RESULT)
+    entry = aws_clients.state_table().get_item(Key=answer_cache._entry_key('k1'))['Item']
+    assert 'result' not in entry and entry[result_store.REFERENCE_ATTRIBUTE]
+    assert answer_cache.lookup('k1', 'kb1') == (RESULT, 0)
+
+
+def test_waiters_are_answered_when_the_cache_write_fails(cache, monkeypatch):
+    monkeypatch.setattr(answer_cache, 'ENABLED', True)
+    for chatbot_request_id in ('owner', 'waiter'):
+        aws_clients.tracking_table().put_item(Item={'chatbot_request_id': chatbot_request_id, 'status': 'processing'})
+    answer_cache.claim('k1', 'kb1', 'owner')
+    answer_cache.claim('k1', 'kb1', 'waiter')
+
+    def complete(*args):
+        raise RuntimeError('Item size has exceeded the maximum allowed size')
+    monkeypatch.setattr(answer_cache, 'complete', complete)
+
+    queue_handler.publish_to_answer_cache('k1', 'owner', RESULT, 'success')
+    waiter = aws_clients.tracking_table().get_item(Key={'chatbot_request_id': 'waiter'})['Item']
+    assert waiter['status'] == 'success'
+
+
+def test_inline_answers_are_shared_through_the_cache(cache, monkeypatch):
+    monkeypatch.setattr(answer_cache, 'ENABLED', True)
+    body = {
+        'message': 'What was the tone?', 'knowledgeBaseId': 'kb1', 'sync': True,
+        'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0',
+        'textInferenceConfig': {'maxTokens': 4096, 'temperature': 0.5, 'topP': 1, 'stopSequences': []}
+    }
+    cache_key = answer_cache.cache_key(index.build_payload(body))
+    # An identical question that is already waiting on this one
+    aws_clients.tracking_table().put_item(Item={'chatbot_request_id': 'waiter', 'status': 'processing'})
+
+    def answer(payload):
+        assert answer_cache.claim(cache_key, 'kb1', 'waiter') == (answer_cache.WAITER, None)
+        return RESULT
+    monkeypatch.setattr(fast_path, 'answer', answer)
+
+    def post(sub):
+        return json.loads(index.handler({
+            'httpMethod': 'POST',
+            'path': '/chatbot',
+            'body': json.dumps(body),
+            'requestContext': {'authorizer': {'claims': {'sub': sub}}}
+        }, None)['body'])
+
+    assert post('u1')['sync']
+    waiter = aws_clients.tracking_table().get_item(Key={'chatbot_request_id': 'waiter'})['Item']
+    assert waiter['status'] == 'success'
+
+    answer_cache._local.clear()
+    assert answer_cache.lookup(cache_key, 'kb1') == (RESULT, 0)
+    assert post('u2')['cached']
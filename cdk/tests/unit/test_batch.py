@@ -0,0 +1,103 @@
+import json
+
+import boto3
+import pytest
+
+import aws_clients
+import index
+
+REQUEST = {
+    'message': 'What was the tone of the meeting?',
+    'knowledgeBaseId': 'kb1',
+    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0',
+    'textInferenceConfig': {'maxTokens': 4096, 'temperature': 0.5, 'topP': 1, 'stopSequences': []}
+}
+
+
+@pytest.fixture
+def api(aws, monkeypatch):
+    monkeypatch.setattr(index, 'QUEUE_URL', aws)
+    return aws
+
+
+def call(method, path, body=None, query=None, sub='u1'):
+    response = index.handler({
+        'httpMethod': method,
+        'path': path,
+        'body': json.dumps(body) if body is not None else None,
+        'queryStringParameters': query,
+        'requestContext': {'authorizer': {'claims': {'sub': sub}}}
+    }, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def status(chatbot_request_id):
+    return aws_clients.tracking_table().get_item(Key={'chatbot_request_id': chatbot_request_id})['Item']['status']
+
+
+def test_batches_are_queued_and_read_back(api):
+    code, body = call('POST', '/chatbot/batch', {'requests': [REQUEST] * 12})
+    assert code == 200
+    ids = [entry['chatbot_request_id'] for entry in body['requests']]
+    assert len(set(ids)) == 12
+    queued = boto3.client('sqs').get_queue_attributes(QueueUrl=api, AttributeNames=['ApproximateNumberOfMessages'])
+    assert queued['Attributes']['ApproximateNumberOfMessages'] == '12'
+
+    code, body = call('GET', '/chatbot/batch', query={'ids': f"{ids[1]}, {ids[0]},{ids[1]},unknown"})
+    assert code == 200
+    assert [record['chatbot_request_id'] for record in body['requests']] == [ids[1], ids[0]]
+    assert {record['status'] for record in body['requests']} == {'processing'}
+    assert body['missing'] == ['unknown']
+
+
+def test_batches_over_the_limit_are_rejected(api, monkeypatch):
+    monkeypatch.setattr(index, 'MAX_BATCH_SIZE', 3)
+    code, body = call('POST', '/chatbot/batch', {'requests': [REQUEST] * 4})
+    assert code == 400 and '3' in body['error']
+    code, body = call('GET', '/chatbot/batch', query={'ids': 'a,b,c,d'})
+    assert code == 400
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'requests': []},
+    {'requests': REQUEST},
+    {'requests': [REQUEST, 'What was the tone?']},
+    {'requests': [REQUEST, {**REQUEST, 'knowledgeBaseId': None}]},
+    {'requests': [REQUEST, {**REQUEST, 'textPromptTemplate': 'Answer briefly.'}]}
+])
+def test_invalid_batches_queue_nothing(api, body):
+    code, _ = call('POST', '/chatbot/batch', body)
+    assert code == 400
+    assert aws_clients.tracking_table().scan()['Count'] == 0
+
+
+def test_status_reads_need_ids(api):
+    assert call('GET', '/chatbot/batch', query={'ids': ' , '})[0] == 400
+    assert call('GET', '/chatbot/batch')[0] == 400
+
+
+class PartlyFailingSqs:
+    """Rejects every other entry of a batch."""
+
+    def __init__(self, sqs):
+        self.sqs = sqs
+
+    def send_message_batch(self, QueueUrl, Entries):
+        failed = Entries[1::2]
+        response = self.sqs.send_message_batch(QueueUrl=QueueUrl, Entries=Entries[::2])
+        response['Failed'] = [
+            {'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError', 'Message': 'Try again'}
+            for entry in failed
+        ]
+        return response
+
+
+def test_entries_that_fail_to_queue_are_marked_failed(api, monkeypatch):
+    monkeypatch.setitem(aws_clients._clients, 'sqs', PartlyFailingSqs(boto3.client('sqs')))
+    code, body = call('POST', '/chatbot/batch', {'requests': [REQUEST] * 4})
+
+    assert code == 200
+    queued, failed = body['requests'][::2], body['requests'][1::2]
+    assert all('error' not in entry and status(entry['chatbot_request_id']) == 'processing' for entry in queued)
+    assert all(entry['error'] == 'Try again' and status(entry['chatbot_request_id']) == 'error' for entry in failed)
@@ -0,0 +1,98 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'lambda')
+
+# Cold-start budgets in milliseconds. They leave head room over what the
+# handlers take today; a change that blows through them needs a look.
+IMPORT_BUDGET_MS = float(os.environ.get('COLD_START_IMPORT_BUDGET_MS', '1500'))
+FIRST_INVOCATION_BUDGET_MS = float(os.environ.get('COLD_START_FIRST_INVOCATION_BUDGET_MS', '50'))
+
+# Runs in a fresh interpreter so nothing is already imported or cached
+PROBE = """
+import json
+import time
+
+started = time.perf_counter()
+import index
+import queue_handler
+imported = time.perf_counter()
+
+import aws_clients
+clients_after_import = sorted(aws_clients._clients)
+
+response = index.handler({'httpMethod': 'GET', 'path': '/chatbot'}, None)
+invoked = time.perf_counter()
+clients_after_invocation = sorted(aws_clients._clients)
+
+# A warm container serves the model catalog from memory, and a client
+# holding the current version gets an empty 304
+import model_catalog
+model_catalog._cache.update(models=model_catalog.FALLBACK_MODELS, expires_at=time.monotonic() + 60)
+models = index.handler({'httpMethod': 'GET', 'path': '/models'}, None)
+revalidated = index.handler(
+    {'httpMethod': 'GET', 'path': '/models', 'headers': {'If-None-Match': models['headers']['ETag']}}, None
+)
+
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_invocation_ms': (invoked - imported) * 1000,
+    'clients_after_import': clients_after_import,
+    'clients_after_invocation': clients_after_invocation,
+    'status_code': response['statusCode'],
+    'models_status_code': models['statusCode'],
+    'models_cache_control': models['headers'].get('Cache-Control'),
+    'revalidated_status_code': revalidated['statusCode'],
+    'revalidated_body': revalidated['body']
+}))
+"""
+
+
+@pytest.fixture(scope='module')
+def cold_start():
+    env = dict(
+        os.environ,
+        DYNAMODB_TABLE='ava-chatbot-tracking-table',
+        STATE_TABLE='ava-chatbot-state-table',
+        SQS_QUEUE_URL='https://sqs.us-east-1.amazonaws.com/123456789012/ava-queue',
+        AWS_DEFAULT_REGION='us-east-1',
+        AWS_ACCESS_KEY_ID='testing',
+        AWS_SECRET_ACCESS_KEY='testing'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE],
+        cwd=LAMBDA_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    measurements = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f"Cold start: {json.dumps(measurements)}")
+    return measurements
+
+
+def test_import_builds_no_clients(cold_start):
+    assert cold_start['clients_after_import'] == []
+
+
+def test_import_time_within_budget(cold_start):
+    assert cold_start['import_ms'] < IMPORT_BUDGET_MS
+
+
+def test_first_invocation_needs_no_client(cold_start):
+    # GET /chatbot without a request id is answered before any AWS call
+    assert cold_start['status_code'] == 400
+    assert cold_start['clients_after_invocation'] == []
+    assert cold_start['first_invocation_ms'] < FIRST_INVOCATION_BUDGET_MS
+
+
+def test_model_catalog_revalidates_with_304(cold_start):
+    assert cold_start['models_status_code'] == 200
+    assert cold_start['models_cache_control'].startswith('private, max-age=')
+    assert cold_start['revalidated_status_code'] == 304
+    assert cold_start['revalidated_body'] == ''
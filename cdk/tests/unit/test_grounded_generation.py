@@ -0,0 +1,31 @@
+import grounded_generation
+
+RESULTS = [
+    {'content': {'text': 'Hot flashes are common in menopause.'}, 'location': {'s3Location': {'uri': 's3://kb/a.txt'}}},
+    {'content': {'text': 'Talk to a doctor about treatment.'}, 'location': {'s3Location': {'uri': 's3://kb/b.txt'}}}
+]
+
+
+def test_prompt_fills_template_placeholders():
+    prompt = grounded_generation.build_prompt(
+        'Q: $query$\n$search_results$\n$output_format_instructions$', 'hot flashes?', RESULTS
+    )
+    assert prompt.startswith('Q: hot flashes?')
+    assert '<index>2</index>' in prompt and 'Talk to a doctor' in prompt
+    assert grounded_generation.OUTPUT_FORMAT_INSTRUCTIONS in prompt
+    assert '$' not in prompt
+
+
+def test_citations_follow_paragraph_markers():
+    text = 'You asked about hot flashes.\n\nThey are common [1].\n\nSee a doctor [2][1].'
+    citations = grounded_generation.build_citations(text, RESULTS)
+
+    assert [c['generatedResponsePart']['textResponsePart']['text'] for c in citations] == [
+        'You asked about hot flashes.', 'They are common.', 'See a doctor.'
+    ]
+    assert [c['retrievedReferences'] for c in citations] == [[], [RESULTS[0]], [RESULTS[1], RESULTS[0]]]
+
+
+def test_out_of_range_markers_are_ignored():
+    citations = grounded_generation.build_citations('Unsupported claim [7].', RESULTS)
+    assert citations[0]['retrievedReferences'] == []
@@ -0,0 +1,67 @@
+import base64
+import json
+
+import pytest
+
+import aws_clients
+import index
+
+
+def history(sub='u1', **query):
+    response = index.handler({
+        'httpMethod': 'GET',
+        'path': '/chatbot/history',
+        'queryStringParameters': query or None,
+        'requestContext': {'authorizer': {'claims': {'sub': sub}}} if sub else {}
+    }, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+@pytest.fixture
+def records(aws):
+    table = aws_clients.tracking_table()
+    for number in range(5):
+        for user_sub in ('u1', 'u2'):
+            table.put_item(Item=index.new_record(
+                f"{user_sub}-r{number}", {'message': f"Question {number}", 'knowledgeBaseId': 'kb1'},
+                1_700_000_000_000 + number, user_sub
+            ))
+
+
+def test_history_pages_through_the_callers_requests_newest_first(records):
+    code, page = history(limit='2')
+    assert code == 200
+    assert [entry['chatbot_request_id'] for entry in page['requests']] == ['u1-r4', 'u1-r3']
+    assert page['requests'][0]['message'] == 'Question 4' and page['requests'][0]['knowledgeBaseId'] == 'kb1'
+
+    seen = [entry['chatbot_request_id'] for entry in page['requests']]
+    while page['next']:
+        code, page = history(limit='2', next=page['next'])
+        assert code == 200
+        seen.extend(entry['chatbot_request_id'] for entry in page['requests'])
+    assert seen == ['u1-r4', 'u1-r3', 'u1-r2', 'u1-r1', 'u1-r0']
+
+
+def test_page_tokens_only_work_for_their_owner(records):
+    _, page = history(limit='2')
+    code, body = history(sub='u2', limit='2', next=page['next'])
+    assert code == 400 and 'next' in body['error']
+
+    # A token edited to point into someone else's history is refused too
+    start_key = json.loads(base64.urlsafe_b64decode(page['next']))
+    forged = base64.urlsafe_b64encode(json.dumps({**start_key, 'user_sub': 'u2'}).encode()).decode()
+    assert history(limit='2', next=forged)[0] == 400
+
+
+@pytest.mark.parametrize('token', ['not base64!', base64.urlsafe_b64encode(b'not json').decode(),
+                                   base64.urlsafe_b64encode(b'[1, 2]').decode()])
+def test_malformed_page_tokens_are_rejected(records, token):
+    assert history(next=token)[0] == 400
+
+
+def test_history_needs_a_signed_in_caller_and_a_numeric_limit(records):
+    assert history(sub=None)[0] == 401
+    assert history(limit='ten')[0] == 400
+    # Out of range limits are clamped
+    code, page = history(limit='0')
+    assert code == 200 and len(page['requests']) == 1
@@ -0,0 +1,163 @@
+import json
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+import answer_cache
+import aws_clients
+import fast_path
+import idempotency
+import index
+import sessions
+
+BODY = {
+    'message': 'What was the tone of the meeting?',
+    'knowledgeBaseId': 'kb1',
+    'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0',
+    'textInferenceConfig': {'maxTokens': 4096, 'temperature': 0.5, 'topP': 1, 'stopSequences': []}
+}
+
+
+def post(body=None, sub='u1'):
+    return index.handler({
+        'httpMethod': 'POST',
+        'path': '/chatbot',
+        'body': json.dumps(body or BODY),
+        'requestContext': {'authorizer': {'claims': {'sub': sub}}}
+    }, None)
+
+
+@pytest.fixture
+def api(aws, monkeypatch):
+    monkeypatch.setattr(index, 'QUEUE_URL', aws)
+    monkeypatch.setattr(answer_cache, 'ENABLED', False)
+    return aws
+
+
+def queued(queue_url):
+    return boto3.client('sqs').get_queue_attributes(
+        QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages']
+    )['Attributes']['ApproximateNumberOfMessages']
+
+
+def test_ids_depend_on_caller_and_payload():
+    event = {'requestContext': {'authorizer': {'claims': {'sub': 'u1'}}}}
+    payload = index.build_payload(BODY)
+    assert idempotency.request_id(event, BODY, payload) == idempotency.request_id(
+        event, BODY, {**payload, 'message': '  What was the tone of  the meeting? '})
+    assert idempotency.request_id(event, BODY, payload) != idempotency.request_id(
+        {'requestContext': {'authorizer': {'claims': {'sub': 'u2'}}}}, BODY, payload)
+
+
+def test_repeated_submissions_queue_one_job(api):
+    first = json.loads(post()['body'])
+    second = json.loads(post()['body'])
+    assert second == {'chatbot_request_id': first['chatbot_request_id'], 'duplicate': True}
+    assert queued(api) == '1'
+
+
+def test_retry_after_a_failed_send_queues_the_job(api, monkeypatch):
+    monkeypatch.setattr(index, 'QUEUE_URL', api + '-missing')
+    failed = json.loads(post()['body'])
+    assert failed['success'] is False
+
+    monkeypatch.setattr(index, 'QUEUE_URL', api)
+    retried = json.loads(post()['body'])
+    assert 'duplicate' not in retried
+    assert queued(api) == '1'
+    record = aws_clients.tracking_table().get_item(Key={'chatbot_request_id': retried['chatbot_request_id']})
+    assert record['Item']['status'] == 'processing'
+
+
+def test_repeated_sync_submissions_answer_once(api, monkeypatch):
+    calls = []
+
+    def answer(payload):
+        calls.append(payload)
+        return {'output': {'text': 'Upbeat.'}, 'citations': []}
+    monkeypatch.setattr(fast_path, 'answer', answer)
+
+    first = json.loads(post({**BODY, 'sync': True})['body'])
+    second = json.loads(post({**BODY, 'sync': True})['body'])
+    assert len(calls) == 1
+    assert first['status'] == 'success' and first['sync']
+    assert second['duplicate'] and second['status'] == 'success'
+    assert second['result']['output']['text'] == 'Upbeat.'
+
+
+def test_sync_fallback_queues_the_job_once(api, monkeypatch):
+    monkeypatch.setattr(fast_path, 'answer', lambda payload: None)
+    first = json.loads(post({**BODY, 'sync': True})['body'])
+    assert 'duplicate' not in first
+    assert json.loads(post({**BODY, 'sync': True})['body'])['duplicate']
+    assert queued(api) == '1'
+
+
+def test_repeated_follow_ups_in_a_conversation_are_new_questions(api, monkeypatch):
+    monkeypatch.setattr(sessions, 'ENABLED', True)
+    conversation = sessions.conversation_key('u1', 'c1')
+    sessions.save(conversation, 's1')
+    turn = {**BODY, 'message': 'Tell me more', 'conversationId': 'c1'}
+
+    first = json.loads(post(turn)['body'])
+    second = json.loads(post(turn)['body'])
+    assert 'duplicate' not in second
+    assert first['chatbot_request_id'] != second['chatbot_request_id']
+    assert queued(api) == '2'
+
+    # A client key still dedupes a retried turn
+    keyed = {**turn, 'idempotencyKey': 'turn-3'}
+    assert json.loads(post(keyed)['body'])['chatbot_request_id'] == json.loads(post(keyed)['body'])['chatbot_request_id']
+
+
+def test_failed_sync_answers_free_the_submission(api, monkeypatch):
+    def answer(payload):
+        raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'Slow down'}}, 'UpdateItem')
+    monkeypatch.setattr(fast_path, 'answer', answer)
+    assert post({**BODY, 'sync': True})['statusCode'] == 500
+
+    monkeypatch.setattr(fast_path, 'answer', lambda payload: {'output': {'text': 'Upbeat.'}, 'citations': []})
+    retried = json.loads(post({**BODY, 'sync': True})['body'])
+    assert 'duplicate' not in retried and retried['status'] == 'success'
+
+
+def test_sync_answers_are_returned_when_they_cannot_be_stored(api, monkeypatch):
+    monkeypatch.setattr(fast_path, 'answer', lambda payload: {'output': {'text': 'Upbeat.'}, 'citations': []})
+
+    def record_answer(item, result):
+        raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'PutObject')
+    monkeypatch.setattr(index, 'record_answer', record_answer)
+
+    answered = json.loads(post({**BODY, 'sync': True})['body'])
+    assert answered['result']['output']['text'] == 'Upbeat.'
+    # Not left processing, and a retry is not a duplicate
+    assert 'Item' not in aws_clients.tracking_table().get_item(Key={'chatbot_request_id': answered['chatbot_request_id']})
+
+
+def test_records_are_only_returned_to_their_owner(api):
+    chatbot_request_id = json.loads(post()['body'])['chatbot_request_id']
+
+    def get(path, query, sub):
+        return index.handler({
+            'httpMethod': 'GET',
+            'path': path,
+            'queryStringParameters': query,
+            'requestContext': {'authorizer': {'claims': {'sub': sub}}}
+        }, None)
+
+    assert get('/chatbot', {'url': chatbot_request_id}, 'u1')['statusCode'] == 200
+    assert get('/chatbot', {'url': chatbot_request_id}, 'u2')['statusCode'] == 404
+    batch = json.loads(get('/chatbot/batch', {'ids': chatbot_request_id}, 'u2')['body'])
+    assert batch == {'requests': [], 'missing': [chatbot_request_id]}
+
+
+def test_submissions_after_the_window_get_a_new_record(api, monkeypatch):
+    first = json.loads(post()['body'])['chatbot_request_id']
+    later = idempotency.time() + idempotency.IDEMPOTENCY_WINDOW_SECONDS
+    monkeypatch.setattr(idempotency, 'time', lambda: later)
+    second = json.loads(post()['body'])['chatbot_request_id']
+
+    assert first != second
+    assert queued(api) == '2'
+    assert aws_clients.tracking_table().get_item(Key={'chatbot_request_id': first})['Item']['status'] == 'processing'
@@ -0,0 +1,108 @@
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+import aws_clients
+import job_envelope
+import job_retry
+import model_router
+import queue_handler
+
+MODEL = 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0'
+
+
+def client_error(code, status=400):
+    return ClientError({'Error': {'Code': code, 'Message': code}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                       'RetrieveAndGenerate')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_transient_errors_are_told_apart_from_permanent_ones():
+    assert job_retry.is_transient(client_error('ThrottlingException'))
+    # Event streams report codes in camel case
+    assert job_retry.is_transient(client_error('throttlingException'))
+    assert job_retry.is_transient(client_error('ServiceUnavailableException', 503))
+    assert job_retry.is_transient(client_error('SomethingNew', 502))
+    assert job_retry.is_transient(client_error('SomethingNew', 429))
+    assert job_retry.is_transient(ReadTimeoutError(endpoint_url='https://bedrock'))
+
+    assert not job_retry.is_transient(client_error('ValidationException'))
+    assert not job_retry.is_transient(client_error('AccessDeniedException', 403))
+    assert not job_retry.is_transient(ValueError('bad payload'))
+    assert job_retry.is_throttling(client_error('ThrottlingException'))
+    assert not job_retry.is_throttling(client_error('ModelTimeoutException', 408))
+
+
+def test_breaker_opens_cools_down_and_closes_on_a_good_trial(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_retry, 'monotonic', clock)
+    breaker = job_retry.CircuitBreaker(failure_threshold=3, window_seconds=10, cooldown_seconds=30)
+
+    for _ in range(2):
+        breaker.record_failure()
+    assert not breaker.is_open and breaker.wait_seconds() == 0
+    breaker.record_failure()
+    assert breaker.is_open and breaker.wait_seconds() == 30
+
+    clock.now += 30
+    # Half open: one trial goes ahead while everything else keeps waiting
+    assert breaker.wait_seconds() == 0
+    assert breaker.wait_seconds() == 30
+    breaker.record_success()
+    assert not breaker.is_open and breaker.wait_seconds() == 0
+
+
+def test_breaker_reopens_when_the_trial_fails(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_retry, 'monotonic', clock)
+    breaker = job_retry.CircuitBreaker(failure_threshold=1, window_seconds=10, cooldown_seconds=30)
+
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.wait_seconds() == 0
+    breaker.record_failure()
+    assert breaker.is_open and breaker.wait_seconds() == 30
+
+
+def test_failures_outside_the_window_do_not_add_up(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_retry, 'monotonic', clock)
+    breaker = job_retry.CircuitBreaker(failure_threshold=2, window_seconds=10, cooldown_seconds=30)
+
+    breaker.record_failure()
+    clock.now += 11
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+class UnavailableRuntime:
+    def retrieve_and_generate(self, **request):
+        raise client_error('ServiceUnavailableException', 503)
+
+
+def test_a_target_that_keeps_failing_trips_its_breaker(aws, monkeypatch):
+    monkeypatch.setitem(aws_clients._clients, 'bedrock-agent-runtime', UnavailableRuntime())
+    monkeypatch.setattr(job_retry, '_breakers', {})
+    monkeypatch.setattr(model_router, 'MODEL_ROUTES', {})
+    monkeypatch.setattr(model_router, '_stats', {})
+
+    for number in range(job_retry.BREAKER_FAILURE_THRESHOLD):
+        chatbot_request_id = f"r{number}"
+        aws_clients.tracking_table().put_item(Item={'chatbot_request_id': chatbot_request_id, 'status': 'processing'})
+        message_body, _ = job_envelope.build_message(chatbot_request_id, {
+            'message': 'What was the tone?',
+            'knowledgeBaseId': 'kb1',
+            'modelArn': MODEL,
+            'textInferenceConfig': {'maxTokens': 4096, 'temperature': 0.5, 'topP': 1, 'stopSequences': []}
+        })
+        # Deferred for another attempt; the receipt handle is fake, so the visibility change fails
+        assert queue_handler._timed_process_record({
+            'messageId': f"m{number}", 'receiptHandle': 'fake', 'body': message_body, 'attributes': {}
+        }) == {'itemIdentifier': f"m{number}"}
+
+    assert job_retry.breaker_for(MODEL).is_open
@@ -0,0 +1,92 @@
+import pytest
+
+import kb_catalog
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeBedrockAgent:
+    def __init__(self, knowledge_bases):
+        # id -> (name, tags)
+        self.knowledge_bases = knowledge_bases
+        self.list_calls = 0
+
+    def get_paginator(self, operation):
+        assert operation == 'list_knowledge_bases'
+        return self
+
+    def paginate(self):
+        self.list_calls += 1
+        summaries = [{'knowledgeBaseId': kb_id, 'name': name} for kb_id, (name, _) in self.knowledge_bases.items()]
+        # Two pages, as the real paginator would return for a long list
+        return [{'knowledgeBaseSummaries': summaries[:1]}, {'knowledgeBaseSummaries': summaries[1:]}]
+
+    def get_knowledge_base(self, knowledgeBaseId):
+        return {'knowledgeBase': {'knowledgeBaseArn': f"arn:aws:bedrock:us-east-1:123456789012:knowledge-base/{knowledgeBaseId}"}}
+
+
+class FakeBedrock:
+    def __init__(self, agent):
+        self.agent = agent
+
+    def list_tags_for_resource(self, resourceArn):
+        return {'tags': self.agent.knowledge_bases[resourceArn.rsplit('/', 1)[-1]][1]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kb_catalog, 'monotonic', clock)
+    kb_catalog.invalidate()
+    yield clock
+    kb_catalog.invalidate()
+
+
+def test_only_visible_knowledge_bases_are_listed(clock):
+    agent = FakeBedrockAgent({
+        'kb1': ('Minutes', {'public': 'visible'}),
+        'kb2': ('Drafts', {}),
+        'kb3': ('Policies', {'public': 'visible'})
+    })
+    assert kb_catalog.get_visible_knowledge_bases(agent, FakeBedrock(agent)) == [
+        {'id': 'kb1', 'name': 'Minutes'},
+        {'id': 'kb3', 'name': 'Policies'}
+    ]
+
+
+def test_catalog_is_served_from_memory_until_it_expires(clock):
+    agent = FakeBedrockAgent({'kb1': ('Minutes', {'public': 'visible'})})
+    bedrock = FakeBedrock(agent)
+    first = kb_catalog.get_visible_knowledge_bases(agent, bedrock)
+
+    agent.knowledge_bases['kb2'] = ('Policies', {'public': 'visible'})
+    clock.now += kb_catalog.CATALOG_TTL_SECONDS - 1
+    assert kb_catalog.get_visible_knowledge_bases(agent, bedrock) == first
+    assert agent.list_calls == 1
+
+    clock.now += 1
+    assert [kb['id'] for kb in kb_catalog.get_visible_knowledge_bases(agent, bedrock)] == ['kb1', 'kb2']
+    assert agent.list_calls == 2
+
+
+def test_invalidation_refreshes_on_the_next_call(clock):
+    agent = FakeBedrockAgent({'kb1': ('Minutes', {'public': 'visible'})})
+    bedrock = FakeBedrock(agent)
+    kb_catalog.get_visible_knowledge_bases(agent, bedrock)
+
+    agent.knowledge_bases['kb1'] = ('Minutes', {})
+    kb_catalog.invalidate('kb1 hidden')
+    assert kb_catalog.get_visible_knowledge_bases(agent, bedrock) == []
+    assert agent.list_calls == 2
+
+
+def test_callers_cannot_change_the_cached_list(clock):
+    agent = FakeBedrockAgent({'kb1': ('Minutes', {'public': 'visible'})})
+    kb_catalog.get_visible_knowledge_bases(agent, FakeBedrock(agent)).clear()
+    assert kb_catalog.get_visible_knowledge_bases(agent, FakeBedrock(agent)) == [{'id': 'kb1', 'name': 'Minutes'}]
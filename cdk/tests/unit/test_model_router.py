@@ -0,0 +1,54 @@
+import job_retry
+import model_router
+
+US_PROFILE = 'arn:aws:bedrock:us-east-1:123456789012:inference-profile/us.anthropic.claude-3-5-haiku-20241022-v1:0'
+WEST_MODEL = 'arn:aws:bedrock:us-west-2::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0'
+
+
+def routes(monkeypatch):
+    monkeypatch.setattr(model_router, 'MODEL_ROUTES', {'claude-3-5-haiku': [WEST_MODEL]})
+    monkeypatch.setattr(model_router, 'EXPLORE_RATE', 0)
+    monkeypatch.setattr(model_router, '_stats', {})
+    monkeypatch.setattr(job_retry, '_breakers', {})
+
+
+def test_profiles_and_models_share_a_model_id():
+    assert model_router.model_id(US_PROFILE) == model_router.model_id(WEST_MODEL)
+
+
+def test_slow_or_throttling_targets_lose_traffic(monkeypatch):
+    routes(monkeypatch)
+    assert model_router.candidates(US_PROFILE) == [US_PROFILE, WEST_MODEL]
+
+    model_router.record(US_PROFILE, 900, throttled=False)
+    model_router.record(WEST_MODEL, 1200, throttled=False)
+    assert model_router.choose(US_PROFILE) == (US_PROFILE, 0.0)
+
+    model_router.record(US_PROFILE, None, throttled=True)
+    assert model_router.choose(US_PROFILE) == (WEST_MODEL, 0.0)
+
+
+def test_open_circuits_are_skipped_until_all_are_open(monkeypatch):
+    routes(monkeypatch)
+    for _ in range(job_retry.BREAKER_FAILURE_THRESHOLD):
+        job_retry.breaker_for(US_PROFILE).record_failure()
+    assert model_router.choose(US_PROFILE) == (WEST_MODEL, 0.0)
+
+    for _ in range(job_retry.BREAKER_FAILURE_THRESHOLD):
+        job_retry.breaker_for(WEST_MODEL).record_failure()
+    target, wait_seconds = model_router.choose(US_PROFILE)
+    assert target is None and wait_seconds > 0
+
+
+def test_throttles_report_no_latency(monkeypatch):
+    routes(monkeypatch)
+    emitted = []
+    monkeypatch.setattr(model_router.metrics, 'emit', lambda values, dimensions, properties=None: emitted.append(values))
+
+    model_router.record(US_PROFILE, None, throttled=True)
+    model_router.record(US_PROFILE, 900, throttled=False)
+    assert emitted == [
+        {'TargetThrottles': (1, 'Count')},
+        {'TargetThrottles': (0, 'Count'), 'TargetLatency': (900, 'Milliseconds')}
+    ]
+    assert model_router._stats[US_PROFILE].latency_ms == 900
@@ -0,0 +1,40 @@
+import json
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import notifications
+
+
+class FakeConnections:
+    def __init__(self):
+        self.sent = []
+
+    def post_to_connection(self, ConnectionId, Data):
+        if ConnectionId == 'gone':
+            raise ClientError({'Error': {'Code': 'GoneException', 'Message': 'Gone'}}, 'PostToConnection')
+        self.sent.append((ConnectionId, json.loads(Data)))
+
+
+def test_push_sends_the_client_record(monkeypatch):
+    connections = FakeConnections()
+    monkeypatch.setitem(aws_clients._clients, 'apigatewaymanagementapi', connections)
+
+    record = {'chatbot_request_id': 'r1', 'status': 'success', 'result': {'output': {'text': 'Hi'}}}
+    assert notifications.push('c1', record)
+    assert connections.sent == [('c1', {'type': 'status', **record})]
+
+
+def test_oversized_answers_are_announced_without_the_result(monkeypatch):
+    connections = FakeConnections()
+    monkeypatch.setitem(aws_clients._clients, 'apigatewaymanagementapi', connections)
+
+    record = {'chatbot_request_id': 'r1', 'status': 'success',
+              'result': {'output': {'text': 'x' * notifications.MAX_PUSH_BYTES}}}
+    notifications.push('c1', record)
+    assert connections.sent[0][1] == {'type': 'status', 'chatbot_request_id': 'r1', 'status': 'success', 'fetch': True}
+
+
+def test_gone_connections_are_reported(monkeypatch):
+    monkeypatch.setitem(aws_clients._clients, 'apigatewaymanagementapi', FakeConnections())
+    assert not notifications.push('gone', {'chatbot_request_id': 'r1', 'status': 'error', 'result': 'Throttled'})
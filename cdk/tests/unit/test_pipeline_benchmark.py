@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('moto')
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'benchmarks')
+sys.path.insert(0, os.path.abspath(BENCHMARKS_DIR))
+
+import pipeline  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def results():
+    return pipeline.PipelineBenchmark(
+        requests=24,
+        concurrency=4,
+        bedrock_latency_ms=20,
+        bedrock_jitter_ms=5,
+        poll_interval_ms=10,
+        worker_concurrency=4
+    ).run()
+
+
+def test_every_request_completes(results):
+    assert results['statuses'] == {'success': 24}
+    assert results['routes'][pipeline.SUBMIT_ROUTE]['count'] == 24
+
+
+def test_repeated_questions_share_generation(results):
+    # Only the distinct questions reach Bedrock; the rest are coalesced or cached
+    generations = results['aws_calls'][pipeline.WORKER_ROUTE]['bedrock-agent-runtime.RetrieveAndGenerate']
+    assert generations <= len(pipeline.QUESTIONS)
+
+
+def test_poll_is_a_single_aws_call(results):
+    assert results['routes'][pipeline.POLL_ROUTE]['aws_calls_per_request'] == 1.0
+
+
+def test_regressions_are_reported(results):
+    assert pipeline.find_regressions(results, results) == []
+
+    baseline = {
+        'end_to_end': results['end_to_end'],
+        'routes': {
+            route: {**section, 'aws_calls_per_request': section['aws_calls_per_request'] / 2}
+            for route, section in results['routes'].items()
+        }
+    }
+    regressions = pipeline.find_regressions(results, baseline)
+    assert any(regression.startswith(pipeline.POLL_ROUTE + ' aws_calls_per_request') for regression in regressions)
@@ -0,0 +1,86 @@
+import decimal
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import job_envelope
+import job_retry
+import queue_handler
+
+LOCATION = {'type': 'S3', 's3Location': {'uri': 's3://minutes/2024-05-01.pdf'}}
+CITATION = {
+    'generatedResponsePart': {'textResponsePart': {'text': 'Upbeat.', 'span': {'start': 0, 'end': 6}}},
+    'retrievedReferences': [{
+        'content': {'text': 'The meeting was upbeat.'},
+        'location': LOCATION,
+        'metadata': {'x-amz-bedrock-kb-document-page-number': 2.0}
+    }]
+}
+
+
+class FakeStreamingRuntime:
+    def retrieve_and_generate_stream(self, **request):
+        return {
+            'sessionId': 's1',
+            'stream': [
+                {'output': {'text': 'Upbeat.'}},
+                {'citation': {'citation': CITATION}}
+            ]
+        }
+
+
+def test_streamed_citations_only_point_at_their_references(aws, monkeypatch):
+    monkeypatch.setitem(aws_clients._clients, 'bedrock-agent-runtime', FakeStreamingRuntime())
+    # Every event is written as it arrives
+    monkeypatch.setattr(queue_handler, 'STREAM_FLUSH_INTERVAL_SECONDS', 0)
+    aws_clients.tracking_table().put_item(Item={'chatbot_request_id': 'r1', 'status': 'processing'})
+
+    result = queue_handler.stream_retrieve_and_generate('r1', {})
+
+    assert result['citations'] == [CITATION]
+    item = aws_clients.tracking_table().get_item(Key={'chatbot_request_id': 'r1'})['Item']
+    assert item['status'] == 'streaming'
+    assert item['stream_citations'] == [{
+        'generatedResponsePart': {'textResponsePart': {
+            'text': 'Upbeat.', 'span': {'start': decimal.Decimal(0), 'end': decimal.Decimal(6)}
+        }},
+        'retrievedReferences': [{'location': LOCATION}]
+    }]
+
+
+def test_partial_output_that_outgrows_the_record_stops_being_written(aws, monkeypatch):
+    monkeypatch.setitem(aws_clients._clients, 'bedrock-agent-runtime', FakeStreamingRuntime())
+    monkeypatch.setattr(queue_handler, 'STREAM_FLUSH_INTERVAL_SECONDS', 0)
+    writes = []
+
+    def append_stream_chunks(chatbot_request_id, text_chunks, citations):
+        writes.append(text_chunks)
+        raise ClientError({'Error': {'Code': 'ValidationException',
+                                     'Message': 'Item size has exceeded the maximum allowed size'}}, 'UpdateItem')
+    monkeypatch.setattr(queue_handler, 'append_stream_chunks', append_stream_chunks)
+
+    result = queue_handler.stream_retrieve_and_generate('r1', {})
+    assert len(writes) == 1
+    assert result['output']['text'] == 'Upbeat.' and result['citations'] == [CITATION]
+
+
+def test_jobs_out_of_deliveries_are_failed_before_the_dead_letter_queue(aws):
+    aws_clients.tracking_table().put_item(Item={'chatbot_request_id': 'r1', 'status': 'processing'})
+    message_body, _ = job_envelope.build_message('r1', {
+        'message': 'What was the tone?',
+        'knowledgeBaseId': 'kb1',
+        'modelArn': 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0',
+        'textInferenceConfig': {'maxTokens': 4096, 'temperature': 0.5, 'topP': 1, 'stopSequences': []}
+    })
+
+    result = queue_handler._timed_process_record({
+        'messageId': 'm1',
+        'body': message_body,
+        'attributes': {'ApproximateReceiveCount': str(job_retry.MAX_DELIVERIES + 1)}
+    })
+
+    # Handled, so the message is deleted instead of redriven
+    assert result is None
+    item = aws_clients.tracking_table().get_item(Key={'chatbot_request_id': 'r1'})['Item']
+    assert item['status'] == 'error'
+    assert item['result'].startswith('Gave up')
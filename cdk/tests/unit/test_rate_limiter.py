@@ -0,0 +1,180 @@
+import os
+
+import pytest
+
+import aws_clients
+import job_envelope
+import job_retry
+import model_router
+import queue_handler
+import rate_limiter
+
+US_PROFILE = 'arn:aws:bedrock:us-east-1:123456789012:inference-profile/us.anthropic.claude-3-5-haiku-20241022-v1:0'
+WEST_MODEL = 'arn:aws:bedrock:us-west-2::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def buckets(aws, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'STATE_TABLE', os.environ['STATE_TABLE'])
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+
+def limits(monkeypatch, budgets):
+    monkeypatch.setattr(rate_limiter, 'MODEL_RATE_LIMITS', budgets)
+
+
+def bucket(model_arn):
+    return aws_clients.state_table().get_item(Key=rate_limiter._key(model_arn))['Item']
+
+
+def test_each_target_has_its_own_budget(buckets, monkeypatch):
+    limits(monkeypatch, {
+        'claude-3-5-haiku': {'rpm': 1},
+        'us.anthropic.claude-3-5-haiku': {'rpm': 2},
+        'default': {'rpm': 5}
+    })
+    # The most specific pattern wins, anything else falls back to the default
+    assert rate_limiter.budget_for(US_PROFILE) == {'rpm': 2}
+    assert rate_limiter.budget_for(WEST_MODEL) == {'rpm': 1}
+    assert rate_limiter.budget_for('arn:aws:bedrock:us-east-1::foundation-model/amazon.nova-pro-v1:0') == {'rpm': 5}
+
+    assert rate_limiter.acquire(WEST_MODEL, 100) == 0
+    assert rate_limiter.acquire(WEST_MODEL, 100) > 0
+    # Draining one target leaves an equivalent one untouched
+    assert rate_limiter.acquire(US_PROFILE, 100) == 0
+    assert rate_limiter.acquire(US_PROFILE, 100) == 0
+
+
+def test_unbudgeted_models_are_not_limited(buckets, monkeypatch):
+    limits(monkeypatch, {'claude-3-opus': {'rpm': 1}, 'claude-3-5-haiku': {'rpm': 0}})
+    assert rate_limiter.budget_for(US_PROFILE) is None
+    for _ in range(3):
+        assert rate_limiter.acquire(US_PROFILE, 100) == 0
+
+
+def test_waits_cover_the_missing_requests_or_tokens(buckets, monkeypatch):
+    limits(monkeypatch, {'default': {'rpm': 2, 'tpm': 6000}})
+    assert rate_limiter.acquire(US_PROFILE, 4000) == 0
+    # 2000 tokens left of 6000 per minute: 1000 more take 10 seconds
+    assert rate_limiter.acquire(US_PROFILE, 3000) == pytest.approx(10)
+    # Nothing is taken by a call that has to wait
+    assert float(bucket(US_PROFILE)['tokens']) == 2000
+    assert rate_limiter.acquire(US_PROFILE, 2000) == 0
+    # Out of requests: one more takes half a minute at 2 per minute
+    assert rate_limiter.acquire(US_PROFILE, 0) == pytest.approx(30)
+
+
+def test_jobs_bigger_than_the_budget_wait_for_a_full_bucket(buckets, monkeypatch):
+    limits(monkeypatch, {'default': {'tpm': 1000}})
+    assert rate_limiter.acquire(US_PROFILE, 5000) == 0
+    assert rate_limiter.acquire(US_PROFILE, 5000) == pytest.approx(60)
+
+
+def test_buckets_refill_over_time(buckets, monkeypatch):
+    limits(monkeypatch, {'default': {'rpm': 6}})
+    for _ in range(6):
+        assert rate_limiter.acquire(US_PROFILE, 0) == 0
+    assert rate_limiter.acquire(US_PROFILE, 0) == pytest.approx(10)
+
+    buckets.now += 10
+    assert rate_limiter.acquire(US_PROFILE, 0) == 0
+    buckets.now += 120
+    # Never more than a minute of budget
+    for _ in range(6):
+        assert rate_limiter.acquire(US_PROFILE, 0) == 0
+    assert rate_limiter.acquire(US_PROFILE, 0) > 0
+
+
+class ContendedTable:
+    """Another worker takes from the bucket between every read and write."""
+
+    def __init__(self, table, clock, rounds):
+        self.table = table
+        self.clock = clock
+        self.rounds = rounds
+
+    def get_item(self, **kwargs):
+        response = self.table.get_item(**kwargs)
+        if self.rounds and 'Item' in response:
+            self.rounds -= 1
+            self.clock.now += 1
+            self.table.update_item(
+                Key=kwargs['Key'],
+                UpdateExpression='SET refilled_at = :now ADD requests :minus_one',
+                ExpressionAttributeValues={':now': int(self.clock.now * 1000), ':minus_one': -1}
+            )
+        return response
+
+    def update_item(self, **kwargs):
+        return self.table.update_item(**kwargs)
+
+
+def test_contended_buckets_are_read_again(buckets, monkeypatch):
+    limits(monkeypatch, {'default': {'rpm': 10}})
+    assert rate_limiter.acquire(US_PROFILE, 0) == 0
+    table = aws_clients.state_table()
+    monkeypatch.setattr(aws_clients, 'state_table', lambda: ContendedTable(table, buckets, rounds=1))
+
+    assert rate_limiter.acquire(US_PROFILE, 0) == 0
+    # Ours and the other worker's request both came out of the bucket
+    assert float(bucket(US_PROFILE)['requests']) == pytest.approx(7)
+
+
+def test_endless_contention_backs_off(buckets, monkeypatch):
+    limits(monkeypatch, {'default': {'rpm': 100}})
+    assert rate_limiter.acquire(US_PROFILE, 0) == 0
+    table = aws_clients.state_table()
+    monkeypatch.setattr(aws_clients, 'state_table',
+                        lambda: ContendedTable(table, buckets, rounds=rate_limiter.MAX_ACQUIRE_ATTEMPTS))
+    assert rate_limiter.acquire(US_PROFILE, 0) == 1.0
+
+
+class AnsweringRuntime:
+    def __init__(self):
+        self.models = []
+
+    def retrieve_and_generate(self, **request):
+        self.models.append(request['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']['modelArn'])
+        return {'output': {'text': 'Upbeat.'}, 'citations': []}
+
+
+def test_jobs_over_budget_move_to_an_equivalent_target(buckets, monkeypatch):
+    runtime = AnsweringRuntime()
+    monkeypatch.setitem(aws_clients._clients, 'bedrock-agent-runtime', runtime)
+    monkeypatch.setattr(model_router, 'MODEL_ROUTES', {'claude-3-5-haiku': [WEST_MODEL]})
+    monkeypatch.setattr(model_router, 'EXPLORE_RATE', 0)
+    monkeypatch.setattr(model_router, '_stats', {})
+    monkeypatch.setattr(job_retry, '_breakers', {})
+    limits(monkeypatch, {US_PROFILE: {'rpm': 1}, WEST_MODEL: {'rpm': 1}})
+
+    def process(chatbot_request_id):
+        aws_clients.tracking_table().put_item(Item={'chatbot_request_id': chatbot_request_id, 'status': 'processing'})
+        message_body, _ = job_envelope.build_message(chatbot_request_id, {
+            'message': 'What was the tone?',
+            'knowledgeBaseId': 'kb1',
+            'modelArn': US_PROFILE,
+            'textInferenceConfig': {'maxTokens': 4096, 'temperature': 0.5, 'topP': 1, 'stopSequences': []}
+        })
+        return queue_handler._timed_process_record({
+            'messageId': chatbot_request_id, 'receiptHandle': 'fake', 'body': message_body, 'attributes': {}
+        })
+
+    assert process('r1') is None
+    assert process('r2') is None
+    assert runtime.models == [US_PROFILE, WEST_MODEL]
+    served = aws_clients.tracking_table().get_item(Key={'chatbot_request_id': 'r2'})['Item']['served_model_arn']
+    assert served == WEST_MODEL
+
+    # Every target is spent: the job is put back instead of failing
+    assert process('r3') == {'itemIdentifier': 'r3'}
+    assert len(runtime.models) == 2
@@ -0,0 +1,44 @@
+import result_store
+
+REFERENCE = {
+    'content': {'text': 'The meeting was upbeat. ' * 50},
+    'location': {'type': 'S3', 's3Location': {'uri': 's3://ava-kb/meeting.txt'}}
+}
+OTHER_REFERENCE = {
+    'content': {'text': 'Action items were assigned.'},
+    'location': {'type': 'S3', 's3Location': {'uri': 's3://ava-kb/notes.txt'}}
+}
+RESPONSE = {
+    'output': {'text': 'The tone was upbeat.'},
+    'citations': [
+        {
+            'generatedResponsePart': {'textResponsePart': {'text': 'The tone', 'span': {'start': 0, 'end': 7}}},
+            'retrievedReferences': [REFERENCE, OTHER_REFERENCE]
+        },
+        {
+            'generatedResponsePart': {'textResponsePart': {'text': 'was upbeat.', 'span': {'start': 9, 'end': 19}}},
+            'retrievedReferences': [REFERENCE]
+        }
+    ],
+    'sessionId': 'session-1',
+    'ResponseMetadata': {'HTTPStatusCode': 200, 'HTTPHeaders': {'content-type': 'application/json'}}
+}
+
+
+def test_compact_drops_metadata_and_repeated_references():
+    compacted = result_store.compact(RESPONSE)
+    assert 'ResponseMetadata' not in compacted
+    assert compacted['references'] == [REFERENCE, OTHER_REFERENCE]
+    assert [citation['refs'] for citation in compacted['citations']] == [[0, 1], [0]]
+
+
+def test_inline_round_trip():
+    attributes = result_store.encode('request-1', RESPONSE)
+    assert list(attributes) == [result_store.INLINE_ATTRIBUTE]
+
+    expected = {key: value for key, value in RESPONSE.items() if key != 'ResponseMetadata'}
+    assert result_store.decode({'status': 'success', **attributes}) == expected
+
+
+def test_plain_results_pass_through():
+    assert result_store.decode({'status': 'error', 'result': 'Throttled'}) == 'Throttled'
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+import index
+from router import Router, json_response
+
+
+@pytest.fixture
+def router():
+    router = Router()
+
+    @router.route('GET', '/chatbot')
+    def get_chatbot(event, context):
+        return json_response(200, {'method': 'GET'})
+
+    @router.route('POST', '/chatbot/')
+    def post_chatbot(event, context):
+        return json_response(200, {'method': 'POST'})
+
+    return router
+
+
+def test_requests_reach_the_route_for_their_method_and_path(router):
+    for method, path in (('GET', '/chatbot'), ('get', 'chatbot/'), ('POST', '/chatbot')):
+        response = router.dispatch({'httpMethod': method, 'path': path}, None)
+        assert response['statusCode'] == 200
+        assert json.loads(response['body'])['method'] == method.upper()
+
+
+def test_unknown_paths_are_not_found(router):
+    response = router.dispatch({'httpMethod': 'GET', 'path': '/chatbots'}, None)
+    assert response['statusCode'] == 404
+    assert json.loads(response['body']) == {'error': 'No route for /chatbots'}
+    assert response['headers']['Access-Control-Allow-Origin'] == '*'
+
+
+def test_known_paths_with_the_wrong_method_are_not_allowed(router):
+    response = router.dispatch({'httpMethod': 'DELETE', 'path': '/chatbot'}, None)
+    assert response['statusCode'] == 405
+    assert response['headers']['Allow'] == 'GET,POST'
+
+
+def test_failing_handlers_answer_500_and_are_counted():
+    router = Router()
+
+    @router.route('GET', '/broken')
+    def broken(event, context):
+        raise RuntimeError('boom')
+
+    response = router.dispatch({'httpMethod': 'GET', 'path': '/broken'}, None)
+    assert response['statusCode'] == 500
+    assert router.stats()['GET /broken']['errors'] == 1
+
+
+def test_duplicate_routes_are_refused(router):
+    with pytest.raises(ValueError):
+        router.add('GET', 'chatbot', lambda event, context: None)
+
+
+def test_api_answers_unknown_routes_and_methods():
+    assert index.handler({'httpMethod': 'GET', 'path': '/nothing-here'}, None)['statusCode'] == 404
+    response = index.handler({'httpMethod': 'PUT', 'path': '/chatbot'}, None)
+    assert response['statusCode'] == 405
+    assert response['headers']['Allow'] == 'GET,POST'
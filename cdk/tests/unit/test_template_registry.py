@@ -0,0 +1,28 @@
+import pytest
+
+import template_registry
+
+CUSTOM_TEMPLATE = 'Answer briefly.\n$search_results$\n$query$'
+
+
+def test_ids_follow_content_and_version():
+    identifier = template_registry.template_id(CUSTOM_TEMPLATE)
+    assert identifier == template_registry.template_id(CUSTOM_TEMPLATE)
+    assert identifier.startswith(f"v{template_registry.TEMPLATE_VERSION}-")
+    assert identifier != template_registry.template_id(CUSTOM_TEMPLATE + ' ')
+
+
+def test_templates_without_search_results_are_rejected():
+    with pytest.raises(template_registry.InvalidTemplate):
+        template_registry.template_reference('Just answer: $query$')
+
+
+def test_default_template_needs_no_storage():
+    reference = template_registry.template_reference(None)
+    assert reference == {'templateId': template_registry.default_template_id()}
+    assert template_registry.template_for(reference) == template_registry.default_template()
+    assert '$search_results$' in template_registry.default_template()
+
+
+def test_jobs_with_inline_templates_still_resolve():
+    assert template_registry.template_for({'textPromptTemplate': CUSTOM_TEMPLATE}) == CUSTOM_TEMPLATE
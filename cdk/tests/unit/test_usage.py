@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+import answer_cache
+import index
+import rate_limiter
+import usage
+
+SONNET = 'arn:aws:bedrock:us-east-1:123456789012:inference-profile/us.anthropic.claude-3-5-sonnet-20241022-v2:0'
+HAIKU = 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-5-haiku-20241022-v1:0'
+
+
+def test_converse_usage_is_taken_as_reported():
+    measured = usage.measure({'usage': {'inputTokens': 1200, 'outputTokens': 300}}, 'prompt', 812.5)
+    assert measured == {'input_tokens': 1200, 'output_tokens': 300, 'generation_ms': 812, 'usage_estimated': False}
+
+
+def test_knowledge_base_usage_is_estimated():
+    measured = usage.measure({'output': {'text': 'x' * 400}}, 'p' * 800, 100)
+    assert measured['usage_estimated']
+    assert measured['input_tokens'] == 800 // rate_limiter.CHARS_PER_TOKEN + rate_limiter.RETRIEVED_CONTEXT_TOKENS
+    assert measured['output_tokens'] == 100
+
+
+def test_counters_parse_into_totals_and_models():
+    parsed = usage._parse({
+        'pk': 'usage#user#u1#2026-01-01',
+        'requests#*': 3, 'input_tokens#*': 30, 'output_tokens#*': 6, 'generation_ms#*': 900,
+        'requests#anthropic.claude-3-5-haiku': 3, 'input_tokens#anthropic.claude-3-5-haiku': 30
+    })
+    assert parsed['requests'] == 3 and parsed['input_tokens'] == 30
+    assert parsed['models']['anthropic.claude-3-5-haiku']['input_tokens'] == 30
+
+
+def quotas(monkeypatch, used, downgrade=''):
+    monkeypatch.setattr(usage, 'ENABLED', True)
+    monkeypatch.setattr(usage, 'USAGE_QUOTAS', {
+        '*': {'daily_requests': 100},
+        'claude-3-5-sonnet': {'daily_tokens': 1000}
+    })
+    monkeypatch.setattr(usage, 'DOWNGRADE_MODEL_ARN', downgrade)
+    monkeypatch.setattr(usage, '_today', lambda user_sub: usage._parse(used))
+
+
+def test_heavy_users_are_downgraded_or_rejected(monkeypatch):
+    used = {'requests#*': 10, 'input_tokens#anthropic.claude-3-5-sonnet-20241022-v2:0': 1000}
+    quotas(monkeypatch, used, downgrade=HAIKU)
+    assert usage.check('u1', HAIKU) == (HAIKU, False)
+    assert usage.check('u1', SONNET) == (HAIKU, True)
+    assert usage.check(None, SONNET) == (SONNET, False)
+
+    quotas(monkeypatch, used)
+    with pytest.raises(usage.QuotaExceeded):
+        usage.check('u1', SONNET)
+
+    quotas(monkeypatch, {'requests#*': 100})
+    with pytest.raises(usage.QuotaExceeded):
+        usage.check('u1', HAIKU)
+
+
+def test_over_quota_users_still_get_cached_answers(aws, monkeypatch):
+    monkeypatch.setattr(answer_cache, 'ENABLED', True)
+    monkeypatch.setattr(answer_cache, 'STATE_TABLE', os.environ['STATE_TABLE'])
+    answer_cache._local.clear()
+    quotas(monkeypatch, {'requests#*': 100})
+    body = {
+        'message': 'What was the tone?', 'knowledgeBaseId': 'kb1', 'modelArn': HAIKU,
+        'textInferenceConfig': {'maxTokens': 4096, 'temperature': 0.5, 'topP': 1, 'stopSequences': []}
+    }
+    cache_key = answer_cache.cache_key(index.build_payload(body))
+    answer_cache.claim(cache_key, 'kb1', 'earlier')
+    answer_cache.complete(cache_key, 'earlier', {'output': {'text': 'Upbeat.'}, 'citations': []})
+
+    def post(message):
+        return index.handler({
+            'httpMethod': 'POST',
+            'path': '/chatbot',
+            'body': json.dumps({**body, 'message': message}),
+            'requestContext': {'authorizer': {'claims': {'sub': 'u1'}}}
+        }, None)
+
+    cached = post('What was the tone?')
+    assert cached['statusCode'] == 200 and json.loads(cached['body'])['cached']
+    assert post('Who spoke first?')['statusCode'] == 429
+    answer_cache._local.clear()
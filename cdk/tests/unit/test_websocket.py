@@ -0,0 +1,107 @@
+import base64
+import json
+
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+import aws_clients
+import notifications
+import ws_authorizer
+import ws_handler
+from stacks.main_stack import MainStack
+
+USER_POOL_ID = 'us-east-1_Test'
+CLIENT_ID = 'app-client'
+
+
+def token(**claims):
+    claims = {
+        'iss': f"https://cognito-idp.us-east-1.amazonaws.com/{USER_POOL_ID}",
+        'client_id': CLIENT_ID,
+        'token_use': 'access',
+        **claims
+    }
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+    return f"header.{payload}.signature"
+
+
+class FakeCognito:
+    def get_user(self, AccessToken):
+        if AccessToken.endswith('.forged'):
+            raise Exception('NotAuthorizedException')
+        return {'Username': 'alice', 'UserAttributes': [{'Name': 'sub', 'Value': 'u1'}]}
+
+
+@pytest.fixture
+def cognito(monkeypatch):
+    monkeypatch.setattr(ws_authorizer, 'USER_POOL_ID', USER_POOL_ID)
+    monkeypatch.setattr(ws_authorizer, 'USER_POOL_CLIENT_ID', CLIENT_ID)
+    monkeypatch.setitem(aws_clients._clients, 'cognito-idp', FakeCognito())
+
+
+def authorize(query):
+    return ws_authorizer.handler({'queryStringParameters': query, 'methodArn': 'arn:connect'}, None)
+
+
+def test_connections_need_an_access_token_for_the_app(cognito):
+    allowed = authorize({'token': token()})
+    assert allowed['context'] == {'sub': 'u1'}
+    assert allowed['policyDocument']['Statement'][0]['Resource'] == 'arn:connect'
+
+    for query in (None, {'token': token()[:-len('signature')] + 'forged'},
+                  {'token': token(client_id='other-client')},
+                  {'token': token(iss='https://cognito-idp.us-east-1.amazonaws.com/us-east-1_Other')},
+                  {'token': token(token_use='id')}):
+        with pytest.raises(Exception, match='Unauthorized'):
+            authorize(query)
+
+
+def event(route_key, connection_id, body=None, sub=None):
+    request_context = {'routeKey': route_key, 'connectionId': connection_id}
+    if sub:
+        request_context['authorizer'] = {'sub': sub}
+    return {'requestContext': request_context, 'body': json.dumps(body) if body else None}
+
+
+def subscribe(connection_id, chatbot_request_id='r1'):
+    return ws_handler.handler(event('subscribe', connection_id, {'chatbot_request_id': chatbot_request_id}), None)
+
+
+def test_only_the_owner_subscribes_to_a_request(aws):
+    aws_clients.tracking_table().put_item(Item={'chatbot_request_id': 'r1', 'status': 'processing', 'user_sub': 'u1'})
+    aws_clients.tracking_table().put_item(Item={'chatbot_request_id': 'r2', 'status': 'processing'})
+    assert ws_handler.handler(event('$connect', 'c1', sub='u1'), None)['statusCode'] == 200
+    assert ws_handler.handler(event('$connect', 'c2', sub='u2'), None)['statusCode'] == 200
+
+    assert subscribe('c2')['statusCode'] == 403
+    assert subscribe('c1', 'r2')['statusCode'] == 403
+    assert subscribe('c1', 'missing')['statusCode'] == 404
+    assert subscribe('unknown')['statusCode'] == 403
+    assert subscribe('c1')['statusCode'] == 200
+    assert notifications.subscriber('r1') == 'c1'
+
+    ws_handler.handler(event('$disconnect', 'c1'), None)
+    assert subscribe('c1')['statusCode'] == 403
+
+
+def test_subscriptions_are_not_taken_over_by_other_users(aws):
+    assert notifications.subscribe('r1', 'c1', 'u1')
+    assert not notifications.subscribe('r1', 'c2', 'u2')
+    assert notifications.subscriber('r1') == 'c1'
+
+    # A reconnecting client moves its own subscription to the new connection
+    assert notifications.subscribe('r1', 'c3', 'u1')
+    assert notifications.subscriber('r1') == 'c3'
+
+
+def test_connect_route_is_authorized():
+    template = assertions.Template.from_stack(MainStack(core.App(), "ava-test-stack"))
+    template.has_resource_properties("AWS::ApiGatewayV2::Authorizer", {
+        "AuthorizerType": "REQUEST",
+        "IdentitySource": ["route.request.querystring.token"]
+    })
+    template.has_resource_properties("AWS::ApiGatewayV2::Route", {
+        "RouteKey": "$connect",
+        "AuthorizationType": "CUSTOM"
+    })
@@ -0,0 +1,83 @@
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+from stacks.main_stack import MainStack
+from stacks.worker_pipeline import DEFAULT_WORKER_PROFILE, WorkerPerformanceProfile
+
+WORKER_FUNCTION_NAME = "ava-queue-worker-lambda-function"
+
+
+def synth(profile=None):
+    app = core.App()
+    stack = MainStack(app, "ava-test-stack", worker_profile=profile)
+    return assertions.Template.from_stack(stack)
+
+
+@pytest.fixture(scope='module')
+def template():
+    return synth()
+
+
+def test_worker_function_is_sized_by_the_profile(template):
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": WORKER_FUNCTION_NAME,
+        "MemorySize": DEFAULT_WORKER_PROFILE.memory_size_mb,
+        "Timeout": DEFAULT_WORKER_PROFILE.timeout_seconds,
+        "Environment": {
+            "Variables": assertions.Match.object_like({
+                "WORKER_CONCURRENCY": str(DEFAULT_WORKER_PROFILE.worker_threads),
+                "RETRY_MAX_ATTEMPTS": str(DEFAULT_WORKER_PROFILE.retry_max_attempts),
+                "MAX_DEFERRALS": str(DEFAULT_WORKER_PROFILE.max_deferrals)
+            })
+        }
+    })
+
+
+def test_event_source_batches_and_caps_concurrency(template):
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": DEFAULT_WORKER_PROFILE.batch_size,
+        "ScalingConfig": {"MaximumConcurrency": DEFAULT_WORKER_PROFILE.max_concurrency},
+        "FunctionResponseTypes": ["ReportBatchItemFailures"]
+    })
+
+
+def test_queue_visibility_follows_worker_timeout_and_redrives(template):
+    template.has_resource_properties("AWS::SQS::Queue", {
+        "VisibilityTimeout": DEFAULT_WORKER_PROFILE.timeout_seconds * DEFAULT_WORKER_PROFILE.visibility_timeout_multiplier,
+        "RedrivePolicy": {
+            "deadLetterTargetArn": assertions.Match.any_value(),
+            "maxReceiveCount": DEFAULT_WORKER_PROFILE.max_receive_count
+        }
+    })
+    template.has_resource_properties("AWS::SQS::Queue", {
+        "MessageRetentionPeriod": DEFAULT_WORKER_PROFILE.dlq_retention_days * 24 * 60 * 60,
+        "RedrivePolicy": assertions.Match.absent()
+    })
+
+
+def test_custom_profile_sets_window_and_reserved_concurrency():
+    profile = WorkerPerformanceProfile(
+        batch_size=50, max_batching_window_seconds=2, max_concurrency=5, reserved_concurrency=5
+    )
+    template = synth(profile)
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": 50,
+        "MaximumBatchingWindowInSeconds": 2
+    })
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "FunctionName": WORKER_FUNCTION_NAME,
+        "ReservedConcurrentExecutions": 5
+    })
+
+
+@pytest.mark.parametrize('overrides', [
+    {'max_receive_count': 10},
+    {'batch_size': 50},
+    {'max_concurrency': 1},
+    {'max_concurrency': 20, 'reserved_concurrency': 10},
+    {'timeout_seconds': 900, 'visibility_timeout_multiplier': 60}
+])
+def test_profiles_that_cannot_work_are_rejected(overrides):
+    with pytest.raises(ValueError):
+        WorkerPerformanceProfile(**overrides).validate()